@@ -8,6 +8,7 @@ import bcrypt
 from typing import Dict
 
 from models import UserCreate, UserResponse, Role, Token
+from shared.authz import JWT_SECRET_KEY, JWT_ALGORITHM, PERMISSIONS_CLAIM, role_mask
 
 app = FastAPI()
 security = HTTPBearer()
@@ -34,8 +35,8 @@ users_db: Dict[str, dict] = {
     }
 }
 
-SECRET_KEY = "your-secret-key-change-in-production"
-ALGORITHM = "HS256"
+SECRET_KEY = JWT_SECRET_KEY
+ALGORITHM = JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 class LoginRequest(BaseModel):
@@ -98,7 +99,8 @@ async def login(login_data: LoginRequest):
             "sub": user["email"],
             "user_id": user["id"],
             "role": user["role"],
-            "email": user["email"]
+            "email": user["email"],
+            PERMISSIONS_CLAIM: role_mask(user["role"])
         },
         expires_delta=access_token_expires
     )
@@ -120,6 +122,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         email = payload.get("sub")
         role = payload.get("role")
         user_id = payload.get("user_id")
+        permissions = payload.get(PERMISSIONS_CLAIM, role_mask(role))
         
         if email not in users_db:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -130,13 +133,15 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             "valid": True,
             "user": email,
             "user_id": user_id,
-            "role": role
+            "role": role,
+            "permissions": permissions
         })
         
         # Устанавливаем заголовки для nginx
         response.headers["X-Auth-User"] = email
         response.headers["X-Auth-Role"] = role
         response.headers["X-Auth-User-Id"] = user_id
+        response.headers["X-Auth-Permissions"] = str(permissions)
         
         return response
     except jwt.ExpiredSignatureError:
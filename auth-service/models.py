@@ -2,10 +2,7 @@ from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 from enum import Enum
 
-class Role(str, Enum):
-    ADMIN = "admin"
-    USER = "user"
-    MANAGER = "manager"
+from shared.authz import Role, Permission, ROLE_PERMISSIONS
 
 # Заменяем EmailStr на обычную строку с валидацией через Field
 class UserBase(BaseModel):
@@ -40,37 +37,3 @@ class TokenData(BaseModel):
     user_id: Optional[str] = None
     role: Optional[Role] = None
     scopes: List[str] = []
-
-class Permission(str, Enum):
-    READ_CATALOG = "read:catalog"
-    WRITE_CATALOG = "write:catalog"
-    DELETE_CATALOG = "delete:catalog"
-    READ_ORDERS = "read:orders"
-    WRITE_ORDERS = "write:orders"
-    MANAGE_USERS = "manage:users"
-    PROCESS_PAYMENTS = "process:payments"
-
-# Ролевые разрешения
-ROLE_PERMISSIONS = {
-    Role.USER: [
-        Permission.READ_CATALOG,
-        Permission.READ_ORDERS,
-        Permission.WRITE_ORDERS,
-    ],
-    Role.ADMIN: [
-        Permission.READ_CATALOG,
-        Permission.WRITE_CATALOG,
-        Permission.DELETE_CATALOG,
-        Permission.READ_ORDERS,
-        Permission.WRITE_ORDERS,
-        Permission.MANAGE_USERS,
-        Permission.PROCESS_PAYMENTS,
-    ],
-    Role.MANAGER: [
-        Permission.READ_CATALOG,
-        Permission.WRITE_CATALOG,
-        Permission.READ_ORDERS,
-        Permission.WRITE_ORDERS,
-        Permission.PROCESS_PAYMENTS,
-    ]
-}
\ No newline at end of file
@@ -2,10 +2,18 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from strawberry.fastapi import GraphQLRouter
 import strawberry
-from typing import List, Optional
+from strawberry.types import Info
+from typing import AsyncGenerator, List, Optional
 import httpx
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
+from enum import Enum
+from prometheus_fastapi_instrumentator import Instrumentator
+
+from order_feed import OrderFeedHub
+from query_planner import QueryPlanner, build
+from tracing import QueryTracing, report_error, setup_tracing, shutdown_tracing, slow_log, upstream_call
+from shared.resilience import breaker_status, get_breaker
 
 # Настройки сервисов
 SERVICE_URLS = {
@@ -15,19 +23,50 @@ SERVICE_URLS = {
     "payment": "http://payment-service:5000"
 }
 
+# Общий пул соединений ко всем сервисам
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+)
+
+# Breaker с bulkhead на каждый сервис: при деградации сервиса резолверы
+# сразу получают ошибку, а не копят ожидающие запросы
+upstream_breakers = {
+    name: get_breaker(f"upstream.{name}", max_concurrent=100, max_wait=0)
+    for name in SERVICE_URLS
+}
+
+async def call_service(service: str, method: str, path: str, **kwargs) -> httpx.Response:
+    """Запрос к сервису через его circuit breaker; вызов учитывается в трассировке запроса GraphQL"""
+    headers = dict(kwargs.pop("headers", None) or {})
+    async def request():
+        with upstream_call(service, method, path, headers):
+            response = await http_client.request(method, f"{SERVICE_URLS[service]}{path}", headers=headers, **kwargs)
+            # 5xx - сбой сервиса, 4xx - нормальный ответ для вызывающего кода
+            if response.status_code >= 500:
+                response.raise_for_status()
+        return response
+    return await upstream_breakers[service].call(request)
+
 # GraphQL типы
 @strawberry.type
 class Product:
+    """Товар catalog-service; имена полей совпадают с моделью каталога"""
     id: str
     name: str
     description: Optional[str]
     price: float
-    category: str
-    stock: int
-    image_url: Optional[str]
-    created_at: str
+    in_stock: bool
     updated_at: str
 
+def product_from_catalog(data: dict) -> Product:
+    """Product из ответа каталога: id там число, updated_at - время в секундах"""
+    data = dict(data)
+    if "id" in data:
+        data["id"] = str(data["id"])
+    if data.get("updated_at") is not None:
+        data["updated_at"] = datetime.utcfromtimestamp(data["updated_at"]).isoformat()
+    return build(Product, data)
+
 @strawberry.type
 class OrderItem:
     product_id: str
@@ -36,30 +75,9 @@ class OrderItem:
     name: str
     
     @strawberry.field
-    async def product(self) -> Optional[Product]:
+    async def product(self, info: Info) -> Optional[Product]:
         """Получить информацию о товаре"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{SERVICE_URLS['catalog']}/api/v1/catalog/items/{self.product_id}",
-                    timeout=5.0
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    return Product(
-                        id=data["id"],
-                        name=data["name"],
-                        description=data.get("description"),
-                        price=data["price"],
-                        category=data["category"],
-                        stock=data.get("stock", 0),
-                        image_url=data.get("image_url"),
-                        created_at=data["created_at"],
-                        updated_at=data["updated_at"]
-                    )
-            except Exception:
-                pass
-        return None
+        return await fetch_product(info, self.product_id)
 
 @strawberry.type
 class Order:
@@ -92,236 +110,197 @@ class User:
     updated_at: str
     
     @strawberry.field
-    async def orders(self) -> List[Order]:
+    async def orders(self, info: Info, status: Optional[str] = None, limit: int = 100) -> List[Order]:
         """Получить заказы пользователя"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{SERVICE_URLS['order']}/api/v1/orders/user/{self.id}",
-                    params={"limit": 100},
-                    timeout=5.0
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    orders = []
-                    for order_data in data["orders"]:
-                        order_items = [
-                            OrderItem(
-                                product_id=item["product_id"],
-                                quantity=item["quantity"],
-                                price=item["price"],
-                                name=item["name"]
-                            )
-                            for item in order_data["items"]
-                        ]
-                        
-                        orders.append(Order(
-                            id=order_data["id"],
-                            user_id=order_data["user_id"],
-                            items=order_items,
-                            total_amount=order_data["total_amount"],
-                            status=order_data["status"],
-                            payment_status=order_data["payment_status"],
-                            shipping_address=order_data["shipping_address"],
-                            payment_method=order_data["payment_method"],
-                            tracking_number=order_data.get("tracking_number"),
-                            notes=order_data.get("notes"),
-                            created_at=order_data["created_at"],
-                            updated_at=order_data["updated_at"]
-                        ))
-                    return orders
-            except Exception as e:
-                print(f"Error fetching orders: {e}")
-        return []
+        return await fetch_user_orders(info, self.id, status, limit)
+
+# Поля документа, которые нужны полям с резолвером (см. query_planner.py)
+planner = QueryPlanner(requires={
+    Order: {"address": ("shipping_address",)},
+    OrderItem: {"product": ("product_id",)}
+})
+
+async def fetch_product(info: Info, product_id: str) -> Optional[Product]:
+    # id товаров каталога - числа; другого товара в каталоге нет
+    if not product_id.isdigit():
+        return None
+    try:
+        response = await call_service(
+            "catalog", "GET", f"/products/{product_id}",
+            params={"fields": planner.fields(info, Product)},
+            timeout=5.0
+        )
+        if response.status_code == 200:
+            return product_from_catalog(response.json())
+    except Exception as e:
+        report_error(f"Error fetching product {product_id}", e)
+    return None
+
+async def fetch_user_orders(info: Info, user_id: str, status: Optional[str], limit: int) -> List[Order]:
+    """Заказы пользователя; фильтры и выбранные поля выполняет order-service"""
+    params = {"limit": limit, "status": status, "fields": planner.fields(info, Order)}
+    try:
+        response = await call_service(
+            "order", "GET", f"/api/v1/orders/user/{user_id}",
+            params={k: v for k, v in params.items() if v is not None},
+            timeout=5.0
+        )
+        if response.status_code == 200:
+            return [build(Order, order_data) for order_data in response.json()["orders"]]
+    except Exception as e:
+        report_error("Error fetching user orders", e)
+    return []
+
+@strawberry.enum
+class SalesDimension(Enum):
+    CATEGORY = "category"
+    PAYMENT_METHOD = "payment_method"
+
+@strawberry.type
+class SalesBucket:
+    """Продажи за корзину времени (аналитика order-service)"""
+    bucket: Optional[str]
+    category: Optional[str]
+    payment_method: Optional[str]
+    ordered_amount: float
+    items: int
+    revenue: float
+    refunded_amount: float
+    # Счетчики заказов не делятся по категориям: null при группировке по категории
+    orders: Optional[int]
+    paid_orders: Optional[int]
+    failed_payments: Optional[int]
+
+async def fetch_sales(params: dict) -> List[SalesBucket]:
+    params = {k: v for k, v in params.items() if v is not None}
+    response = await call_service("order", "GET", "/api/v1/analytics/sales", params=params, timeout=5.0)
+    if response.status_code != 200:
+        raise ValueError(response.json().get("detail", "Sales analytics unavailable"))
+    return [
+        SalesBucket(
+            bucket=row.get("bucket"),
+            category=row.get("category"),
+            payment_method=row.get("payment_method"),
+            ordered_amount=row["ordered_amount"],
+            items=row["items"],
+            revenue=row["revenue"],
+            refunded_amount=row["refunded_amount"],
+            orders=row.get("orders"),
+            paid_orders=row.get("paid_orders"),
+            failed_payments=row.get("failed_payments")
+        )
+        for row in response.json()["rows"]
+    ]
 
 @strawberry.type
 class Query:
     @strawberry.field
     async def user(self, id: str) -> Optional[User]:
         """Получить пользователя по ID"""
-        async with httpx.AsyncClient() as client:
-            try:
-                # В реальном приложении здесь бы была аутентификация
-                # Для демо используем фиктивные данные
-                return User(
-                    id=id,
-                    username=f"user_{id}",
-                    email=f"user{id}@example.com",
-                    full_name="Test User",
-                    created_at=datetime.utcnow().isoformat(),
-                    updated_at=datetime.utcnow().isoformat()
-                )
-            except Exception:
-                return None
+        try:
+            # В реальном приложении здесь бы была аутентификация
+            # Для демо используем фиктивные данные
+            return User(
+                id=id,
+                username=f"user_{id}",
+                email=f"user{id}@example.com",
+                full_name="Test User",
+                created_at=datetime.utcnow().isoformat(),
+                updated_at=datetime.utcnow().isoformat()
+            )
+        except Exception:
+            return None
     
     @strawberry.field
-    async def product(self, id: str) -> Optional[Product]:
+    async def product(self, info: Info, id: str) -> Optional[Product]:
         """Получить товар по ID"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{SERVICE_URLS['catalog']}/api/v1/catalog/items/{id}",
-                    timeout=5.0
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    return Product(
-                        id=data["id"],
-                        name=data["name"],
-                        description=data.get("description"),
-                        price=data["price"],
-                        category=data["category"],
-                        stock=data.get("stock", 0),
-                        image_url=data.get("image_url"),
-                        created_at=data["created_at"],
-                        updated_at=data["updated_at"]
-                    )
-            except Exception:
-                pass
-        return None
+        return await fetch_product(info, id)
     
     @strawberry.field
     async def products(
         self,
-        category: Optional[str] = None,
+        info: Info,
         min_price: Optional[float] = None,
         max_price: Optional[float] = None,
         search: Optional[str] = None,
+        in_stock: Optional[bool] = None,
         limit: int = 20
     ) -> List[Product]:
         """Получить список товаров с фильтрацией"""
-        async with httpx.AsyncClient() as client:
-            try:
-                params = {
-                    "page": 1,
-                    "page_size": limit,
-                    "category": category,
-                    "min_price": min_price,
-                    "max_price": max_price,
-                    "search": search
-                }
-                params = {k: v for k, v in params.items() if v is not None}
-                
-                response = await client.get(
-                    f"{SERVICE_URLS['catalog']}/api/v1/catalog/items",
-                    params=params,
-                    timeout=5.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    products = []
-                    for item in data["items"]:
-                        products.append(Product(
-                            id=item["id"],
-                            name=item["name"],
-                            description=item.get("description"),
-                            price=item["price"],
-                            category=item["category"],
-                            stock=item.get("stock", 0),
-                            image_url=item.get("image_url"),
-                            created_at=item["created_at"],
-                            updated_at=item["updated_at"]
-                        ))
-                    return products
-            except Exception as e:
-                print(f"Error fetching products: {e}")
+        try:
+            params = {
+                "min_price": min_price,
+                "max_price": max_price,
+                "search": search,
+                "in_stock": in_stock,
+                "limit": limit,
+                "fields": planner.fields(info, Product)
+            }
+            params = {k: v for k, v in params.items() if v is not None}
+            
+            response = await call_service(
+                "catalog", "GET", "/products",
+                params=params,
+                timeout=5.0
+            )
+            
+            if response.status_code == 200:
+                return [product_from_catalog(item) for item in response.json()["products"]]
+        except Exception as e:
+            report_error("Error fetching products", e)
         return []
     
     @strawberry.field
-    async def user_orders(self, user_id: str) -> List[Order]:
-        """Получить все заказы пользователя с деталями товаров"""
-        async with httpx.AsyncClient() as client:
-            try:
-                # Получаем заказы пользователя
-                orders_response = await client.get(
-                    f"{SERVICE_URLS['order']}/api/v1/orders/user/{user_id}",
-                    params={"limit": 50},
-                    timeout=5.0
-                )
-                
-                if orders_response.status_code == 200:
-                    data = orders_response.json()
-                    orders = []
-                    
-                    # Для каждого заказа создаем объект Order с OrderItems
-                    for order_data in data["orders"]:
-                        order_items = []
-                        
-                        # Создаем OrderItems для каждого товара в заказе
-                        for item in order_data["items"]:
-                            order_items.append(OrderItem(
-                                product_id=item["product_id"],
-                                quantity=item["quantity"],
-                                price=item["price"],
-                                name=item["name"]
-                            ))
-                        
-                        # Создаем Order с OrderItems
-                        order = Order(
-                            id=order_data["id"],
-                            user_id=order_data["user_id"],
-                            items=order_items,
-                            total_amount=order_data["total_amount"],
-                            status=order_data["status"],
-                            payment_status=order_data["payment_status"],
-                            shipping_address=order_data["shipping_address"],
-                            payment_method=order_data["payment_method"],
-                            tracking_number=order_data.get("tracking_number"),
-                            notes=order_data.get("notes"),
-                            created_at=order_data["created_at"],
-                            updated_at=order_data["updated_at"]
-                        )
-                        
-                        orders.append(order)
-                    
-                    return orders
-            except Exception as e:
-                print(f"Error fetching user orders: {e}")
-        
-        return []
+    async def user_orders(
+        self,
+        info: Info,
+        user_id: str,
+        status: Optional[str] = None,
+        limit: int = 50
+    ) -> List[Order]:
+        """Получить заказы пользователя (фильтр по статусу) с деталями товаров"""
+        return await fetch_user_orders(info, user_id, status, limit)
+    
+    @strawberry.field
+    async def sales_analytics(
+        self,
+        from_time: Optional[str] = None,
+        to_time: Optional[str] = None,
+        step: Optional[int] = None,
+        group_by: Optional[List[SalesDimension]] = None
+    ) -> List[SalesBucket]:
+        """Продажи за период (ISO-время UTC, по умолчанию последние сутки) с шагом step секунд"""
+        return await fetch_sales({
+            "from": from_time,
+            "to": to_time,
+            "step": step,
+            "group_by": ",".join(d.value for d in group_by) if group_by else None
+        })
     
     @strawberry.field
-    async def order(self, id: str) -> Optional[Order]:
+    async def revenue_by_category(self, hours: int = 24) -> List[SalesBucket]:
+        """Выручка по категориям за последние hours часов"""
+        now = datetime.utcnow()
+        return await fetch_sales({
+            "from": (now - timedelta(hours=hours)).isoformat(),
+            "to": now.isoformat(),
+            "group_by": SalesDimension.CATEGORY.value
+        })
+    
+    @strawberry.field
+    async def order(self, info: Info, id: str) -> Optional[Order]:
         """Получить заказ по ID"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{SERVICE_URLS['order']}/api/v1/orders/{id}",
-                    timeout=5.0
-                )
-                
-                if response.status_code == 200:
-                    order_data = response.json()
-                    
-                    # Создаем OrderItems
-                    order_items = [
-                        OrderItem(
-                            product_id=item["product_id"],
-                            quantity=item["quantity"],
-                            price=item["price"],
-                            name=item["name"]
-                        )
-                        for item in order_data["items"]
-                    ]
-                    
-                    # Создаем Order
-                    return Order(
-                        id=order_data["id"],
-                        user_id=order_data["user_id"],
-                        items=order_items,
-                        total_amount=order_data["total_amount"],
-                        status=order_data["status"],
-                        payment_status=order_data["payment_status"],
-                        shipping_address=order_data["shipping_address"],
-                        payment_method=order_data["payment_method"],
-                        tracking_number=order_data.get("tracking_number"),
-                        notes=order_data.get("notes"),
-                        created_at=order_data["created_at"],
-                        updated_at=order_data["updated_at"]
-                    )
-            except Exception as e:
-                print(f"Error fetching order: {e}")
+        try:
+            response = await call_service(
+                "order", "GET", f"/api/v1/orders/{id}",
+                params={"fields": planner.fields(info, Order)},
+                timeout=5.0
+            )
+            
+            if response.status_code == 200:
+                return build(Order, response.json())
+        except Exception as e:
+            report_error("Error fetching order", e)
         
         return None
 
@@ -335,57 +314,65 @@ class Mutation:
         shipping_address: strawberry.scalars.JSON  # ИЗМЕНЯЕМ ТИП
     ) -> Optional[Order]:
         """Создать новый заказ"""
-        async with httpx.AsyncClient() as client:
-            try:
-                order_data = {
-                    "user_id": user_id,
-                    "items": items,
-                    "shipping_address": shipping_address,
-                    "payment_method": "card"
-                }
-                
-                response = await client.post(
-                    f"{SERVICE_URLS['order']}/api/v1/orders",
-                    json=order_data,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 201:
-                    order_data = response.json()
-                    
-                    # Создаем OrderItems
-                    order_items = [
-                        OrderItem(
-                            product_id=item["product_id"],
-                            quantity=item["quantity"],
-                            price=item["price"],
-                            name=item["name"]
-                        )
-                        for item in order_data["items"]
-                    ]
-                    
-                    # Создаем Order
-                    return Order(
-                        id=order_data["id"],
-                        user_id=order_data["user_id"],
-                        items=order_items,
-                        total_amount=order_data["total_amount"],
-                        status=order_data["status"],
-                        payment_status=order_data["payment_status"],
-                        shipping_address=order_data["shipping_address"],
-                        payment_method=order_data["payment_method"],
-                        tracking_number=order_data.get("tracking_number"),
-                        notes=order_data.get("notes"),
-                        created_at=order_data["created_at"],
-                        updated_at=order_data["updated_at"]
-                    )
-            except Exception as e:
-                print(f"Error creating order: {e}")
+        try:
+            order_data = {
+                "user_id": user_id,
+                "items": items,
+                "shipping_address": shipping_address,
+                "payment_method": "card"
+            }
+            
+            response = await call_service(
+                "order", "POST", "/api/v1/orders",
+                json=order_data,
+                timeout=10.0
+            )
+            
+            if response.status_code == 201:
+                return build(Order, response.json())
+        except Exception as e:
+            report_error("Error creating order", e)
         
         return None
 
+@strawberry.type
+class OrderChange:
+    """Изменение заказа из ленты order-service; kind: snapshot, created, updated, deleted
+    или lagged - часть изменений пропущена (dropped), заказы стоит перечитать"""
+    kind: str
+    id: Optional[str] = None
+    user_id: Optional[str] = None
+    version: Optional[int] = None
+    status: Optional[str] = None
+    payment_status: Optional[str] = None
+    tracking_number: Optional[str] = None
+    total_amount: Optional[float] = None
+    updated_at: Optional[str] = None
+    dropped: Optional[int] = None
+
+    @classmethod
+    def from_feed(cls, change: dict) -> "OrderChange":
+        return cls(**{name: change.get(name) for name in cls.__annotations__})
+
+# Одно соединение SSE с order-service на заказ или пользователя для всех подписчиков шлюза
+order_feed = OrderFeedHub(SERVICE_URLS["order"])
+
+@strawberry.type
+class Subscription:
+    @strawberry.subscription
+    async def order_updates(self, id: str) -> AsyncGenerator[OrderChange, None]:
+        """Изменения заказа: первым - текущее состояние; поток завершается при удалении заказа"""
+        async for change in order_feed.subscribe(f"/api/v1/orders/{id}/events"):
+            yield OrderChange.from_feed(change)
+
+    @strawberry.subscription
+    async def user_order_updates(self, user_id: str) -> AsyncGenerator[OrderChange, None]:
+        """Изменения всех заказов пользователя, включая новые"""
+        async for change in order_feed.subscribe(f"/api/v1/orders/user/{user_id}/events"):
+            yield OrderChange.from_feed(change)
+
 # Создаем GraphQL схему
-schema = strawberry.Schema(query=Query, mutation=Mutation)
+schema = strawberry.Schema(query=Query, mutation=Mutation, subscription=Subscription, extensions=[QueryTracing])
 
 # Создаем FastAPI приложение
 app = FastAPI(
@@ -407,6 +394,34 @@ app.add_middleware(
 graphql_app = GraphQLRouter(schema, graphiql=True)
 app.include_router(graphql_app, prefix="/graphql")
 
+Instrumentator().instrument(app).expose(app)
+
+@app.get("/circuit-breaker/status")
+async def circuit_breaker_status():
+    """Состояние breaker'ов вызовов к сервисам"""
+    breakers = breaker_status()
+    return {"circuit_breakers": breakers, "total": len(breakers)}
+
+@app.get("/tracing/slow-queries")
+async def tracing_slow_queries():
+    """Медленные запросы GraphQL по хешу текста запроса, самые медленные первыми"""
+    return {"threshold_ms": slow_log.threshold_ms, "queries": slow_log.snapshot()}
+
+@app.get("/subscriptions/status")
+async def subscriptions_status():
+    """Подписки на изменения заказов и соединения SSE с order-service"""
+    return order_feed.snapshot()
+
+@app.on_event("startup")
+async def on_startup():
+    setup_tracing()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await order_feed.close()
+    await http_client.aclose()
+    shutdown_tracing()
+
 # REST эндпоинт для проверки
 @app.get("/health")
 async def health_check():
@@ -425,7 +440,9 @@ async def root():
         "endpoints": {
             "graphql": "/graphql",
             "graphiql": "/graphql (интерактивная IDE)",
-            "health": "/health"
+            "health": "/health",
+            "circuit_breakers": "/circuit-breaker/status",
+            "slow_queries": "/tracing/slow-queries"
         },
         "integrated_services": list(SERVICE_URLS.keys())
     }
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""Подписки GraphQL на изменения заказов поверх SSE order-service.
+
+На каждый поток order-service (заказ или пользователь) шлюз держит одно
+соединение SSE, сколько бы GraphQL-подписчиков его ни слушали: изменения
+раздаются подписчикам через их очереди в памяти. Очередь подписчика
+ограничена ORDER_FEED_BUFFER; медленный подписчик теряет старые изменения,
+а не задерживает остальных, и получает событие lagged. Последний
+отписавшийся закрывает соединение.
+
+Разорванное или закрытое сервисом соединение восстанавливается с
+Last-Event-ID, поэтому поток заказа не присылает повторно уже отданное
+состояние. Поток завершается, только когда сервис отвечает 404 (заказ
+удален). Новый подписчик уже открытого потока сразу получает последние
+известные изменения (по одному на заказ), а не ждет следующего.
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Set
+
+import httpx
+
+ORDER_FEED_BUFFER = int(os.getenv("ORDER_FEED_BUFFER", "32"))
+ORDER_FEED_RECONNECT_MAX = float(os.getenv("ORDER_FEED_RECONNECT_MAX", "30"))
+
+
+class _Subscriber:
+    __slots__ = ("changes", "dropped", "ready", "ended")
+
+    def __init__(self):
+        self.changes: Deque[Dict[str, Any]] = deque()
+        self.dropped = 0
+        self.ready = asyncio.Event()
+        self.ended = False
+
+    def put(self, change: Dict[str, Any]):
+        if len(self.changes) >= ORDER_FEED_BUFFER:
+            self.changes.popleft()
+            self.dropped += 1
+        self.changes.append(change)
+        self.ready.set()
+
+    def end(self):
+        self.ended = True
+        self.ready.set()
+
+
+class _Topic:
+    __slots__ = ("subscribers", "task", "last_event_id", "latest")
+
+    def __init__(self):
+        self.subscribers: Set[_Subscriber] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.last_event_id: Optional[str] = None
+        # Последнее изменение каждого заказа потока - снимок для новых подписчиков
+        self.latest: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def remember(self, change: Dict[str, Any]):
+        order_id = change.get("id")
+        if order_id is None:
+            return
+        self.latest.pop(order_id, None)
+        self.latest[order_id] = change
+        if len(self.latest) > ORDER_FEED_BUFFER:
+            self.latest.popitem(last=False)
+
+
+class OrderFeedHub:
+    def __init__(self, base_url: str):
+        # Соединения SSE живут часами: отдельный клиент без лимита соединений и таймаута чтения
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(10.0, read=None),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=0)
+        )
+        self.topics: Dict[str, _Topic] = {}
+
+    async def close(self):
+        for topic in self.topics.values():
+            topic.task.cancel()
+        await self.client.aclose()
+
+    async def subscribe(self, path: str) -> AsyncIterator[Dict[str, Any]]:
+        """Изменения из потока SSE path; завершается, когда поток закрыт сервисом"""
+        topic = self.topics.get(path)
+        if topic is None:
+            topic = self.topics[path] = _Topic()
+            topic.task = asyncio.create_task(self._pump(path, topic))
+        subscriber = _Subscriber()
+        for change in topic.latest.values():
+            subscriber.put(change)
+        topic.subscribers.add(subscriber)
+        try:
+            while True:
+                await subscriber.ready.wait()
+                subscriber.ready.clear()
+                if subscriber.dropped:
+                    dropped, subscriber.dropped = subscriber.dropped, 0
+                    yield {"kind": "lagged", "dropped": dropped}
+                while subscriber.changes:
+                    yield subscriber.changes.popleft()
+                if subscriber.ended:
+                    return
+        finally:
+            topic.subscribers.discard(subscriber)
+            if not topic.subscribers and self.topics.get(path) is topic:
+                topic.task.cancel()
+                del self.topics[path]
+
+    def _end(self, path: str, topic: _Topic):
+        for subscriber in topic.subscribers:
+            subscriber.end()
+        if self.topics.get(path) is topic:
+            del self.topics[path]
+
+    async def _pump(self, path: str, topic: _Topic):
+        delay = 1.0
+        while True:
+            headers = {"Last-Event-ID": topic.last_event_id} if topic.last_event_id else {}
+            try:
+                async with self.client.stream("GET", path, headers=headers) as response:
+                    if response.status_code == 404:
+                        self._end(path, topic)
+                        return
+                    response.raise_for_status()
+                    delay = 1.0
+                    event, data = None, None
+                    async for line in response.aiter_lines():
+                        if line.startswith("id:"):
+                            topic.last_event_id = line[3:].strip()
+                        elif line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data = line[5:].strip()
+                        elif not line:
+                            # Пустая строка завершает событие; без data это heartbeat или retry
+                            if event and data:
+                                change = json.loads(data)
+                                if event == "lagged":
+                                    change["kind"] = "lagged"
+                                else:
+                                    topic.remember(change)
+                                for subscriber in topic.subscribers:
+                                    subscriber.put(change)
+                            event, data = None, None
+                # Поток закрыт сервисом (перезапуск, балансировщик или удаление
+                # заказа): переподключаемся, удаленный заказ ответит 404
+                print(f"Order feed {path} closed by upstream, reconnecting")
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"Order feed {path} disconnected: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, ORDER_FEED_RECONNECT_MAX)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "upstream_streams": len(self.topics),
+            "subscribers": sum(len(topic.subscribers) for topic in self.topics.values())
+        }
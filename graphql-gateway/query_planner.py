@@ -0,0 +1,93 @@
+"""Планировщик запросов шлюза: в сервисы уходят только поля, выбранные в запросе.
+
+Раньше резолверы Query.order, user_orders и products забирали документы
+целиком и собирали из них все поля типа, даже если клиент спросил
+{ order(id: ...) { status } }. QueryPlanner проходит по выбору полей
+резолвера (info.selected_fields, с фрагментами) и строит для сервиса
+параметр fields: поля типа с тем же именем в сервисе, вложенные типы -
+через точку (items.name), а поля с резолвером - то, что им нужно из
+документа (requires: Order.address читает shipping_address). Сервис
+отдает только эти поля (разреженный набор полей, shared/fieldsets.py).
+
+build собирает объект Strawberry из неполного документа: поля, которых
+нет в ответе, равны None. GraphQL не обращается к невыбранным полям,
+поэтому None в обязательном поле клиент не увидит.
+"""
+import dataclasses
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from strawberry.types import Info
+from strawberry.types.nodes import FragmentSpread, InlineFragment, SelectedField
+
+
+def _object_type(type_: Any) -> Optional[type]:
+    """Тип Strawberry внутри List[...] / Optional[...]; None - скаляр"""
+    while hasattr(type_, "of_type"):
+        type_ = type_.of_type
+    return type_ if hasattr(type_, "__strawberry_definition__") else None
+
+
+def _selections(selections: Iterable[Any]) -> Iterable[SelectedField]:
+    for selection in selections:
+        if isinstance(selection, (FragmentSpread, InlineFragment)):
+            yield from _selections(selection.selections)
+        elif isinstance(selection, SelectedField):
+            yield selection
+
+
+class QueryPlanner:
+    def __init__(self, requires: Optional[Mapping[type, Mapping[str, Tuple[str, ...]]]] = None):
+        # {тип: {поле с резолвером: поля документа, которые ему нужны}}
+        self.requires = requires or {}
+        self._names: Dict[Tuple[int, type], Dict[str, Any]] = {}
+
+    def _fields_by_name(self, info: Info, type_: type) -> Dict[str, Any]:
+        key = (id(info.schema), type_)
+        names = self._names.get(key)
+        if names is None:
+            converter = info.schema.config.name_converter
+            names = self._names[key] = {
+                converter.get_graphql_name(field): field for field in type_.__strawberry_definition__.fields
+            }
+        return names
+
+    def _paths(self, info: Info, type_: type, selections: Iterable[Any], prefix: str) -> List[str]:
+        fields = self._fields_by_name(info, type_)
+        requires = self.requires.get(type_, {})
+        paths: List[str] = []
+        for selection in _selections(selections):
+            field = fields.get(selection.name)
+            if field is None:
+                # __typename и прочие служебные поля
+                continue
+            if field.base_resolver is not None:
+                paths += [prefix + name for name in requires.get(field.python_name, ())]
+                continue
+            nested = _object_type(field.type)
+            if nested is not None and selection.selections:
+                paths += self._paths(info, nested, selection.selections, f"{prefix}{field.python_name}.")
+            else:
+                paths.append(prefix + field.python_name)
+        return paths
+
+    def fields(self, info: Info, type_: type) -> str:
+        """Значение параметра fields для ответа резолвера типа type_ (или списка type_)"""
+        paths = self._paths(info, type_, info.selected_fields[0].selections, "")
+        # Пустой выбор (только __typename) - хоть одно поле, чтобы не получить документ целиком
+        return ",".join(dict.fromkeys(paths)) or "id"
+
+
+def build(type_: type, data: Dict[str, Any]) -> Any:
+    """Объект Strawberry из документа сервиса, в том числе неполного"""
+    nested = {field.python_name: _object_type(field.type)
+              for field in type_.__strawberry_definition__.fields if field.base_resolver is None}
+    values = {}
+    for field in dataclasses.fields(type_):
+        if not field.init:
+            continue
+        value = data.get(field.name)
+        inner = nested.get(field.name)
+        if inner is not None and value is not None:
+            value = [build(inner, item) for item in value] if isinstance(value, list) else build(inner, value)
+        values[field.name] = value
+    return type_(**values)
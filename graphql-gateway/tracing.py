@@ -0,0 +1,278 @@
+"""Трассировка запросов GraphQL: какие резолверы и вызовы сервисов тратят время.
+
+QueryTracing - расширение схемы Strawberry. На каждый запрос оно:
+  * измеряет каждый резолвер со своим кодом (поля, которые просто читают
+    атрибут объекта, не измеряются) - гистограмма
+    graphql_field_duration_seconds{type, field};
+  * считает вызовы сервисов за запрос (upstream_call в call_service) -
+    гистограмма graphql_upstream_calls_per_query{service}: N+1 вида
+    OrderItem.product видно как десятки вызовов catalog на запрос;
+  * пишет span OpenTelemetry на операцию, на резолвер и на вызов сервиса
+    (traceparent передается сервису) и отправляет их по OTLP в Jaeger;
+  * медленные запросы (дольше GRAPHQL_SLOW_QUERY_MS) попадают в журнал и
+    в сводку по хешу текста запроса; в журнал пишется не больше одной строки
+    на хеш за GRAPHQL_SLOW_QUERY_LOG_INTERVAL секунд, остальные только
+    считаются;
+  * по заголовку X-GraphQL-Tracing: 1 (если GRAPHQL_TRACING_PAYLOAD не
+    выключен) возвращает тайминги резолверов и вызовы сервисов в
+    extensions.tracing ответа.
+
+Хеш запроса (sha256 текста, 16 символов) есть в span, в журнале и в
+extensions.tracing, поэтому медленный запрос из журнала находится в Jaeger.
+
+OpenTelemetry необязателен: без пакетов opentelemetry метрики, журнал и
+extensions.tracing работают, span не пишутся. Экспорт настраивается
+стандартными переменными OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME,
+OTEL_TRACES_SAMPLER.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import Counter as Counts, OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from graphql import GraphQLResolveInfo
+from prometheus_client import Counter, Histogram
+from strawberry.extensions import SchemaExtension
+from strawberry.extensions.tracing.utils import should_skip_tracing
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.propagate import inject
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:
+    trace = None
+
+GRAPHQL_SLOW_QUERY_MS = float(os.getenv("GRAPHQL_SLOW_QUERY_MS", "500"))
+GRAPHQL_SLOW_QUERY_LOG_INTERVAL = float(os.getenv("GRAPHQL_SLOW_QUERY_LOG_INTERVAL", "60"))
+GRAPHQL_SLOW_QUERY_KEEP = int(os.getenv("GRAPHQL_SLOW_QUERY_KEEP", "200"))
+GRAPHQL_TRACING_PAYLOAD = os.getenv("GRAPHQL_TRACING_PAYLOAD", "on") == "on"
+TRACING_HEADER = "x-graphql-tracing"
+
+query_duration = Histogram("graphql_query_duration_seconds", "GraphQL operation duration", ["operation"])
+field_duration = Histogram("graphql_field_duration_seconds", "Resolver duration", ["type", "field"],
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+field_errors = Counter("graphql_field_errors_total", "Resolver errors, raised or caught and reported", ["type", "field"])
+upstream_calls = Counter("graphql_upstream_calls_total", "Calls from resolvers to services", ["service", "outcome"])
+upstream_per_query = Histogram("graphql_upstream_calls_per_query", "Service calls made by one GraphQL operation",
+                               ["service"], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+slow_queries = Counter("graphql_slow_queries_total", "Operations slower than GRAPHQL_SLOW_QUERY_MS")
+
+_tracer = None
+
+
+def setup_tracing():
+    """Экспорт span в OTLP-коллектор (Jaeger); без opentelemetry - ничего не делает"""
+    global _tracer
+    if trace is None:
+        print("opentelemetry is not installed: GraphQL spans are not exported")
+        return
+    # Адрес коллектора экспортер берет из OTEL_EXPORTER_OTLP_ENDPOINT, сэмплер - из OTEL_TRACES_SAMPLER
+    provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "graphql-gateway")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("graphql-gateway")
+
+
+def shutdown_tracing():
+    if _tracer is not None:
+        trace.get_tracer_provider().shutdown()
+
+
+def _span(name: str, client: bool = False, **attributes) -> Any:
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, kind=SpanKind.CLIENT if client else SpanKind.INTERNAL,
+                                         attributes=attributes)
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()[:16]
+
+
+class QueryTrace:
+    __slots__ = ("hash", "started", "duration", "upstream", "resolvers", "errors")
+
+    def __init__(self, query: str):
+        self.hash = query_hash(query)
+        self.started = time.perf_counter_ns()
+        self.duration: Optional[int] = None
+        self.upstream: Counts = Counts()
+        self.resolvers: List[Dict[str, Any]] = []
+        self.errors = 0
+
+
+_current: ContextVar[Optional[QueryTrace]] = ContextVar("graphql_query_trace", default=None)
+# Резолвер, который сейчас выполняется: (тип, поле)
+_field: ContextVar[Optional[tuple]] = ContextVar("graphql_field", default=None)
+
+
+@contextmanager
+def upstream_call(service: str, method: str, path: str, headers: Dict[str, str]) -> Iterator[None]:
+    """Учесть вызов сервиса в текущем запросе; headers дополняются traceparent"""
+    query = _current.get()
+    if query is not None:
+        query.upstream[service] += 1
+    with _span(f"{method} {service}", client=True,
+               **{"peer.service": service, "http.method": method, "http.target": path}) as span:
+        if span is not None:
+            inject(headers)
+        try:
+            yield
+        except Exception as e:
+            upstream_calls.labels(service, "error").inc()
+            if span is not None:
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR, str(e)))
+            raise
+        upstream_calls.labels(service, "ok").inc()
+
+
+def report_error(message: str, error: Exception):
+    """Ошибка, которую резолвер перехватил и заменил пустым результатом: в журнал, метрику и span"""
+    print(f"{message}: {error!r}")
+    query = _current.get()
+    if query is not None:
+        query.errors += 1
+    field = _field.get()
+    if field is not None:
+        field_errors.labels(*field).inc()
+    if _tracer is not None:
+        span = trace.get_current_span()
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, message))
+
+
+class SlowQueryLog:
+    """Сводка медленных запросов по хешу; журнал - не чаще раза в interval секунд на хеш"""
+
+    def __init__(self, threshold_ms: float = GRAPHQL_SLOW_QUERY_MS,
+                 interval: float = GRAPHQL_SLOW_QUERY_LOG_INTERVAL, keep: int = GRAPHQL_SLOW_QUERY_KEEP):
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.keep = keep
+        self.queries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def record(self, query: QueryTrace, text: str, operation: Optional[str], duration_ms: float,
+               trace_id: Optional[str]):
+        if duration_ms < self.threshold_ms:
+            return
+        slow_queries.inc()
+        entry = self.queries.pop(query.hash, None)
+        if entry is None:
+            entry = {"hash": query.hash, "operation": operation, "query": text[:2000],
+                     "count": 0, "max_ms": 0.0, "logged_at": 0.0}
+            if len(self.queries) >= self.keep:
+                self.queries.popitem(last=False)
+        self.queries[query.hash] = entry
+        entry["count"] += 1
+        entry["max_ms"] = max(entry["max_ms"], duration_ms)
+        entry["last_ms"] = duration_ms
+        entry["last_upstream"] = dict(query.upstream)
+        entry["last_trace_id"] = trace_id
+        now = time.time()
+        if now - entry["logged_at"] >= self.interval:
+            entry["logged_at"] = now
+            slowest = sorted(query.resolvers, key=lambda r: r["duration"], reverse=True)[:5]
+            print("Slow GraphQL query " + json.dumps({
+                "hash": query.hash, "operation": operation, "duration_ms": round(duration_ms, 1),
+                "upstream": dict(query.upstream), "trace_id": trace_id, "slow_count": entry["count"],
+                "slowest": [{"path": r["path"], "ms": round(r["duration"] / 1e6, 1)} for r in slowest],
+                "query": " ".join(text.split())[:500]
+            }, ensure_ascii=False))
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return sorted(({k: v for k, v in e.items() if k != "logged_at"} for e in self.queries.values()),
+                      key=lambda e: e["max_ms"], reverse=True)
+
+
+slow_log = SlowQueryLog()
+
+
+def _path(info: GraphQLResolveInfo) -> str:
+    return ".".join(str(key) for key in info.path.as_list())
+
+
+class QueryTracing(SchemaExtension):
+    def _payload_requested(self) -> bool:
+        if not GRAPHQL_TRACING_PAYLOAD:
+            return False
+        context = self.execution_context.context
+        request = context.get("request") if isinstance(context, dict) else None
+        return request is not None and request.headers.get(TRACING_HEADER) == "1"
+
+    def on_operation(self):
+        text = self.execution_context.query or ""
+        self.query = QueryTrace(text)
+        token = _current.set(self.query)
+        self.trace_id = None
+        with _span("graphql.operation", **{"graphql.query.hash": self.query.hash}) as span:
+            if span is not None:
+                self.trace_id = format(span.get_span_context().trace_id, "032x")
+            yield
+            operation_type = self.execution_context.operation_type
+            operation = operation_type.value if operation_type else "unknown"
+            name = self.execution_context.operation_name
+            if span is not None:
+                span.update_name(f"graphql.{operation} {name}" if name else f"graphql.{operation}")
+                span.set_attribute("graphql.operation.type", operation)
+                if name:
+                    span.set_attribute("graphql.operation.name", name)
+                for service, calls in self.query.upstream.items():
+                    span.set_attribute(f"graphql.upstream.{service}.calls", calls)
+        _current.reset(token)
+        self.query.duration = time.perf_counter_ns() - self.query.started
+        query_duration.labels(operation).observe(self.query.duration / 1e9)
+        for service, calls in self.query.upstream.items():
+            upstream_per_query.labels(service).observe(calls)
+        slow_log.record(self.query, text, name, self.query.duration / 1e6, self.trace_id)
+
+    async def resolve(self, _next: Callable, root: Any, info: GraphQLResolveInfo, *args, **kwargs) -> Any:
+        if should_skip_tracing(_next, info):
+            result = _next(root, info, *args, **kwargs)
+            if hasattr(result, "__await__"):
+                result = await result
+            return result
+
+        parent, field = info.parent_type.name, info.field_name
+        path = _path(info)
+        started = time.perf_counter_ns()
+        token = _field.set((parent, field))
+        with _span(f"{parent}.{field}", **{"graphql.field.path": path}):
+            try:
+                result = _next(root, info, *args, **kwargs)
+                if hasattr(result, "__await__"):
+                    result = await result
+                return result
+            except Exception:
+                field_errors.labels(parent, field).inc()
+                raise
+            finally:
+                _field.reset(token)
+                elapsed = time.perf_counter_ns() - started
+                field_duration.labels(parent, field).observe(elapsed / 1e9)
+                query = _current.get()
+                if query is not None:
+                    query.resolvers.append({
+                        "path": path, "parentType": parent, "fieldName": field,
+                        "startOffset": started - query.started, "duration": elapsed
+                    })
+
+    def get_results(self) -> Dict[str, Any]:
+        if not self._payload_requested():
+            return {}
+        return {"tracing": {
+            "queryHash": self.query.hash,
+            "traceId": self.trace_id,
+            "duration": self.query.duration or time.perf_counter_ns() - self.query.started,
+            "upstream": dict(self.query.upstream),
+            "errors": self.query.errors,
+            "resolvers": self.query.resolvers
+        }}
@@ -0,0 +1,282 @@
+"""Конвейер отправки уведомлений.
+
+Событие превращается в уведомления по правилам из templates.py, каждое
+уходит в очередь своего канала. Воркеры канала собирают пачки, ждут
+токенов у ограничителя скорости (квота провайдера) и отправляют пачку
+одним вызовом. Неудачные уведомления попадают в очередь повторов с
+экспоненциальной задержкой и возвращаются в очередь канала, когда
+подойдет их время.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from models import Notification
+from templates import NOTIFICATION_RULES, NotificationTemplate
+
+NOTIFICATIONS_TOTAL = Counter(
+    "notifications_total", "Уведомления по каналу и результату", ["channel", "outcome"]
+)
+NOTIFICATION_LAG = Histogram(
+    "notification_lag_seconds", "Время от события до доставки", ["channel"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+)
+NOTIFICATION_BATCH_SIZE = Histogram(
+    "notification_batch_size", "Размер отправляемой пачки", ["channel"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500)
+)
+NOTIFICATION_QUEUE_DEPTH = Gauge(
+    "notification_queue_depth", "Уведомления в очереди канала", ["channel", "queue"]
+)
+
+
+def _env(channel: str, name: str, default: str) -> str:
+    return os.getenv(f"NOTIFY_{channel.upper()}_{name}", default)
+
+
+class TokenBucket:
+    """Не больше rate токенов в секунду со всплеском до burst"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        # Ожидающие обслуживаются по очереди, иначе большие пачки голодают
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class ChannelDispatcher:
+    """Очередь, пул воркеров, ограничение скорости и повторы одного канала"""
+
+    def __init__(
+        self,
+        name: str,
+        sender,
+        rate: float,
+        burst: Optional[float] = None,
+        workers: int = 4,
+        batch_size: int = 50,
+        batch_wait: float = 0.01,
+        max_attempts: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 60.0,
+        queue_size: int = 100000
+    ):
+        self.name = name
+        self.sender = sender
+        self.limiter = TokenBucket(rate, burst)
+        self.workers = workers
+        # Пачка больше всплеска ограничителя превысила бы квоту провайдера
+        self.batch_size = max(1, min(batch_size, int(self.limiter.capacity)))
+        self.batch_wait = batch_wait
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # (время повтора, порядковый номер, уведомление)
+        self._retries: List[Tuple[float, int, Notification]] = []
+        self._retry_seq = itertools.count()
+        self._retry_wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.started_at = time.monotonic()
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "dead": 0, "batches": 0}
+        self.lag_ewma = 0.0
+        # Дочерние метрики создаются один раз: labels() на каждое уведомление заметно на 10k/s
+        self._sent_metric = NOTIFICATIONS_TOTAL.labels(name, "sent")
+        self._lag_metric = NOTIFICATION_LAG.labels(name)
+        self._batch_metric = NOTIFICATION_BATCH_SIZE.labels(name)
+
+    @classmethod
+    def from_env(cls, name: str, sender) -> "ChannelDispatcher":
+        """Настройки канала из NOTIFY_<CHANNEL>_RATE, _BURST, _WORKERS, _BATCH_SIZE, _MAX_ATTEMPTS"""
+        return cls(
+            name,
+            sender,
+            rate=float(_env(name, "RATE", "1000")),
+            burst=float(_env(name, "BURST", "0")) or None,
+            workers=int(_env(name, "WORKERS", "4")),
+            batch_size=int(_env(name, "BATCH_SIZE", "50")),
+            max_attempts=int(_env(name, "MAX_ATTEMPTS", "5"))
+        )
+
+    def start(self):
+        if not self._tasks:
+            self.started_at = time.monotonic()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._retry_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.sender.close()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def retry_depth(self) -> int:
+        return len(self._retries)
+
+    async def submit(self, notification: Notification):
+        # Полная очередь приостанавливает потребителя событий - обратное давление до брокера
+        await self._queue.put(notification)
+
+    async def _next_batch(self) -> List[Notification]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            await self.limiter.acquire(len(batch))
+            try:
+                errors = await self.sender.send_batch(batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+
+            now = time.time()
+            sent = 0
+            for notification, error in zip(batch, errors):
+                if error is None:
+                    lag = now - notification.created_at
+                    self.lag_ewma = self.lag_ewma * 0.99 + lag * 0.01 if self.stats["sent"] else lag
+                    self._lag_metric.observe(lag)
+                    sent += 1
+                else:
+                    self._fail(notification, error)
+            self.stats["sent"] += sent
+            self.stats["batches"] += 1
+            self._sent_metric.inc(sent)
+            self._batch_metric.observe(len(batch))
+            NOTIFICATION_QUEUE_DEPTH.labels(self.name, "main").set(self._queue.qsize())
+
+    def _fail(self, notification: Notification, error: Exception):
+        notification.attempts += 1
+        self.stats["failed"] += 1
+        NOTIFICATIONS_TOTAL.labels(self.name, "failed").inc()
+        if notification.attempts >= self.max_attempts:
+            self.stats["dead"] += 1
+            NOTIFICATIONS_TOTAL.labels(self.name, "dead").inc()
+            print(f"[{self.name}] giving up on {notification.id} to {notification.recipient}: {error}")
+            return
+
+        # "Full jitter": равномерно от 0 до экспоненциальной границы
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** notification.attempts))
+        heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_seq), notification))
+        self.stats["retried"] += 1
+        NOTIFICATIONS_TOTAL.labels(self.name, "retried").inc()
+        NOTIFICATION_QUEUE_DEPTH.labels(self.name, "retry").set(len(self._retries))
+        self._retry_wakeup.set()
+
+    async def _retry_loop(self):
+        while True:
+            if not self._retries:
+                self._retry_wakeup.clear()
+                await self._retry_wakeup.wait()
+                continue
+            due_at = self._retries[0][0]
+            delay = due_at - time.monotonic()
+            if delay > 0:
+                self._retry_wakeup.clear()
+                try:
+                    # Просыпаемся раньше, если появился повтор с меньшей задержкой
+                    await asyncio.wait_for(self._retry_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, notification = heapq.heappop(self._retries)
+            NOTIFICATION_QUEUE_DEPTH.labels(self.name, "retry").set(len(self._retries))
+            await self._queue.put(notification)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth,
+            "retry_depth": self.retry_depth,
+            "throughput_per_sec": round(self.stats["sent"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "lag_ms": round(self.lag_ewma * 1000, 1),
+            "rate_limit": self.limiter.rate,
+            "workers": self.workers,
+            "batch_size": self.batch_size
+        }
+
+
+class NotificationDispatcher:
+    """Рендер уведомлений по правилам и раздача по каналам"""
+
+    def __init__(
+        self,
+        channels: Dict[str, ChannelDispatcher],
+        rules: Dict[str, List[NotificationTemplate]] = NOTIFICATION_RULES
+    ):
+        self.channels = channels
+        self.rules = rules
+        self.skipped = 0
+
+    def start(self):
+        for channel in self.channels.values():
+            channel.start()
+
+    async def stop(self):
+        await asyncio.gather(*[channel.stop() for channel in self.channels.values()])
+
+    async def dispatch(self, event_type: str, payload: Dict[str, Any], created_at: Optional[float] = None) -> int:
+        """Поставить уведомления по событию в очереди каналов; возвращает их количество"""
+        created_at = created_at or time.time()
+        count = 0
+        for template in self.rules.get(event_type, ()):
+            channel = self.channels.get(template.channel.value)
+            if channel is None:
+                continue
+            notification = template.render(event_type, payload, created_at)
+            if notification is None:
+                self.skipped += 1
+                continue
+            await channel.submit(notification)
+            count += 1
+        return count
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "channels": {name: channel.snapshot() for name, channel in self.channels.items()},
+            "skipped_no_recipient": self.skipped
+        }
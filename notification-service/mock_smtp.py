@@ -0,0 +1,85 @@
+"""Минимальный SMTP-сервер для локальной проверки канала email.
+
+Принимает письма и только считает их (или дописывает в файл с --save).
+Запуск:
+    python mock_smtp.py --port 1025
+    NOTIFY_EMAIL_SENDER=smtp SMTP_HOST=localhost SMTP_PORT=1025 uvicorn app:app --port 5006
+"""
+import argparse
+import asyncio
+import time
+from typing import Optional
+
+received = 0
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, save: Optional[str], latency: float):
+    global received
+
+    async def reply(line: str):
+        writer.write(line.encode() + b"\r\n")
+        await writer.drain()
+
+    await reply("220 mock-smtp ready")
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                await reply("250 mock-smtp")
+            elif command.startswith(("MAIL FROM", "RCPT TO", "RSET", "NOOP")):
+                await reply("250 OK")
+            elif command == "DATA":
+                await reply("354 End data with <CR><LF>.<CR><LF>")
+                data = bytearray()
+                while True:
+                    chunk = await reader.readline()
+                    if not chunk or chunk == b".\r\n":
+                        break
+                    data += chunk
+                if latency:
+                    await asyncio.sleep(latency)
+                received += 1
+                if save:
+                    with open(save, "ab") as f:
+                        f.write(bytes(data) + b"\n")
+                await reply("250 OK queued")
+            elif command == "QUIT":
+                await reply("221 Bye")
+                break
+            else:
+                await reply("502 Command not implemented")
+    finally:
+        writer.close()
+
+
+async def report():
+    last, last_at = 0, time.monotonic()
+    while True:
+        await asyncio.sleep(5)
+        now = time.monotonic()
+        print(f"received: {received} ({(received - last) / (now - last_at):.0f}/s)")
+        last, last_at = received, now
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--save", default=None, help="файл для сохранения писем")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка на письмо")
+    args = parser.parse_args()
+
+    server = await asyncio.start_server(
+        lambda r, w: handle(r, w, args.save, args.latency_ms / 1000), args.host, args.port
+    )
+    print(f"Mock SMTP listening on {args.host}:{args.port}")
+    asyncio.create_task(report())
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
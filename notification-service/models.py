@@ -0,0 +1,27 @@
+from dataclasses import dataclass, field, asdict
+from enum import Enum
+from typing import Optional
+import time
+import uuid
+
+
+class Channel(str, Enum):
+    EMAIL = "email"
+    SMS = "sms"
+    WEBHOOK = "webhook"
+
+
+@dataclass
+class Notification:
+    channel: str
+    recipient: str
+    body: str
+    event_type: str
+    subject: Optional[str] = None
+    # Время события: от него считается задержка доставки
+    created_at: float = field(default_factory=time.time)
+    attempts: int = 0
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
@@ -0,0 +1,148 @@
+"""Отправщики уведомлений.
+
+Каждый отправщик принимает пачку уведомлений одного канала и возвращает
+список ошибок той же длины (None - доставлено). Ошибка отдельного
+уведомления уходит в очередь повторов, исключение из send_batch считается
+ошибкой всей пачки.
+"""
+import asyncio
+import json
+import os
+import random
+import smtplib
+from email.message import EmailMessage
+from typing import List, Optional
+
+import httpx
+
+from models import Notification
+
+
+class SendError(Exception):
+    pass
+
+
+class FileSender:
+    """Дописывает уведомления JSON-строками в файл (локальная замена провайдера)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    async def send_batch(self, batch: List[Notification]) -> List[Optional[Exception]]:
+        lines = "".join(json.dumps(n.to_dict(), ensure_ascii=False) + "\n" for n in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+        return [None] * len(batch)
+
+    def _write(self, data: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    async def close(self):
+        pass
+
+
+class SMTPSender:
+    """Письма через SMTP: одно соединение на пачку, отправка в отдельном потоке"""
+
+    def __init__(self, host: str, port: int, sender: str, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+
+    async def send_batch(self, batch: List[Notification]) -> List[Optional[Exception]]:
+        return await asyncio.get_running_loop().run_in_executor(None, self._send, batch)
+
+    def _send(self, batch: List[Notification]) -> List[Optional[Exception]]:
+        errors: List[Optional[Exception]] = []
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            for notification in batch:
+                message = EmailMessage()
+                message["From"] = self.sender
+                message["To"] = notification.recipient
+                message["Subject"] = notification.subject or ""
+                message.set_content(notification.body)
+                try:
+                    smtp.send_message(message)
+                    errors.append(None)
+                except smtplib.SMTPRecipientsRefused as e:
+                    errors.append(SendError(str(e)))
+        return errors
+
+    async def close(self):
+        pass
+
+
+class WebhookSender:
+    """POST уведомлений на URL подписчика; пачка уходит параллельно по общему пулу соединений"""
+
+    def __init__(self, timeout: float = 5.0, max_connections: int = 50):
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def send_batch(self, batch: List[Notification]) -> List[Optional[Exception]]:
+        results = await asyncio.gather(*[self._send(n) for n in batch], return_exceptions=True)
+        return [r if isinstance(r, Exception) else None for r in results]
+
+    async def _send(self, notification: Notification):
+        response = await self.client.post(
+            notification.recipient,
+            content=notification.body,
+            headers={
+                "Content-Type": "application/json",
+                "X-Notification-Id": notification.id,
+                "X-Event-Type": notification.event_type
+            }
+        )
+        if response.status_code >= 400:
+            raise SendError(f"Webhook {notification.recipient} returned {response.status_code}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class MockSender:
+    """Провайдер-заглушка с задержкой на пачку и долей ошибок (SMS, бенчмарк)"""
+
+    def __init__(self, latency_ms: float = 0.0, failure_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.delivered = 0
+
+    async def send_batch(self, batch: List[Notification]) -> List[Optional[Exception]]:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms * random.uniform(0.5, 1.5) / 1000)
+        errors: List[Optional[Exception]] = []
+        for _ in batch:
+            if self.failure_rate and random.random() < self.failure_rate:
+                errors.append(SendError("Simulated provider failure"))
+            else:
+                self.delivered += 1
+                errors.append(None)
+        return errors
+
+    async def close(self):
+        pass
+
+
+def sender_from_env(channel: str):
+    """Отправщик канала по NOTIFY_<CHANNEL>_SENDER: file, smtp (email), http (webhook) или mock"""
+    prefix = f"NOTIFY_{channel.upper()}"
+    kind = os.getenv(f"{prefix}_SENDER", "file")
+    if kind == "smtp":
+        return SMTPSender(
+            host=os.getenv("SMTP_HOST", "localhost"),
+            port=int(os.getenv("SMTP_PORT", "1025")),
+            sender=os.getenv("SMTP_FROM", "noreply@shop.local")
+        )
+    if kind == "http":
+        return WebhookSender()
+    if kind == "mock":
+        return MockSender(
+            latency_ms=float(os.getenv(f"{prefix}_LATENCY_MS", "0")),
+            failure_rate=float(os.getenv(f"{prefix}_FAILURE_RATE", "0"))
+        )
+    return FileSender(os.path.join(os.getenv("NOTIFY_OUTBOX_DIR", "outbox"), f"{channel}.jsonl"))
@@ -0,0 +1,86 @@
+"""Шаблоны уведомлений и правила: какое событие в какие каналы уходит."""
+import json
+import os
+from string import Template
+from typing import Any, Dict, List, Optional
+
+from models import Channel, Notification
+
+# URL подписчика для канала webhook; без него канал не используется
+NOTIFY_WEBHOOK_URL = os.getenv("NOTIFY_WEBHOOK_URL", "")
+
+
+class NotificationTemplate:
+    def __init__(self, channel: Channel, body: str, subject: Optional[str] = None):
+        self.channel = channel
+        # Шаблоны разбираются один раз при загрузке модуля
+        self.body = Template(body) if body else None
+        self.subject = Template(subject) if subject else None
+
+    def recipient(self, payload: Dict[str, Any]) -> Optional[str]:
+        if self.channel == Channel.EMAIL:
+            if payload.get("email"):
+                return payload["email"]
+            return f"user-{payload['user_id']}@shop.local" if payload.get("user_id") else None
+        if self.channel == Channel.SMS:
+            return payload.get("phone")
+        return NOTIFY_WEBHOOK_URL or None
+
+    def render(self, event_type: str, payload: Dict[str, Any], created_at: float) -> Optional[Notification]:
+        """Уведомление по событию; None - получателя нет"""
+        recipient = self.recipient(payload)
+        if recipient is None:
+            return None
+        if self.body is None:
+            # Webhook получает событие целиком
+            body = json.dumps({"event": event_type, "payload": payload}, ensure_ascii=False)
+        else:
+            body = self.body.safe_substitute(payload)
+        return Notification(
+            channel=self.channel.value,
+            recipient=recipient,
+            body=body,
+            subject=self.subject.safe_substitute(payload) if self.subject else None,
+            event_type=event_type,
+            created_at=created_at
+        )
+
+
+NOTIFICATION_RULES: Dict[str, List[NotificationTemplate]] = {
+    "order.created": [
+        NotificationTemplate(
+            Channel.EMAIL,
+            subject="Заказ $order_id оформлен",
+            body="Ваш заказ $order_id на сумму $total_amount принят и ожидает оплаты."
+        ),
+        NotificationTemplate(Channel.WEBHOOK, body=""),
+    ],
+    "order.cancelled": [
+        NotificationTemplate(Channel.WEBHOOK, body=""),
+    ],
+    "payment.succeeded": [
+        NotificationTemplate(
+            Channel.EMAIL,
+            subject="Заказ $order_id оплачен",
+            body="Оплата $amount $currency по заказу $order_id прошла успешно."
+        ),
+        NotificationTemplate(Channel.SMS, body="Заказ $order_id оплачен: $amount $currency"),
+        NotificationTemplate(Channel.WEBHOOK, body=""),
+    ],
+    "payment.failed": [
+        NotificationTemplate(
+            Channel.EMAIL,
+            subject="Не удалось оплатить заказ $order_id",
+            body="Платеж по заказу $order_id не прошел: $reason. Заказ отменен."
+        ),
+        NotificationTemplate(Channel.SMS, body="Оплата заказа $order_id не прошла"),
+    ],
+    "payment.refunded": [
+        NotificationTemplate(
+            Channel.EMAIL,
+            subject="Возврат по заказу $order_id",
+            body="Мы вернули $amount $currency по заказу $order_id."
+        ),
+        NotificationTemplate(Channel.WEBHOOK, body=""),
+    ],
+}
@@ -0,0 +1,433 @@
+"""Аналитика продаж по времени, категориям и способам оплаты.
+
+Данные поступают из событий order.created и payment.* (отдельная очередь
+order-service.analytics) и хранятся колонками в массивах NumPy по корзинам
+времени. Каждый уровень разрешения - кольцо корзин:
+    amounts[slot, категория, способ оплаты, метрика] - суммы (минимальные единицы) и штуки
+    counts[slot, способ оплаты, метрика]             - счетчики заказов
+Счетчики заказов не делятся по категориям: заказ с товарами нескольких
+категорий иначе посчитался бы несколько раз.
+
+Уровни задаются ANALYTICS_RESOLUTIONS ("ширина корзины в секундах:число
+корзин", от мелкого к крупному). Корзины старше окна уровня сворачиваются
+в корзины следующего уровня (compact), так что недавние данные доступны
+поминутно, а старые - по часам и дням при постоянном объеме памяти.
+
+Запросы (диапазон времени, шаг, группировка) выбирают корзины маской и
+сводят их векторными суммами по нужным осям. Корзина попадает в диапазон,
+если в нем лежит ее начало, поэтому границы округляются до корзин
+уровня, на котором лежат данные.
+
+Выручка по категориям: оплата делится между категориями заказа
+пропорционально сумме строк; состав заказа берется из order.created
+(последние ANALYTICS_PENDING_ORDERS заказов). Оплата заказа, о котором
+ничего не известно, учитывается в категории и способе оплаты "unknown".
+
+Суммы ведутся в одной валюте - валюте каталога (CATALOG_CURRENCY): заказ
+берется из total_minor события, оплаты и возвраты переводятся в
+минимальные единицы по своей валюте. Суммы в других валютах не
+складываются с ними (счетчики заказов и оплат учитываются), а считаются
+в stats["other_currency"].
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from prometheus_client import Counter
+
+from product_cache import CATALOG_CURRENCY
+from shared.messaging import Event, EventConsumer
+from shared.money import allocate, from_minor, to_minor
+
+ANALYTICS_RESOLUTIONS = os.getenv("ANALYTICS_RESOLUTIONS", "60:1440,3600:2160,86400:1830")
+ANALYTICS_PENDING_ORDERS = int(os.getenv("ANALYTICS_PENDING_ORDERS", "200000"))
+ANALYTICS_DEDUP_SIZE = int(os.getenv("ANALYTICS_DEDUP_SIZE", "100000"))
+ANALYTICS_COMPACT_INTERVAL = float(os.getenv("ANALYTICS_COMPACT_INTERVAL", "60"))
+ANALYTICS_SNAPSHOT = os.getenv("ANALYTICS_SNAPSHOT", "data/analytics.npz")
+
+UNKNOWN = "unknown"
+DEFAULT_CATEGORY = "other"
+
+# Колонки amounts
+ORDERED, ITEMS, REVENUE, REFUNDED = range(4)
+AMOUNT_METRICS = ("ordered_amount", "items", "revenue", "refunded_amount")
+# Колонки counts
+CREATED, PAID, FAILED = range(3)
+COUNT_METRICS = ("orders", "paid_orders", "failed_payments")
+# Метрики в минимальных единицах CATALOG_CURRENCY; остальные - штуки
+MONEY = {"ordered_amount", "revenue", "refunded_amount"}
+DIMENSIONS = ("category", "payment_method")
+
+_HANDLERS = {
+    "order.created": "order_created",
+    "payment.succeeded": "payment_succeeded",
+    "payment.failed": "payment_failed",
+    "payment.refunded": "payment_refunded",
+}
+
+analytics_events = Counter("order_analytics_events_total", "Events applied to sales analytics", ["type", "outcome"])
+
+
+def _minor(amount: Optional[float], currency: str) -> int:
+    return to_minor(amount or 0, currency)
+
+
+def parse_resolutions(spec: str) -> List[Tuple[int, int]]:
+    levels = []
+    for part in spec.split(","):
+        width, slots = part.split(":")
+        levels.append((int(width), int(slots)))
+    for (fine, _), (coarse, _) in zip(levels, levels[1:]):
+        if coarse % fine:
+            raise ValueError(f"Resolution {coarse}s is not a multiple of {fine}s")
+    return levels
+
+
+class Dimension:
+    """Значения измерения и их номера в массивах"""
+
+    def __init__(self, values: Sequence[str] = ()):
+        self.values: List[str] = list(values)
+        self.index = {value: i for i, value in enumerate(self.values)}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def get(self, value: str) -> Tuple[int, bool]:
+        """Номер значения и признак того, что оно новое"""
+        i = self.index.get(value)
+        if i is not None:
+            return i, False
+        i = self.index[value] = len(self.values)
+        self.values.append(value)
+        return i, True
+
+
+class Level:
+    """Кольцо корзин одного разрешения; buckets[slot] - номер корзины в слоте, -1 - пусто"""
+
+    def __init__(self, width: int, slots: int, categories: int, methods: int):
+        self.width = width
+        self.slots = slots
+        self.buckets = np.full(slots, -1, dtype=np.int64)
+        self.amounts = np.zeros((slots, categories, methods, len(AMOUNT_METRICS)), dtype=np.int64)
+        self.counts = np.zeros((slots, methods, len(COUNT_METRICS)), dtype=np.int64)
+
+    def grow(self, categories: int, methods: int):
+        _, c, m, _ = self.amounts.shape
+        if categories > c or methods > m:
+            self.amounts = np.pad(self.amounts, ((0, 0), (0, categories - c), (0, methods - m), (0, 0)))
+            self.counts = np.pad(self.counts, ((0, 0), (0, methods - m), (0, 0)))
+
+    def clear(self, slots):
+        self.buckets[slots] = -1
+        self.amounts[slots] = 0
+        self.counts[slots] = 0
+
+
+class SalesAnalytics:
+    def __init__(self, resolutions: str = ANALYTICS_RESOLUTIONS):
+        self.categories = Dimension([UNKNOWN])
+        self.methods = Dimension([UNKNOWN])
+        self.levels = [Level(width, slots, 1, 1) for width, slots in parse_resolutions(resolutions)]
+        # Состав недавних заказов для распределения оплат по категориям:
+        # order_id -> (способ оплаты, номера категорий, суммы строк)
+        self.orders: "OrderedDict[str, Tuple[int, Tuple[int, ...], Tuple[int, ...]]]" = OrderedDict()
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"events": 0, "duplicates": 0, "too_old": 0, "rolled_up": 0, "other_currency": 0}
+
+    # Запись
+
+    def _category(self, value: Optional[str]) -> int:
+        return self._intern(self.categories, value or DEFAULT_CATEGORY)
+
+    def _method(self, value: Optional[str]) -> int:
+        return self._intern(self.methods, value or UNKNOWN)
+
+    def _intern(self, dimension: Dimension, value: str) -> int:
+        i, new = dimension.get(value)
+        if new:
+            for level in self.levels:
+                level.grow(len(self.categories), len(self.methods))
+        return i
+
+    def _slot(self, ts: float, level_index: int = 0) -> Optional[Tuple[Level, int]]:
+        """Уровень и слот для времени ts: самый мелкий уровень, в окне которого оно лежит"""
+        for level in self.levels[level_index:]:
+            bucket = int(ts // level.width)
+            slot = bucket % level.slots
+            held = level.buckets[slot]
+            if held == bucket:
+                return level, slot
+            if held < bucket:
+                if held >= 0:
+                    self._roll_up(level, np.array([slot]))
+                level.buckets[slot] = bucket
+                return level, slot
+            # В слоте корзина новее: время старше окна уровня
+        self.stats["too_old"] += 1
+        return None
+
+    def add_amount(self, ts: float, category: int, method: int, metric: int, value: int):
+        target = self._slot(ts)
+        if target is not None:
+            level, slot = target
+            level.amounts[slot, category, method, metric] += value
+
+    def add_count(self, ts: float, method: int, metric: int, value: int = 1):
+        target = self._slot(ts)
+        if target is not None:
+            level, slot = target
+            level.counts[slot, method, metric] += value
+
+    def _roll_up(self, level: Level, slots: np.ndarray):
+        """Перенести корзины слотов в следующий уровень и освободить слоты"""
+        index = self.levels.index(level)
+        if index + 1 < len(self.levels):
+            coarse = self.levels[index + 1]
+            starts = level.buckets[slots] * level.width
+            # Корзины, попадающие в одну крупную, складываются одной векторной суммой
+            for start in np.unique(starts):
+                group = slots[starts == start]
+                target = self._slot(float(start), index + 1)
+                if target is None:
+                    continue
+                coarse_level, coarse_slot = target
+                coarse_level.amounts[coarse_slot] += level.amounts[group].sum(axis=0)
+                coarse_level.counts[coarse_slot] += level.counts[group].sum(axis=0)
+            self.stats["rolled_up"] += len(slots)
+        level.clear(slots)
+
+    def compact(self, now: Optional[float] = None) -> int:
+        """Свернуть корзины старше окна каждого уровня в следующий уровень"""
+        now = time.time() if now is None else now
+        rolled = 0
+        for level in self.levels:
+            expired = np.nonzero((level.buckets >= 0) & (level.buckets <= int(now // level.width) - level.slots))[0]
+            if len(expired):
+                self._roll_up(level, expired)
+                rolled += len(expired)
+        return rolled
+
+    # События
+
+    def _mark_seen(self, key: str):
+        self._seen[key] = None
+        if len(self._seen) > ANALYTICS_DEDUP_SIZE:
+            self._seen.popitem(last=False)
+
+    def _in_catalog_currency(self, payload: Dict[str, Any]) -> bool:
+        if (payload.get("currency") or CATALOG_CURRENCY).upper() == CATALOG_CURRENCY:
+            return True
+        self.stats["other_currency"] += 1
+        return False
+
+    def order_created(self, payload: Dict[str, Any], ts: float):
+        method = self._method(payload.get("payment_method"))
+        priced = self._in_catalog_currency(payload)
+        categories, lines = [], []
+        for item in payload.get("items") or []:
+            category = self._category(item.get("category"))
+            self.add_amount(ts, category, method, ITEMS, int(item.get("quantity", 0)))
+            categories.append(category)
+            lines.append(_minor(item.get("price", 0), CATALOG_CURRENCY) * int(item.get("quantity", 0)) if priced else 0)
+        self.add_count(ts, method, CREATED)
+        if priced and categories:
+            # Сумма заказа с учетом скидок и доставки делится между категориями по суммам строк
+            total = payload.get("total_minor")
+            ordered = allocate(total, lines) if total is not None else lines
+            for category, amount in zip(categories, ordered):
+                self.add_amount(ts, category, method, ORDERED, amount)
+        order_id = payload.get("order_id")
+        if order_id and categories:
+            self.orders[order_id] = (method, tuple(categories), tuple(lines))
+            if len(self.orders) > ANALYTICS_PENDING_ORDERS:
+                self.orders.popitem(last=False)
+
+    def _distribute(self, payload: Dict[str, Any], ts: float, metric: int) -> int:
+        known = self.orders.get(payload.get("order_id"))
+        method = known[0] if known else self.methods.index[UNKNOWN]
+        if not self._in_catalog_currency(payload):
+            return method
+        amount = _minor(payload.get("amount"), CATALOG_CURRENCY)
+        if known is None:
+            self.add_amount(ts, self.categories.index[UNKNOWN], method, metric, amount)
+            return method
+        _, categories, weights = known
+        for category, part in zip(categories, allocate(amount, weights)):
+            self.add_amount(ts, category, method, metric, part)
+        return method
+
+    def payment_succeeded(self, payload: Dict[str, Any], ts: float):
+        method = self._distribute(payload, ts, REVENUE)
+        self.add_count(ts, method, PAID)
+
+    def payment_failed(self, payload: Dict[str, Any], ts: float):
+        known = self.orders.get(payload.get("order_id"))
+        self.add_count(ts, known[0] if known else self.methods.index[UNKNOWN], FAILED)
+
+    def payment_refunded(self, payload: Dict[str, Any], ts: float):
+        self._distribute(payload, ts, REFUNDED)
+
+    async def on_event(self, event: Event):
+        # Outbox доставляет как минимум один раз: повтор не должен удвоить суммы
+        key = event.message_key
+        if key in self._seen:
+            self.stats["duplicates"] += 1
+            analytics_events.labels(event.routing_key, "duplicate").inc()
+            return
+        handler = getattr(self, _HANDLERS[event.routing_key])
+        handler(event.payload, event.timestamp)
+        self._mark_seen(key)
+        self.stats["events"] += 1
+        analytics_events.labels(event.routing_key, "applied").inc()
+
+    # Запросы
+
+    def query(
+        self,
+        start: float,
+        end: float,
+        step: Optional[int] = None,
+        group_by: Sequence[str] = ()
+    ) -> List[Dict[str, Any]]:
+        """Суммы за [start, end) по шагам step секунд (None - одной строкой) и измерениям group_by"""
+        by_category = "category" in group_by
+        by_method = "payment_method" in group_by
+        totals: Dict[Tuple[int, int, int], np.ndarray] = {}
+        counts: Dict[Tuple[int, int], np.ndarray] = {}
+
+        for level in self.levels:
+            starts = level.buckets * level.width
+            slots = np.nonzero((level.buckets >= 0) & (starts >= start) & (starts < end))[0]
+            if not len(slots):
+                continue
+            times = (starts[slots] // step) * step if step else np.zeros(len(slots), dtype=np.int64)
+            unique_times, inverse = np.unique(times, return_inverse=True)
+
+            amounts = level.amounts[slots]
+            if not by_category:
+                amounts = amounts.sum(axis=1, keepdims=True)
+            if not by_method:
+                amounts = amounts.sum(axis=2, keepdims=True)
+            grouped = np.zeros((len(unique_times),) + amounts.shape[1:], dtype=np.int64)
+            np.add.at(grouped, inverse, amounts)
+            for t, c, m in zip(*np.nonzero(grouped.any(axis=3))):
+                key = (int(unique_times[t]), int(c), int(m))
+                totals[key] = totals.get(key, 0) + grouped[t, c, m]
+
+            if not by_category:
+                level_counts = level.counts[slots]
+                if not by_method:
+                    level_counts = level_counts.sum(axis=1, keepdims=True)
+                grouped_counts = np.zeros((len(unique_times),) + level_counts.shape[1:], dtype=np.int64)
+                np.add.at(grouped_counts, inverse, level_counts)
+                for t, m in zip(*np.nonzero(grouped_counts.any(axis=2))):
+                    key = (int(unique_times[t]), int(m))
+                    counts[key] = counts.get(key, 0) + grouped_counts[t, m]
+
+        keys = set(totals) | {(t, 0, m) for t, m in counts}
+        rows = []
+        for t, c, m in sorted(keys):
+            row: Dict[str, Any] = {"bucket": datetime.utcfromtimestamp(t).isoformat() if step else None}
+            if by_category:
+                row["category"] = self.categories.values[c]
+            if by_method:
+                row["payment_method"] = self.methods.values[m]
+            values = totals.get((t, c, m))
+            for i, name in enumerate(AMOUNT_METRICS):
+                value = int(values[i]) if values is not None else 0
+                row[name] = from_minor(value, CATALOG_CURRENCY) if name in MONEY else value
+            if not by_category:
+                values = counts.get((t, m))
+                for i, name in enumerate(COUNT_METRICS):
+                    row[name] = int(values[i]) if values is not None else 0
+            rows.append(row)
+        return rows
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "levels": [
+                {
+                    "width": level.width,
+                    "slots": level.slots,
+                    "used": int((level.buckets >= 0).sum()),
+                    "bytes": level.amounts.nbytes + level.counts.nbytes + level.buckets.nbytes
+                }
+                for level in self.levels
+            ],
+            "categories": list(self.categories.values),
+            "payment_methods": list(self.methods.values),
+            "currency": CATALOG_CURRENCY,
+            "tracked_orders": len(self.orders),
+            **self.stats
+        }
+
+    # Сохранение между перезапусками
+
+    def save(self, path: str = ANALYTICS_SNAPSHOT):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        arrays = {}
+        for i, level in enumerate(self.levels):
+            arrays[f"buckets_{i}"] = level.buckets
+            arrays[f"amounts_{i}"] = level.amounts
+            arrays[f"counts_{i}"] = level.counts
+        tmp = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp,
+            resolutions=np.array([[level.width, level.slots] for level in self.levels]),
+            categories=np.array(self.categories.values),
+            methods=np.array(self.methods.values),
+            **arrays
+        )
+        os.replace(tmp, path)
+
+    def load(self, path: str = ANALYTICS_SNAPSHOT) -> bool:
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            resolutions = [tuple(int(v) for v in row) for row in data["resolutions"]]
+            if resolutions != [(level.width, level.slots) for level in self.levels]:
+                print(f"Analytics snapshot {path} has other resolutions, ignored")
+                return False
+            self.categories = Dimension([str(v) for v in data["categories"]])
+            self.methods = Dimension([str(v) for v in data["methods"]])
+            for i, level in enumerate(self.levels):
+                level.buckets = data[f"buckets_{i}"].copy()
+                level.amounts = data[f"amounts_{i}"].copy()
+                level.counts = data[f"counts_{i}"].copy()
+        return True
+
+    # Фоновое сворачивание и сохранение
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ANALYTICS_COMPACT_INTERVAL)
+            self.compact()
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Could not save analytics snapshot: {e}")
+
+
+def analytics_consumer(analytics: SalesAnalytics, **kwargs) -> EventConsumer:
+    consumer = EventConsumer("order-service.analytics", **kwargs)
+    consumer.subscribe(*_HANDLERS)(analytics.on_event)
+    return consumer
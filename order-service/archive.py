@@ -0,0 +1,290 @@
+"""Архив завершенных заказов: горячие заказы в orders_db, холодные - на диске.
+
+Доставленные, отмененные и возвращенные заказы раньше оставались в
+orders_db навсегда: память росла, а каждый просмотр заказов (список,
+поиск по пользователю, пересчет сводок) проходил и по ним. Теперь
+ArchiveCompactor раз в ORDER_ARCHIVE_INTERVAL секунд переносит заказы в
+конечных статусах, не менявшиеся дольше ORDER_ARCHIVE_AFTER секунд и без
+незавершенной саги, в OrderArchive - SQLite-файл в томе сервиса. Заказ
+хранится сжатым JSON (zlib) вместе с несжатыми колонками для поиска по
+пользователю и для пересчета сводок, которым не нужен весь заказ.
+
+Перенос идет пачками по ORDER_ARCHIVE_BATCH заказов; после каждой пачки
+компактор выжидает, чтобы запись на диск не превышала ORDER_ARCHIVE_IO_RATE
+байт в секунду. Сжатие и запись идут в потоке (asyncio.to_thread), чтобы
+не останавливать event loop; JSON заказов снимается до ухода в поток. После
+записи из orders_db удаляются только заказы, чья версия не изменилась за
+время записи, а архивные копии остальных удаляются - в памяти остается
+более новая версия.
+
+Чтение по id проходит в архив, если заказа нет в orders_db; запросы к
+архиву из обработчиков тоже выполняются в потоке (методы с префиксом a). Изменение
+архивного заказа (например, возврат по доставленному) сначала возвращает
+его в orders_db (restore). Сводки пользователей архивация не меняет:
+заказ остается заказом пользователя, только хранится в другом месте.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from prometheus_client import Counter, Gauge
+
+from models import OrderStatus
+
+ORDER_ARCHIVE_DB = os.getenv("ORDER_ARCHIVE_DB", "data/orders-archive.db")
+ORDER_ARCHIVE_AFTER = float(os.getenv("ORDER_ARCHIVE_AFTER", str(7 * 86400)))
+ORDER_ARCHIVE_INTERVAL = float(os.getenv("ORDER_ARCHIVE_INTERVAL", "300"))
+ORDER_ARCHIVE_BATCH = int(os.getenv("ORDER_ARCHIVE_BATCH", "500"))
+ORDER_ARCHIVE_IO_RATE = int(os.getenv("ORDER_ARCHIVE_IO_RATE", str(1 << 20)))
+ORDER_ARCHIVE_COMPRESSION = int(os.getenv("ORDER_ARCHIVE_COMPRESSION", "6"))
+
+TERMINAL_STATUSES = frozenset(s.value for s in (OrderStatus.DELIVERED, OrderStatus.CANCELLED, OrderStatus.REFUNDED))
+
+archive_orders = Gauge("order_archive_orders", "Orders in the cold archive")
+archive_moved = Counter("order_archive_moved_total", "Orders moved from memory to the archive")
+archive_restored = Counter("order_archive_restored_total", "Archived orders moved back to memory for an update")
+archive_bytes = Counter("order_archive_written_bytes_total", "Compressed bytes written to the archive")
+archive_reads = Counter("order_archive_reads_total", "Order reads served from the archive")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payment_status TEXT NOT NULL,
+    total_amount REAL NOT NULL,
+    refunded_amount REAL,
+    currency TEXT,
+    created_at TEXT NOT NULL,
+    archived_at REAL NOT NULL,
+    data BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, created_at);
+"""
+
+# Колонки, которых достаточно для сводок пользователей (summaries._contribution)
+SUMMARY_COLUMNS = ("user_id", "status", "payment_status", "total_amount", "refunded_amount", "currency", "created_at")
+
+
+class OrderArchive:
+    def __init__(self, path: str = ORDER_ARCHIVE_DB):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Записи из потока компактора и из event loop не должны попасть в одну транзакцию
+        self._write_lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        self.count = self._db.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        archive_orders.set(self.count)
+
+    def _migrate(self):
+        """Архив прежней версии без колонки currency: валюта берется из сжатого заказа"""
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(orders)")}
+        if "currency" in columns:
+            return
+        self._db.execute("ALTER TABLE orders ADD COLUMN currency TEXT")
+        rows = self._db.execute("SELECT id, data FROM orders").fetchall()
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "UPDATE orders SET currency = ? WHERE id = ?",
+                [(self._load(data).get("currency"), order_id) for order_id, data in rows]
+            )
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def _load(data: bytes) -> Dict[str, Any]:
+        return json.loads(zlib.decompress(data))
+
+    @staticmethod
+    def _encode(orders: List[Dict[str, Any]]) -> List[tuple]:
+        """Снимок заказов: колонки и несжатый JSON"""
+        return [
+            (order["id"], *(order.get(column) for column in SUMMARY_COLUMNS),
+             json.dumps(order, separators=(",", ":")).encode())
+            for order in orders
+        ]
+
+    def _write(self, encoded: List[tuple]) -> int:
+        now = time.time()
+        rows = [(*row[:-1], now, zlib.compress(row[-1], ORDER_ARCHIVE_COMPRESSION)) for row in encoded]
+        with self._write_lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO orders (id, {', '.join(SUMMARY_COLUMNS)}, archived_at, data) "
+                f"VALUES ({', '.join('?' * (len(SUMMARY_COLUMNS) + 3))})",
+                rows
+            )
+            self.count = self._db.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        archive_orders.set(self.count)
+        return sum(len(row[-1]) for row in rows)
+
+    def put_many(self, orders: List[Dict[str, Any]]) -> int:
+        """Записать заказы одной транзакцией; возвращает число записанных байт"""
+        return self._write(self._encode(orders))
+
+    async def aput_many(self, orders: List[Dict[str, Any]]) -> int:
+        """put_many в потоке; заказы сериализуются сразу, до первого await"""
+        return await asyncio.to_thread(self._write, self._encode(orders))
+
+    def get(self, order_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db.execute("SELECT data FROM orders WHERE id = ?", (order_id,)).fetchone()
+        if row is None:
+            return None
+        archive_reads.inc()
+        return self._load(row[0])
+
+    async def aget(self, order_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.get, order_id)
+
+    def delete(self, order_id: str) -> bool:
+        with self._write_lock:
+            deleted = self._db.execute("DELETE FROM orders WHERE id = ?", (order_id,)).rowcount > 0
+        if deleted:
+            self.count -= 1
+            archive_orders.set(self.count)
+        return deleted
+
+    def by_user(self, user_id: str, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """Архивные заказы пользователя, новые первыми"""
+        query = "SELECT data FROM orders WHERE user_id = ?"
+        params: List[Any] = [user_id]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        return [self._load(row[0]) for row in self._db.execute(query, params)]
+
+    def count_user(self, user_id: str, status: Optional[str] = None) -> int:
+        query = "SELECT COUNT(*) FROM orders WHERE user_id = ?"
+        params: List[Any] = [user_id]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        return self._db.execute(query, params).fetchone()[0]
+
+    async def aby_user(self, user_id: str, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.by_user, user_id, status, limit)
+
+    async def acount_user(self, user_id: str, status: Optional[str] = None) -> int:
+        return await asyncio.to_thread(self.count_user, user_id, status)
+
+    def summary_rows(self) -> Iterator[Dict[str, Any]]:
+        """Поля заказов для пересчета сводок, без распаковки"""
+        for row in self._db.execute(f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM orders"):
+            yield dict(zip(SUMMARY_COLUMNS, row))
+
+    def snapshot(self) -> Dict[str, Any]:
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        return {"orders": self.count, "file_bytes": page_count * page_size}
+
+
+class ArchiveCompactor:
+    """Фоновый перенос завершенных заказов; busy(order_id) - заказ еще нельзя переносить (идет сага)"""
+
+    def __init__(
+        self,
+        orders: Dict[str, Dict[str, Any]],
+        archive: OrderArchive,
+        busy: Callable[[str], bool],
+        archive_after: float = ORDER_ARCHIVE_AFTER,
+        batch_size: int = ORDER_ARCHIVE_BATCH,
+        io_rate: int = ORDER_ARCHIVE_IO_RATE
+    ):
+        self.orders = orders
+        self.archive = archive
+        self.busy = busy
+        self.archive_after = archive_after
+        self.batch_size = batch_size
+        self.io_rate = io_rate
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "moved": 0, "bytes": 0, "last_run_at": None, "last_run_seconds": None}
+
+    def _eligible(self, order: Dict[str, Any], cutoff: str) -> bool:
+        return order["status"] in TERMINAL_STATUSES and order["updated_at"] < cutoff and not self.busy(order["id"])
+
+    async def compact(self) -> int:
+        """Перенести все подходящие заказы; возвращает их число"""
+        started = time.time()
+        # updated_at - ISO-время UTC, поэтому сравнивается строкой
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.archive_after)).isoformat()
+        candidates = [order_id for order_id, order in self.orders.items() if self._eligible(order, cutoff)]
+        moved = 0
+        for i in range(0, len(candidates), self.batch_size):
+            # Заказ мог измениться или удалиться, пока компактор ждал
+            batch = [self.orders[order_id] for order_id in candidates[i:i + self.batch_size]
+                     if order_id in self.orders and self._eligible(self.orders[order_id], cutoff)]
+            if not batch:
+                continue
+            versions = {order["id"]: order["version"] for order in batch}
+            try:
+                written = await self.archive.aput_many(batch)
+            except sqlite3.Error as e:
+                print(f"Could not archive orders: {e}")
+                break
+            # Пока шла запись, заказ могли изменить, удалить или начать по нему сагу:
+            # тогда в памяти остается он, а устаревшая архивная копия удаляется
+            archived = 0
+            for order in batch:
+                order_id = order["id"]
+                current = self.orders.get(order_id)
+                if current is order and order["version"] == versions[order_id] and self._eligible(order, cutoff):
+                    del self.orders[order_id]
+                    archived += 1
+                else:
+                    self.archive.delete(order_id)
+            moved += archived
+            archive_moved.inc(archived)
+            archive_bytes.inc(written)
+            self.stats["bytes"] += written
+            # Ограничение скорости записи: пауза пропорциональна объему пачки
+            await asyncio.sleep(written / self.io_rate)
+        self.stats["runs"] += 1
+        self.stats["moved"] += moved
+        self.stats["last_run_at"] = started
+        self.stats["last_run_seconds"] = time.time() - started
+        return moved
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+            try:
+                moved = await self.compact()
+                if moved:
+                    print(f"Archived {moved} completed orders")
+            except Exception as e:
+                print(f"Order archive compaction failed: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "hot_orders": len(self.orders),
+            "archive_after_seconds": self.archive_after,
+            "io_rate_bytes": self.io_rate,
+            **self.archive.snapshot(),
+            **self.stats
+        }
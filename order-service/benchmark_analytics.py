@@ -0,0 +1,86 @@
+"""Бенчмарк аналитики продаж: запись событий и запросы по диапазону.
+
+Генерирует --orders заказов (и оплаты к 70% из них), равномерно за --days
+дней, сворачивает старые корзины и сравнивает запросы SalesAnalytics с
+прежним способом - полным проходом по выгруженным заказам:
+    python benchmark_analytics.py --orders 1000000 --days 30
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from analytics import SalesAnalytics  # noqa: E402
+
+CATEGORIES = ["electronics", "books", "clothing", "food", "other"]
+METHODS = ["card", "sbp", "cash"]
+
+
+def measure(fn, repeat: int = 5) -> float:
+    """Миллисекунды на вызов (лучший из repeat)"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=300000)
+    parser.add_argument("--days", type=int, default=30)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    now = time.time()
+    start = now - args.days * 86400
+    orders = []
+    for i in range(args.orders):
+        ts = start + (now - start) * i / args.orders
+        items = [{"price": rng.choice([99.0, 1990.0, 349.5]), "quantity": rng.randint(1, 3),
+                  "category": rng.choice(CATEGORIES)} for _ in range(rng.randint(1, 3))]
+        orders.append((f"ORD-{i:08d}", ts, rng.choice(METHODS), items, rng.random() < 0.7))
+
+    analytics = SalesAnalytics()
+    started = time.perf_counter()
+    for order_id, ts, method, items, paid in orders:
+        analytics.order_created({"order_id": order_id, "payment_method": method, "items": items}, ts)
+        if paid:
+            amount = sum(item["price"] * item["quantity"] for item in items)
+            analytics.payment_succeeded({"order_id": order_id, "amount": amount}, ts + 5)
+    ingest = time.perf_counter() - started
+    analytics.compact(now)
+    events = sum(2 if o[4] else 1 for o in orders)
+    print(f"Ingest: {events} events in {ingest:.2f}s ({ingest / events * 1e6:.1f}us per event)")
+    memory = sum(level["bytes"] for level in analytics.snapshot()["levels"])
+    print(f"Arrays: {memory / 1024 / 1024:.1f} MiB for any number of orders")
+
+    def scan(range_start: float, step: int):
+        # Прежний способ: проход по всем заказам с группировкой в словаре
+        totals = defaultdict(float)
+        for _, ts, method, items, paid in orders:
+            if range_start <= ts < now and paid:
+                for item in items:
+                    totals[(int(ts // step), item["category"])] += item["price"] * item["quantity"]
+        return totals
+
+    queries = [
+        ("24h per hour by category", now - 86400, 3600, ["category"]),
+        ("7d per day by category", now - 7 * 86400, 86400, ["category"]),
+        (f"{args.days}d per day by method", start, 86400, ["payment_method"]),
+        (f"{args.days}d total", start, None, []),
+    ]
+    print(f"{'query':<30}{'analytics ms':>14}{'full scan ms':>14}")
+    for name, range_start, step, group_by in queries:
+        fast = measure(lambda: analytics.query(range_start, now, step, group_by))
+        slow = measure(lambda: scan(range_start, step or 86400 * 365), repeat=1)
+        print(f"{name:<30}{fast:>14.2f}{slow:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
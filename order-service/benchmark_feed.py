@@ -0,0 +1,96 @@
+"""Бенчмарк ленты изменений: стоимость простаивающих подписок и раздачи.
+
+Открывает --subscribers подписок (каждая - задача, читающая sse_stream,
+как соединение SSE в uvicorn), меряет память на подписку, время
+heartbeat-тика и время раздачи изменений заказов с --per-order
+подписчиками; затем переполняет буфер медленного подписчика:
+    python benchmark_feed.py --subscribers 50000 --per-order 100
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from changefeed import COALESCE, DROP, ChangeFeed, sse_stream  # noqa: E402
+from state_machine import UPDATED  # noqa: E402
+
+
+async def drain(stream, counter):
+    async for chunk in stream:
+        counter[0] += chunk.count(b"event: order")
+
+
+def order(i: int, version: int = 1) -> dict:
+    return {"id": f"ORD-{i:08d}", "user_id": f"user-{i % 1000}", "version": version,
+            "status": "processing", "payment_status": "paid", "total_amount": 100.0}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=20000)
+    parser.add_argument("--per-order", type=int, default=100)
+    args = parser.parse_args()
+
+    feed = ChangeFeed(max_subscribers=args.subscribers + args.per_order + 10)
+    delivered = [0]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = []
+    for i in range(args.subscribers):
+        subscriber = feed.subscribe(f"order:ORD-{i:08d}")
+        tasks.append(asyncio.create_task(drain(sse_stream(feed, subscriber), delivered)))
+    await asyncio.sleep(0.1)
+    idle = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{args.subscribers} idle subscriptions: {idle / args.subscribers:.0f} bytes each "
+          f"(feed and stream task, without the HTTP connection)")
+
+    started = time.perf_counter()
+    for subscribers in feed.topics.values():
+        for subscriber in subscribers:
+            subscriber.heartbeat = True
+            subscriber.wake()
+    await asyncio.sleep(0)
+    tick = time.perf_counter() - started
+    print(f"Heartbeat tick for all subscriptions: {tick * 1000:.1f} ms")
+
+    # Изменения заказов, у каждого из которых per_order подписчиков
+    hot = [feed.subscribe("order:ORD-HOT") for _ in range(args.per_order)]
+    tasks += [asyncio.create_task(drain(sse_stream(feed, s), delivered)) for s in hot]
+    await asyncio.sleep(0.1)
+    delivered[0] = 0
+    changes = 1000
+    started = time.perf_counter()
+    for version in range(changes):
+        feed(UPDATED, {**order(0, version), "id": "ORD-HOT"}, {})
+        await asyncio.sleep(0)
+    while delivered[0] < changes * args.per_order and time.perf_counter() - started < 30:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    print(f"{changes} changes x {args.per_order} subscribers: {elapsed * 1000:.0f} ms, "
+          f"{delivered[0]} events written ({elapsed / max(delivered[0], 1) * 1e6:.1f} us per event)")
+
+    # Медленный подписчик: буфер не растет, лишнее сливается или вытесняется
+    for policy in (COALESCE, DROP):
+        slow = feed.subscribe("user:user-1", policy, limit=64)
+        # 10000 изменений 50 заказов одного пользователя
+        for i in range(10000):
+            feed(UPDATED, order(i % 50 * 1000 + 1, i), {})
+        changes, dropped = await slow.get()
+        print(f"Slow subscriber ({policy}): buffered {len(changes)} changes of "
+              f"{len({c['id'] for c in changes})} orders, dropped {dropped}")
+        feed.unsubscribe(slow)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+"""Бенчмарк расчета стоимости: --carts корзин по одной и одним пакетом.
+
+Сравнивает прежний расчет (сумма float по строкам), PricingEngine.price()
+для каждой корзины и PricingEngine.price_batch() для всех сразу:
+    python benchmark_pricing.py --carts 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from check_pricing import RULES, random_cart  # noqa: E402
+from pricing import PricingEngine  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--carts", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = PricingEngine(RULES)
+    carts = [random_cart(rng) for _ in range(args.carts)]
+    lines = sum(len(cart.lines) for cart in carts)
+    print(f"{args.carts} carts, {lines} lines, {len(RULES)} currencies")
+
+    started = time.perf_counter()
+    for cart in carts:
+        sum(line.unit_price / 100 * line.quantity for line in cart.lines)
+    baseline = time.perf_counter() - started
+
+    started = time.perf_counter()
+    quotes = [engine.price(cart) for cart in carts]
+    scalar = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = engine.price_batch(carts)
+    vectorized = time.perf_counter() - started
+
+    mismatches = sum(1 for i, quote in enumerate(quotes) if quote.total != batch.total[i])
+    print(f"{'method':<34}{'total s':>10}{'us per cart':>14}")
+    for name, seconds in [("float sum (no promos/tax/shipping)", baseline),
+                          ("price() per cart", scalar), ("price_batch()", vectorized)]:
+        print(f"{name:<34}{seconds:>10.3f}{seconds / args.carts * 1e6:>14.2f}")
+    print(f"Batch speedup over scalar: {scalar / vectorized:.1f}x, mismatched totals: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Бенчмарк саг: стоимость ожидающей саги и таймеров колеса.
+
+Создает --sagas саг, равномерно распределенных по половине окна таймаута оплаты
+(колесо прокручивается без реального ожидания), половину завершает оплатой,
+затем прокручивает колесо до срабатывания всех таймаутов. Отчет: время на
+операцию, память на ожидающую сагу и время тика.
+    python benchmark_saga.py --sagas 1000000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from saga import OrderSagas  # noqa: E402
+
+
+async def main(args):
+    cancelled = []
+
+    async def refund(order_id, payment_id):
+        pass
+
+    sagas = OrderSagas(lambda order_id, reason: cancelled.append(order_id), refund,
+                       payment_timeout=args.timeout, tick=1.0, slots=args.slots)
+    order_ids = [f"ORD-{i:08X}" for i in range(args.sagas)]
+
+    # Создание занимает половину окна таймаута, чтобы ни одна сага не истекла раньше оплаты
+    per_tick = max(args.sagas // max(int(args.timeout) // 2, 1), 1)
+    started = time.perf_counter()
+    for i, order_id in enumerate(order_ids):
+        if i % per_tick == 0:
+            sagas.wheel.advance()
+        sagas.order_created(order_id)
+    created = time.perf_counter() - started
+    print(f"Start:    {args.sagas} sagas in {created:.2f}s ({created / args.sagas * 1e6:.2f}us each)")
+
+    # Память отдельно: tracemalloc сильно замедляет выделения
+    probe = OrderSagas(lambda order_id, reason: None, refund, payment_timeout=args.timeout, slots=args.slots)
+    probe_ids = order_ids[:100000]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for order_id in probe_ids:
+        probe.order_created(order_id)
+    memory = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f"Memory:   {memory / len(probe_ids):.0f} bytes per pending saga (state + timer, without the key string)")
+
+    started = time.perf_counter()
+    for order_id in order_ids[::2]:
+        sagas.payment_succeeded(order_id, "pay")
+    paid = time.perf_counter() - started
+    print(f"Complete: {len(order_ids[::2])} sagas in {paid:.2f}s ({paid / len(order_ids[::2]) * 1e6:.2f}us each)")
+
+    worst = 0.0
+    started = time.perf_counter()
+    for _ in range(int(args.timeout) + 1):
+        tick_started = time.perf_counter()
+        sagas.wheel.advance()
+        worst = max(worst, time.perf_counter() - tick_started)
+    ticked = time.perf_counter() - started
+    print(f"Timeouts: {len(cancelled)} fired over {int(args.timeout) + 1} ticks in {ticked:.2f}s, "
+          f"worst tick {worst * 1000:.1f}ms")
+    print(sagas.snapshot())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sagas", type=int, default=1000000)
+    parser.add_argument("--timeout", type=float, default=900, help="таймаут оплаты, тиков")
+    parser.add_argument("--slots", type=int, default=4096)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,225 @@
+"""Лента изменений заказов: подписки вместо опроса GET /api/v1/orders/{id}.
+
+ChangeFeed подписан на изменения заказов (state_machine.add_listener) и
+раздает каждое изменение подписчикам заказа ("order:<id>") и его
+пользователя ("user:<user_id>"). Раздача синхронная и стоит O(число
+подписчиков темы); подписчики без изменений ничего не стоят: у каждого
+только буфер и future, созданная на время ожидания. Heartbeat для всех
+соединений выставляет одна фоновая задача раз в ORDER_FEED_HEARTBEAT
+секунд, поэтому десятки тысяч простаивающих соединений не держат таймеров.
+
+Буфер подписчика ограничен ORDER_FEED_BUFFER изменениями. Политика
+ORDER_FEED_POLICY:
+  coalesce - в буфере только последнее изменение каждого заказа (клиенту
+             важно текущее состояние); при переполнении вытесняется заказ,
+             изменившийся раньше всех;
+  drop     - очередь изменений, при переполнении вытесняются старые.
+О вытесненных изменениях клиент узнает событием lagged с их числом - после
+него стоит перечитать заказы.
+
+Изменения отдаются как Server-Sent Events (sse_stream):
+    id: <order_id>:<version>
+    event: order
+    data: {"kind": "updated", "id": ..., "status": ..., ...}
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from state_machine import DELETED
+
+ORDER_FEED_BUFFER = int(os.getenv("ORDER_FEED_BUFFER", "64"))
+ORDER_FEED_POLICY = os.getenv("ORDER_FEED_POLICY", "coalesce")
+ORDER_FEED_HEARTBEAT = float(os.getenv("ORDER_FEED_HEARTBEAT", "15"))
+ORDER_FEED_MAX_SUBSCRIBERS = int(os.getenv("ORDER_FEED_MAX_SUBSCRIBERS", "50000"))
+
+COALESCE = "coalesce"
+DROP = "drop"
+
+# Поля заказа в событии ленты: все, что клиенты отслеживают опросом
+CHANGE_FIELDS = ("id", "user_id", "version", "status", "payment_status", "tracking_number",
+                 "total_amount", "refunded_amount", "updated_at")
+
+feed_subscribers = Gauge("order_feed_subscribers", "Open order change feed subscriptions")
+feed_changes = Counter("order_feed_changes_total", "Order changes published to the feed")
+feed_deliveries = Counter("order_feed_deliveries_total", "Changes put into subscriber buffers")
+feed_coalesced = Counter("order_feed_coalesced_total", "Buffered changes replaced by a newer change of the same order")
+feed_dropped = Counter("order_feed_dropped_total", "Changes evicted from full subscriber buffers")
+
+
+class FeedFull(Exception):
+    pass
+
+
+class FeedClosed(Exception):
+    pass
+
+
+def change_of(kind: str, order: Dict[str, Any]) -> Dict[str, Any]:
+    return {"kind": kind, **{field: order.get(field) for field in CHANGE_FIELDS}}
+
+
+class Subscriber:
+    __slots__ = ("topic", "coalesce", "limit", "buffer", "dropped", "heartbeat", "closed", "_waiter")
+
+    def __init__(self, topic: str, policy: str = ORDER_FEED_POLICY, limit: int = ORDER_FEED_BUFFER):
+        self.topic = topic
+        self.coalesce = policy == COALESCE
+        self.limit = limit
+        self.buffer = OrderedDict() if self.coalesce else deque()
+        self.dropped = 0
+        self.heartbeat = False
+        self.closed = False
+        self._waiter: Optional[asyncio.Future] = None
+
+    def push(self, change: Dict[str, Any]):
+        buffer = self.buffer
+        if self.coalesce:
+            order_id = change["id"]
+            if order_id in buffer:
+                del buffer[order_id]
+                feed_coalesced.inc()
+            elif len(buffer) >= self.limit:
+                buffer.popitem(last=False)
+                self.dropped += 1
+                feed_dropped.inc()
+            buffer[order_id] = change
+        else:
+            if len(buffer) >= self.limit:
+                buffer.popleft()
+                self.dropped += 1
+                feed_dropped.inc()
+            buffer.append(change)
+        self.wake()
+
+    def wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self) -> Tuple[List[Dict[str, Any]], int]:
+        """Накопленные изменения и число вытесненных; пустой список - heartbeat"""
+        while not self.buffer and not self.heartbeat and not self.closed:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        if self.closed and not self.buffer:
+            raise FeedClosed()
+        changes = list(self.buffer.values()) if self.coalesce else list(self.buffer)
+        self.buffer.clear()
+        dropped, self.dropped = self.dropped, 0
+        self.heartbeat = False
+        return changes, dropped
+
+
+class ChangeFeed:
+    def __init__(self, max_subscribers: int = ORDER_FEED_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.topics: Dict[str, Set[Subscriber]] = {}
+        self.count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __call__(self, kind: str, order: Dict[str, Any], before: Dict[str, Any]):
+        """Слушатель изменений заказов (state_machine.add_listener)"""
+        feed_changes.inc()
+        if not self.topics:
+            return
+        change = None
+        for topic in (f"order:{order['id']}", f"user:{order['user_id']}"):
+            subscribers = self.topics.get(topic)
+            if not subscribers:
+                continue
+            change = change or change_of(kind, order)
+            for subscriber in subscribers:
+                subscriber.push(change)
+            feed_deliveries.inc(len(subscribers))
+            if kind == DELETED and topic.startswith("order:"):
+                # Удаленный заказ больше не изменится: поток заказа завершается
+                for subscriber in subscribers:
+                    subscriber.closed = True
+
+    def subscribe(self, topic: str, policy: str = ORDER_FEED_POLICY, limit: int = ORDER_FEED_BUFFER) -> Subscriber:
+        if self.count >= self.max_subscribers:
+            raise FeedFull(f"Change feed is limited to {self.max_subscribers} subscriptions")
+        subscriber = Subscriber(topic, policy, limit)
+        self.topics.setdefault(topic, set()).add(subscriber)
+        self.count += 1
+        feed_subscribers.set(self.count)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self.topics.get(subscriber.topic)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.topics[subscriber.topic]
+        self.count -= 1
+        feed_subscribers.set(self.count)
+
+    # Heartbeat
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for subscribers in self.topics.values():
+            for subscriber in subscribers:
+                subscriber.closed = True
+                subscriber.wake()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ORDER_FEED_HEARTBEAT)
+            for subscribers in list(self.topics.values()):
+                for subscriber in subscribers:
+                    subscriber.heartbeat = True
+                    subscriber.wake()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "subscribers": self.count,
+            "topics": len(self.topics),
+            "max_subscribers": self.max_subscribers,
+            "policy": ORDER_FEED_POLICY,
+            "buffer": ORDER_FEED_BUFFER,
+            "heartbeat_seconds": ORDER_FEED_HEARTBEAT
+        }
+
+
+def _event(event: str, data: Dict[str, Any], event_id: Optional[str] = None) -> bytes:
+    head = f"id: {event_id}\n" if event_id else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+async def sse_stream(feed: ChangeFeed, subscriber: Subscriber,
+                     initial: Optional[Dict[str, Any]] = None) -> AsyncIterator[bytes]:
+    """Тело ответа text/event-stream; подписка снимается, когда клиент отключается"""
+    try:
+        # Рекомендуемая задержка переподключения для EventSource
+        yield b"retry: 3000\n\n"
+        if initial is not None:
+            yield _event("order", initial, f"{initial['id']}:{initial['version']}")
+        while True:
+            try:
+                changes, dropped = await subscriber.get()
+            except FeedClosed:
+                return
+            if dropped:
+                yield _event("lagged", {"dropped": dropped})
+            if not changes:
+                yield b": ping\n\n"
+                continue
+            yield b"".join(_event("order", change, f"{change['id']}:{change['version']}") for change in changes)
+    finally:
+        feed.unsubscribe(subscriber)
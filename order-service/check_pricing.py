@@ -0,0 +1,143 @@
+"""Проверка расчета стоимости на случайных корзинах: нет расхождения округлений.
+
+Для --carts случайных корзин (разные валюты, страны, акции, цены с
+дробными копейками в исходных числах) проверяет, что
+  * price() и price_batch() дают одинаковые суммы до единицы;
+  * итог равен сумме строк плюс доставка (и налог на нее, если он сверху);
+  * скидки, налоги и доставка совпадают с эталоном на Decimal;
+  * сумма распределенной скидки заказа равна самой скидке;
+  * суммы не отрицательны и скидка не больше суммы строк.
+Завершается с кодом 1 при первом расхождении:
+    python check_pricing.py --carts 20000 --seed 7
+"""
+import argparse
+import os
+import random
+import sys
+from decimal import ROUND_HALF_UP, Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pricing import (  # noqa: E402
+    BP, Cart, CartLine, PricingEngine, PricingRules, Promotion, ShippingRule, TaxRule
+)
+from shared.money import to_minor  # noqa: E402
+
+CATEGORIES = ["electronics", "books", "clothing", "food", None]
+
+RULES = {
+    "RUB": PricingRules(
+        "RUB",
+        promotions=(
+            Promotion("books15", percent_bp=1500, category="books"),
+            Promotion("welcome", code="WELCOME", percent_bp=333),
+            Promotion("big", min_subtotal=1_000_000, amount_off=50_000),
+            Promotion("gift", code="GIFT", amount_off=777),
+        ),
+        taxes={"*": TaxRule(2000, inclusive=True), "KZ": TaxRule(1200, inclusive=True)},
+        shipping={"*": ShippingRule(fee=29_900, free_from=300_000), "KZ": ShippingRule(fee=99_900)},
+    ),
+    "USD": PricingRules(
+        "USD",
+        promotions=(
+            Promotion("food5", percent_bp=500, category="food"),
+            Promotion("save10", code="SAVE10", amount_off=1_000, min_subtotal=5_000),
+        ),
+        taxes={"*": TaxRule(875, inclusive=False)},
+        shipping={"*": ShippingRule(fee=599, free_from=5_000)},
+    ),
+    "JPY": PricingRules(
+        "JPY",
+        promotions=(Promotion("sale", code="SALE", percent_bp=1250),),
+        taxes={"*": TaxRule(1000, inclusive=False)},
+        shipping={"*": ShippingRule(fee=500)},
+    ),
+}
+CODES = {"RUB": ["WELCOME", "GIFT"], "USD": ["SAVE10"], "JPY": ["SALE"]}
+
+
+def random_cart(rng: random.Random) -> Cart:
+    currency = rng.choice(list(RULES))
+    lines = [
+        CartLine(f"P{rng.randint(1, 500)}", to_minor(round(rng.uniform(0.01, 5000), 3), currency),
+                 rng.randint(1, 20), rng.choice(CATEGORIES))
+        for _ in range(rng.randint(1, 8))
+    ]
+    codes = tuple(code for code in CODES[currency] if rng.random() < 0.4)
+    return Cart(lines, currency, rng.choice(["RU", "KZ", "US", ""]), codes)
+
+
+def half_up(value: Decimal) -> int:
+    return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def reference(engine: PricingEngine, cart: Cart):
+    """Эталон на Decimal: (скидка на строки, скидка на заказ, доставка, налог, итог)"""
+    rules = engine.rules[cart.currency]
+    subtotals = [line.unit_price * line.quantity for line in cart.lines]
+    active = [p for p in rules.promotions if p.active(cart.promo_codes, sum(subtotals))]
+    line_discount = 0
+    nets = []
+    for line, subtotal in zip(cart.lines, subtotals):
+        percent = max((p.percent_bp for p in active
+                       if p.percent_bp and p.category in (None, line.category)), default=0)
+        discount = half_up(Decimal(subtotal) * percent / BP)
+        line_discount += discount
+        nets.append(subtotal - discount)
+    order_off = min(sum(p.amount_off for p in active), sum(nets))
+    net = sum(nets) - order_off
+    shipping = rules.shipping_for(cart.country).cost(net)
+    tax_rule = rules.tax_for(cart.country)
+    rate = Decimal(tax_rule.rate_bp) / BP
+    base = rate / (1 + rate) if tax_rule.inclusive else rate
+    # Налог строк считается от их сумм после распределения скидки, поэтому
+    # эталон по заказу целиком может отличаться на полединицы на строку
+    tax = Decimal(net + shipping) * base
+    total = net + shipping + (0 if tax_rule.inclusive else half_up(tax))
+    return line_discount, order_off, shipping, tax, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--carts", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    engine = PricingEngine(RULES)
+    carts = [random_cart(rng) for _ in range(args.carts)]
+    batch = engine.price_batch(carts)
+
+    def fail(i: int, message: str):
+        print(f"cart {i}: {message}\n  {carts[i]}")
+        sys.exit(1)
+
+    for i, cart in enumerate(carts):
+        quote = engine.price(cart)
+        if quote != batch.quote(i, engine):
+            fail(i, f"scalar {quote} != batch {batch.quote(i, engine)}")
+
+        added = 0 if engine.rules[cart.currency].tax_for(cart.country).inclusive else 1
+        lines_total = sum(line.total for line in quote.lines)
+        shipping_tax = quote.tax - sum(line.tax for line in quote.lines)
+        if quote.total != lines_total + quote.shipping + added * shipping_tax:
+            fail(i, f"total {quote.total} != lines {lines_total} + shipping {quote.shipping}")
+        if quote.discount != sum(line.discount for line in quote.lines):
+            fail(i, "line discounts do not add up to the order discount")
+        if any(v < 0 for v in (quote.total, quote.tax, quote.shipping, quote.discount)) \
+                or quote.discount > quote.subtotal:
+            fail(i, f"negative or excessive amounts in {quote}")
+
+        line_discount, order_off, shipping, tax, total = reference(engine, cart)
+        if quote.discount != line_discount + order_off or quote.shipping != shipping:
+            fail(i, f"discount/shipping {quote.discount}/{quote.shipping} != "
+                    f"reference {line_discount + order_off}/{shipping}")
+        tolerance = Decimal(len(cart.lines) + 1) / 2
+        if abs(quote.tax - tax) > tolerance or abs(quote.total - total) > added * tolerance:
+            fail(i, f"tax/total {quote.tax}/{quote.total} drift from reference {tax:.2f}/{total}")
+
+    print(f"OK: {args.carts} carts, scalar == batch, totals balance, no rounding drift")
+
+
+if __name__ == "__main__":
+    main()
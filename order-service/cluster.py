@@ -0,0 +1,87 @@
+"""Запуск order-service: один процесс или шарды с маршрутизатором.
+
+    ORDER_SHARDS=1 (по умолчанию) - обычный uvicorn app:app на порту сервиса;
+    ORDER_SHARDS=N                - N процессов app:app на unix-сокетах
+                                    (ORDER_SHARD_SOCKET_DIR) и router:app на порту
+                                    сервиса с ORDER_ROUTER_WORKERS воркерами.
+
+Если любой процесс завершился, останавливаются все остальные и launcher
+выходит с ошибкой: заказы упавшего шарда потеряны, и перезапуск всего
+сервиса (restart policy контейнера) проще частичного.
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from sharding import ORDER_SHARDS, ORDER_SHARD_SOCKET_DIR, shard_socket
+
+ORDER_HOST = os.getenv("ORDER_HOST", "0.0.0.0")
+ORDER_PORT = int(os.getenv("ORDER_PORT", "5000"))
+ORDER_ROUTER_WORKERS = int(os.getenv("ORDER_ROUTER_WORKERS", str(ORDER_SHARDS)))
+SHARD_START_TIMEOUT = float(os.getenv("ORDER_SHARD_START_TIMEOUT", "30"))
+
+
+def uvicorn(app: str, *args: str) -> List[str]:
+    return [sys.executable, "-m", "uvicorn", app, *args]
+
+
+def wait_for_sockets(processes: Dict[str, subprocess.Popen]):
+    deadline = time.monotonic() + SHARD_START_TIMEOUT
+    for shard in range(ORDER_SHARDS):
+        while not os.path.exists(shard_socket(shard)):
+            if any(p.poll() is not None for p in processes.values()):
+                raise RuntimeError("order shard exited during startup")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"order shard {shard} did not start in {SHARD_START_TIMEOUT}s")
+            time.sleep(0.1)
+
+
+def main():
+    if ORDER_SHARDS <= 1:
+        os.execv(sys.executable, uvicorn("app:app", "--host", ORDER_HOST, "--port", str(ORDER_PORT),
+                                         "--proxy-headers"))
+
+    os.makedirs(ORDER_SHARD_SOCKET_DIR, exist_ok=True)
+    processes: Dict[str, subprocess.Popen] = {}
+
+    def stop():
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for shard in range(ORDER_SHARDS):
+            socket = shard_socket(shard)
+            if os.path.exists(socket):
+                os.unlink(socket)
+            env = {**os.environ, "ORDER_SHARD": str(shard), "ORDER_SHARDS": str(ORDER_SHARDS)}
+            processes[f"shard {shard}"] = subprocess.Popen(uvicorn("app:app", "--uds", socket), env=env)
+        wait_for_sockets(processes)
+        processes["router"] = subprocess.Popen(uvicorn(
+            "router:app", "--host", ORDER_HOST, "--port", str(ORDER_PORT), "--proxy-headers",
+            "--workers", str(ORDER_ROUTER_WORKERS)
+        ))
+        print(f"Order-service started with {ORDER_SHARDS} shards and {ORDER_ROUTER_WORKERS} router workers")
+
+        while True:
+            for name, process in processes.items():
+                code = process.poll()
+                if code is not None:
+                    print(f"Order-service {name} exited with {code}, stopping")
+                    sys.exit(1)
+            time.sleep(1)
+    finally:
+        stop()
+
+
+if __name__ == "__main__":
+    main()
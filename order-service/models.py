@@ -22,12 +22,38 @@ class OrderItem(BaseModel):
     quantity: int = Field(..., gt=0, description="Количество")
     price: float = Field(..., gt=0, description="Цена за единицу")
     name: str = Field(..., description="Название товара")
+    category: Optional[str] = Field(None, description="Категория товара (для аналитики продаж)")
 
 class OrderCreate(BaseModel):
     user_id: str = Field(..., description="ID пользователя")
     items: List[OrderItem] = Field(..., min_items=1, description="Список товаров")
     shipping_address: Dict[str, Any] = Field(..., description="Адрес доставки")
     payment_method: str = Field(default="card", description="Метод оплаты")
+    currency: str = Field(default="RUB", description="Валюта заказа (ISO 4217)")
+    promo_codes: List[str] = Field(default_factory=list, description="Промокоды")
+
+class PriceQuoteRequest(BaseModel):
+    items: List[OrderItem] = Field(..., min_items=1, description="Список товаров")
+    shipping_address: Dict[str, Any] = Field(default_factory=dict, description="Адрес доставки (важна страна)")
+    currency: str = Field(default="RUB", description="Валюта заказа (ISO 4217)")
+    promo_codes: List[str] = Field(default_factory=list, description="Промокоды")
+
+class PriceQuoteLine(BaseModel):
+    product_id: str
+    subtotal: float
+    discount: float
+    tax: float
+    total: float
+
+class PriceQuote(BaseModel):
+    currency: str
+    subtotal: float
+    discount: float
+    shipping: float
+    tax: float
+    total: float
+    promotions: List[str]
+    lines: List[PriceQuoteLine]
 
 class OrderUpdate(BaseModel):
     status: Optional[OrderStatus] = None
@@ -40,6 +66,12 @@ class OrderResponse(BaseModel):
     user_id: str
     items: List[OrderItem]
     total_amount: float
+    currency: str = "RUB"
+    subtotal: Optional[float] = None
+    discount: Optional[float] = None
+    shipping_cost: Optional[float] = None
+    tax: Optional[float] = None
+    promotions: List[str] = []
     status: OrderStatus
     payment_status: PaymentStatus
     shipping_address: Dict[str, Any]
@@ -48,6 +80,7 @@ class OrderResponse(BaseModel):
     notes: Optional[str]
     created_at: str
     updated_at: str
+    version: int = 1
 
     class Config:
         from_attributes = True
@@ -55,4 +88,20 @@ class OrderResponse(BaseModel):
 class UserOrdersResponse(BaseModel):
     orders: List[OrderResponse]
     total: int
-    user_id: str
\ No newline at end of file
+    user_id: str
+
+class OrderTransition(BaseModel):
+    version: int
+    at: float
+    status: OrderStatus
+    payment_status: PaymentStatus
+    actor: str
+
+class UserOrderSummary(BaseModel):
+    user_id: str
+    order_count: int
+    orders_by_status: Dict[str, int]
+    # Суммы по валютам заказов: {"RUB": 1500.0, "USD": 20.0}
+    total_amount: Dict[str, float]
+    total_spent: Dict[str, float]
+    last_order_at: Optional[str]
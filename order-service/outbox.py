@@ -0,0 +1,272 @@
+"""Транзакционный outbox событий заказов.
+
+Событие записывается в таблицу outbox (SQLite в томе сервиса) синхронно, в
+том же шаге цикла событий, что и изменение заказа: между ними нет await,
+поэтому никакой другой код не увидит заказ без события. Если запись не
+удалась, изменение не применяется и клиент получает ошибку.
+
+В брокер события отправляет OutboxRelay: читает пачку после курсора,
+публикует ее в exchange "events" на канале с подтверждениями и только
+после подтверждения всей пачки сдвигает курсор. Курсор хранится в той же
+базе, поэтому после перезапуска или недоступности брокера relay продолжает
+с места остановки и догоняет накопившееся пачками. Доставка - как минимум
+один раз: message_id = "order-service:<seq>" позволяет потребителям
+отбрасывать повторы.
+
+Тело кодируется при записи (shared.envelope, формат по EVENTS_ENCODING);
+вместе с ним сохраняются заголовки конверта, включая trace context события,
+в обработчике которого была сделана запись.
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+import aio_pika
+from prometheus_client import Counter, Gauge, Histogram
+
+from shared.envelope import EventHeader, encode
+from shared.messaging import EVENTS_EXCHANGE, ordering_headers
+
+OUTBOX_DB = os.getenv("OUTBOX_DB", "data/outbox.db")
+# NORMAL в режиме WAL переживает падение процесса, FULL - и отключение питания
+OUTBOX_SYNCHRONOUS = os.getenv("OUTBOX_SYNCHRONOUS", "NORMAL")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+# Сколько хранить опубликованные события (для разбора инцидентов)
+OUTBOX_RETENTION_SECONDS = float(os.getenv("OUTBOX_RETENTION_SECONDS", "3600"))
+# Опрос на случай, если сигнал о новой записи потерялся
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL_MS", "1000")) / 1000
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "30"))
+
+MESSAGE_ID_PREFIX = "order-service"
+
+outbox_pending = Gauge("order_outbox_pending", "Events written to the outbox but not yet confirmed by the broker")
+outbox_published = Counter("order_outbox_published_total", "Events published from the outbox")
+outbox_publish_errors = Counter("order_outbox_publish_errors_total", "Failed outbox batch publishes")
+outbox_lag = Histogram(
+    "order_outbox_lag_seconds", "Time from outbox write to broker confirm",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30, 120, 600)
+)
+outbox_batch_size = Histogram(
+    "order_outbox_batch_size", "Events per relay batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    routing_key TEXT NOT NULL,
+    body BLOB NOT NULL,
+    ordering_key TEXT,
+    created_at REAL NOT NULL,
+    content_type TEXT NOT NULL DEFAULT 'application/json',
+    headers TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS outbox_cursor (
+    name TEXT PRIMARY KEY,
+    last_seq INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class OutboxError(Exception):
+    pass
+
+
+class Outbox:
+    def __init__(self, path: str = OUTBOX_DB, relay_name: str = "events"):
+        self.path = path
+        self.relay_name = relay_name
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={OUTBOX_SYNCHRONOUS}")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        # Outbox, созданный до появления конверта событий
+        if "content_type" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN content_type TEXT NOT NULL DEFAULT 'application/json'")
+        if "headers" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN headers TEXT NOT NULL DEFAULT '{}'")
+        self._db.execute(
+            "INSERT OR IGNORE INTO outbox_cursor (name, last_seq, updated_at) VALUES (?, 0, ?)",
+            (relay_name, time.time())
+        )
+        self.cursor = self._db.execute(
+            "SELECT last_seq FROM outbox_cursor WHERE name = ?", (relay_name,)
+        ).fetchone()[0]
+        self.last_seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM outbox").fetchone()[0]
+        # Сигнал relay о новых записях
+        self.wakeup = asyncio.Event()
+        outbox_pending.set(self.pending)
+
+    @property
+    def pending(self) -> int:
+        return max(self.last_seq - self.cursor, 0)
+
+    def close(self):
+        self._db.close()
+
+    def append(self, routing_key: str, message: Dict[str, Any], ordering_key: Optional[str] = None) -> int:
+        """Записать событие; вызывать до изменения состояния, без await между ними"""
+        # id события при публикации - номер записи в outbox
+        header = EventHeader.new(routing_key)
+        body, content_type = encode(routing_key, message)
+        try:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (routing_key, body, ordering_key, created_at, content_type, headers) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (routing_key, body, ordering_key, header.timestamp, content_type, json.dumps(header.headers()))
+            )
+        except sqlite3.Error as e:
+            raise OutboxError(f"Could not write {routing_key} to outbox: {e}") from e
+        self.last_seq = cursor.lastrowid
+        outbox_pending.set(self.pending)
+        self.wakeup.set()
+        return self.last_seq
+
+    def read_batch(self, limit: int) -> List[tuple]:
+        return self._db.execute(
+            "SELECT seq, routing_key, body, ordering_key, created_at, content_type, headers "
+            "FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?",
+            (self.cursor, limit)
+        ).fetchall()
+
+    def advance(self, seq: int):
+        """Сдвинуть курсор: все события до seq подтверждены брокером"""
+        self._db.execute(
+            "UPDATE outbox_cursor SET last_seq = ?, updated_at = ? WHERE name = ?",
+            (seq, time.time(), self.relay_name)
+        )
+        self.cursor = seq
+        outbox_pending.set(self.pending)
+
+    def purge(self, older_than: float) -> int:
+        """Удалить опубликованные события старше older_than"""
+        return self._db.execute(
+            "DELETE FROM outbox WHERE seq <= ? AND created_at < ?", (self.cursor, older_than)
+        ).rowcount
+
+
+class OutboxRelay:
+    """Фоновая отправка outbox в брокер со своим соединением и каналом с подтверждениями"""
+
+    def __init__(self, outbox: Outbox, url: str, batch_size: int = OUTBOX_BATCH_SIZE,
+                 exchange: str = EVENTS_EXCHANGE, message_id_prefix: str = MESSAGE_ID_PREFIX):
+        self.outbox = outbox
+        # У каждого шарда своя последовательность seq, поэтому и свой префикс
+        self.message_id_prefix = message_id_prefix
+        self.url = url
+        self.batch_size = batch_size
+        self.exchange_name = exchange
+        self._connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self._exchange: Optional[aio_pika.abc.AbstractExchange] = None
+        self._task: Optional[asyncio.Task] = None
+        self.connected = False
+        self.last_error: Optional[str] = None
+        self.stats = {"published": 0, "batches": 0, "errors": 0}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _connect(self):
+        if self._connection is None:
+            self._connection = await aio_pika.connect_robust(self.url)
+        channel = await self._connection.channel(publisher_confirms=True)
+        self._exchange = await channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.TOPIC)
+        self.connected = True
+
+    async def _run(self):
+        backoff = 0.5
+        last_purge = 0.0
+        while True:
+            try:
+                if self._exchange is None:
+                    await self._connect()
+                published = await self.publish_batch()
+                backoff = 0.5
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Брокер недоступен: события копятся в outbox и уйдут после восстановления
+                self.stats["errors"] += 1
+                outbox_publish_errors.inc()
+                self.connected = False
+                self._exchange = None
+                self.last_error = str(e)
+                print(f"Outbox relay error ({self.outbox.pending} pending), retry in {backoff:.1f}s: {e}")
+                await asyncio.sleep(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, OUTBOX_BACKOFF_MAX)
+                continue
+
+            now = time.time()
+            if now - last_purge > 60:
+                last_purge = now
+                self.outbox.purge(now - OUTBOX_RETENTION_SECONDS)
+            if published < self.batch_size:
+                # Догнали: ждем новых записей
+                self.outbox.wakeup.clear()
+                if self.outbox.pending:
+                    continue
+                try:
+                    await asyncio.wait_for(self.outbox.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def publish_batch(self) -> int:
+        rows = self.outbox.read_batch(self.batch_size)
+        if not rows:
+            return 0
+        # Публикации пачки идут конвейером, подтверждения ждем все вместе
+        await asyncio.gather(*(
+            self._exchange.publish(
+                aio_pika.Message(
+                    body=body,
+                    content_type=content_type,
+                    type=routing_key,
+                    message_id=f"{self.message_id_prefix}:{seq}",
+                    correlation_id=ordering_key,
+                    headers={**ordering_headers(ordering_key), **json.loads(headers)},
+                    timestamp=created_at,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                ),
+                routing_key=routing_key
+            )
+            for seq, routing_key, body, ordering_key, created_at, content_type, headers in rows
+        ))
+        self.outbox.advance(rows[-1][0])
+
+        now = time.time()
+        for row in rows:
+            outbox_lag.observe(now - row[4])
+        outbox_batch_size.observe(len(rows))
+        outbox_published.inc(len(rows))
+        self.stats["published"] += len(rows)
+        self.stats["batches"] += 1
+        return len(rows)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "connected": self.connected,
+            "pending": self.outbox.pending,
+            "cursor": self.outbox.cursor,
+            "last_seq": self.outbox.last_seq,
+            "last_error": self.last_error,
+            **self.stats
+        }
@@ -0,0 +1,380 @@
+"""Расчет стоимости заказа в целых минимальных единицах валюты.
+
+Все суммы - целые (копейки, центы, иены; см. shared.money), цены строк
+переводятся в них один раз на входе. Порядок расчета:
+  1. строки: цена * количество, скидка в процентах (лучшая из подходящих
+     акций; акция может ограничиваться категорией товара);
+  2. заказ: фиксированные скидки на заказ распределяются по строкам
+     пропорционально их сумме методом наибольших остатков, так что сумма
+     скидок строк равна скидке заказа до единицы;
+  3. доставка по стране: стоимость или бесплатно от порога;
+  4. налог по стране на каждую строку и на доставку: добавляется к цене
+     (inclusive=false) или выделяется из нее (inclusive=true, как НДС в
+     российских ценах - итог при этом не меняется).
+Процентные величины задаются в базисных пунктах (1/100 процента), все
+округления - половина вверх в целых числах. Акции доступны по коду
+(promo_codes заказа) или без кода - автоматически; порог min_subtotal
+сравнивается с суммой строк до скидок.
+
+price() считает одну корзину на чистом Python, price_batch() - много корзин
+массивами NumPy: строки всех корзин лежат подряд, суммы по корзинам
+берутся через np.add.reduceat. Результаты обоих путей совпадают до единицы
+(см. check_pricing.py).
+
+Правила по валютам читаются из JSON-файла PRICING_RULES; без него
+действуют DEFAULT_RULES.
+"""
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared.money import allocate, exponent, from_minor, round_div
+
+PRICING_RULES = os.getenv("PRICING_RULES", "")
+
+BP = 10000
+ANY_COUNTRY = "*"
+
+
+class PricingError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Promotion:
+    id: str
+    code: Optional[str] = None
+    percent_bp: int = 0
+    category: Optional[str] = None
+    amount_off: int = 0
+    min_subtotal: int = 0
+
+    def active(self, codes: Sequence[str], subtotal: int) -> bool:
+        return (self.code is None or self.code in codes) and subtotal >= self.min_subtotal
+
+
+@dataclass(frozen=True)
+class TaxRule:
+    rate_bp: int = 0
+    inclusive: bool = True
+
+    def tax(self, amount: int) -> int:
+        if self.inclusive:
+            return round_div(amount * self.rate_bp, BP + self.rate_bp)
+        return round_div(amount * self.rate_bp, BP)
+
+
+@dataclass(frozen=True)
+class ShippingRule:
+    fee: int = 0
+    free_from: Optional[int] = None
+
+    def cost(self, amount: int) -> int:
+        return 0 if self.free_from is not None and amount >= self.free_from else self.fee
+
+
+@dataclass
+class PricingRules:
+    currency: str
+    promotions: Tuple[Promotion, ...] = ()
+    taxes: Dict[str, TaxRule] = field(default_factory=dict)
+    shipping: Dict[str, ShippingRule] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.codes = {p.code for p in self.promotions if p.code}
+
+    def tax_for(self, country: str) -> TaxRule:
+        return self.taxes.get(country) or self.taxes.get(ANY_COUNTRY) or TaxRule()
+
+    def shipping_for(self, country: str) -> ShippingRule:
+        return self.shipping.get(country) or self.shipping.get(ANY_COUNTRY) or ShippingRule()
+
+    @classmethod
+    def from_dict(cls, currency: str, data: Dict[str, Any]) -> "PricingRules":
+        exponent(currency)
+        return cls(
+            currency=currency,
+            promotions=tuple(Promotion(**p) for p in data.get("promotions", [])),
+            taxes={country.upper(): TaxRule(**rule) for country, rule in data.get("taxes", {}).items()},
+            shipping={country.upper(): ShippingRule(**rule) for country, rule in data.get("shipping", {}).items()}
+        )
+
+
+# Цены каталога включают НДС 20%; доставка и скидки по умолчанию не настроены
+DEFAULT_RULES = {
+    "RUB": PricingRules("RUB", taxes={ANY_COUNTRY: TaxRule(2000, inclusive=True)}),
+    "USD": PricingRules("USD"),
+    "EUR": PricingRules("EUR"),
+}
+
+
+@dataclass
+class CartLine:
+    product_id: str
+    unit_price: int
+    quantity: int
+    category: Optional[str] = None
+
+
+@dataclass
+class Cart:
+    lines: List[CartLine]
+    currency: str = "RUB"
+    country: str = ""
+    promo_codes: Tuple[str, ...] = ()
+
+
+@dataclass
+class LineQuote:
+    product_id: str
+    subtotal: int
+    discount: int
+    tax: int
+    total: int
+
+
+@dataclass
+class Quote:
+    currency: str
+    lines: List[LineQuote]
+    subtotal: int
+    discount: int
+    shipping: int
+    tax: int
+    total: int
+    promotions: List[str]
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Суммы в основных единицах валюты, как в остальном API"""
+        major = lambda amount: from_minor(amount, self.currency)  # noqa: E731
+        return {
+            "currency": self.currency,
+            "subtotal": major(self.subtotal),
+            "discount": major(self.discount),
+            "shipping": major(self.shipping),
+            "tax": major(self.tax),
+            "total": major(self.total),
+            "promotions": self.promotions,
+            "lines": [
+                {"product_id": line.product_id, "subtotal": major(line.subtotal), "discount": major(line.discount),
+                 "tax": major(line.tax), "total": major(line.total)}
+                for line in self.lines
+            ]
+        }
+
+
+@dataclass
+class BatchQuote:
+    """Результаты price_batch: массивы по корзинам и по строкам (строки корзины i - offsets[i]:offsets[i+1])"""
+    carts: List[Cart]
+    offsets: np.ndarray
+    subtotal: np.ndarray
+    discount: np.ndarray
+    shipping: np.ndarray
+    tax: np.ndarray
+    total: np.ndarray
+    line_subtotal: np.ndarray
+    line_discount: np.ndarray
+    line_tax: np.ndarray
+    line_total: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.carts)
+
+    def quote(self, i: int, engine: "PricingEngine") -> Quote:
+        cart = self.carts[i]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return Quote(
+            currency=cart.currency,
+            lines=[
+                LineQuote(line.product_id, int(self.line_subtotal[j]), int(self.line_discount[j]),
+                          int(self.line_tax[j]), int(self.line_total[j]))
+                for j, line in zip(range(start, end), cart.lines)
+            ],
+            subtotal=int(self.subtotal[i]),
+            discount=int(self.discount[i]),
+            shipping=int(self.shipping[i]),
+            tax=int(self.tax[i]),
+            total=int(self.total[i]),
+            promotions=engine.applied_promotions(cart, int(self.subtotal[i]))
+        )
+
+
+class PricingEngine:
+    def __init__(self, rules: Optional[Dict[str, PricingRules]] = None):
+        self.rules = rules if rules is not None else dict(DEFAULT_RULES)
+
+    @classmethod
+    def from_file(cls, path: str = PRICING_RULES) -> "PricingEngine":
+        if not path:
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        return cls({currency.upper(): PricingRules.from_dict(currency.upper(), rules)
+                    for currency, rules in data.items()})
+
+    def rules_for(self, cart: Cart) -> PricingRules:
+        rules = self.rules.get(cart.currency.upper())
+        if rules is None:
+            raise PricingError(f"Unsupported currency {cart.currency}")
+        unknown = set(cart.promo_codes) - rules.codes
+        if unknown:
+            raise PricingError(f"Unknown promo code: {', '.join(sorted(unknown))}")
+        if not cart.lines:
+            raise PricingError("Cart is empty")
+        return rules
+
+    def applied_promotions(self, cart: Cart, subtotal: int) -> List[str]:
+        rules = self.rules[cart.currency.upper()]
+        return [p.id for p in rules.promotions if p.active(cart.promo_codes, subtotal)]
+
+    # Одна корзина
+
+    def price(self, cart: Cart) -> Quote:
+        rules = self.rules_for(cart)
+        subtotals = [line.unit_price * line.quantity for line in cart.lines]
+        subtotal = sum(subtotals)
+        active = [p for p in rules.promotions if p.active(cart.promo_codes, subtotal)]
+
+        nets = []
+        for line, line_subtotal in zip(cart.lines, subtotals):
+            percent = max((p.percent_bp for p in active
+                           if p.percent_bp and (p.category is None or p.category == line.category)), default=0)
+            nets.append(line_subtotal - round_div(line_subtotal * percent, BP))
+        order_off = min(sum(p.amount_off for p in active), sum(nets))
+        nets = [net - part for net, part in zip(nets, allocate(order_off, nets))]
+        net = sum(nets)
+
+        country = cart.country.upper()
+        tax_rule = rules.tax_for(country)
+        shipping = rules.shipping_for(country).cost(net)
+        line_taxes = [tax_rule.tax(n) for n in nets]
+        tax = sum(line_taxes) + tax_rule.tax(shipping)
+        added = 0 if tax_rule.inclusive else 1
+        return Quote(
+            currency=rules.currency,
+            lines=[
+                LineQuote(line.product_id, s, s - n, t, n + added * t)
+                for line, s, n, t in zip(cart.lines, subtotals, nets, line_taxes)
+            ],
+            subtotal=subtotal,
+            discount=subtotal - net,
+            shipping=shipping,
+            tax=tax,
+            total=net + shipping + added * tax,
+            promotions=[p.id for p in active]
+        )
+
+    # Много корзин
+
+    def price_batch(self, carts: Sequence[Cart]) -> BatchQuote:
+        """Стоимость всех корзин; корзины разных валют считаются по группам"""
+        carts = list(carts)
+        n = len(carts)
+        counts = np.fromiter((len(cart.lines) for cart in carts), dtype=np.int64, count=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        result = BatchQuote(
+            carts, offsets,
+            *(np.zeros(n, dtype=np.int64) for _ in range(5)),
+            *(np.zeros(int(offsets[-1]), dtype=np.int64) for _ in range(4))
+        )
+        groups: Dict[str, List[int]] = {}
+        for i, cart in enumerate(carts):
+            try:
+                self.rules_for(cart)
+            except PricingError as e:
+                raise PricingError(f"Cart {i}: {e}")
+            groups.setdefault(cart.currency.upper(), []).append(i)
+        for currency, indexes in groups.items():
+            self._price_group(self.rules[currency], [carts[i] for i in indexes], np.array(indexes), result)
+        return result
+
+    def _price_group(self, rules: PricingRules, carts: List[Cart], indexes: np.ndarray, result: BatchQuote):
+        n = len(carts)
+        counts = np.fromiter((len(cart.lines) for cart in carts), dtype=np.int64, count=n)
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        line_cart = np.repeat(np.arange(n), counts)
+        lines = [line for cart in carts for line in cart.lines]
+        m = len(lines)
+        price = np.fromiter((line.unit_price for line in lines), dtype=np.int64, count=m)
+        quantity = np.fromiter((line.quantity for line in lines), dtype=np.int64, count=m)
+
+        subtotal = price * quantity
+        cart_subtotal = np.add.reduceat(subtotal, starts)
+
+        # Строки: лучшая процентная скидка из активных акций
+        percent = np.zeros(m, dtype=np.int64)
+        order_off = np.zeros(n, dtype=np.int64)
+        categories = np.array([line.category or "" for line in lines], dtype=object)
+        for promotion in rules.promotions:
+            active = cart_subtotal >= promotion.min_subtotal
+            if promotion.code is not None:
+                active &= np.fromiter((promotion.code in cart.promo_codes for cart in carts), dtype=bool, count=n)
+            if promotion.percent_bp:
+                applies = active[line_cart]
+                if promotion.category is not None:
+                    applies &= categories == promotion.category
+                np.maximum(percent, np.where(applies, promotion.percent_bp, 0), out=percent)
+            if promotion.amount_off:
+                order_off += np.where(active, promotion.amount_off, 0)
+        net = subtotal - (2 * subtotal * percent + BP) // (2 * BP)
+
+        # Заказ: фиксированная скидка по строкам пропорционально сумме
+        cart_net = np.add.reduceat(net, starts)
+        order_off = np.minimum(order_off, cart_net)
+        if order_off.any():
+            net -= self._allocate(order_off, net, cart_net, line_cart, starts)
+            cart_net = np.add.reduceat(net, starts)
+
+        # Доставка и налог по стране корзины
+        # Правила ищутся один раз на страну, корзинам раздаются индексом
+        countries, country = np.unique([cart.country.upper() for cart in carts], return_inverse=True)
+        shipping_rules = [rules.shipping_for(c) for c in countries]
+        fee = np.array([r.fee for r in shipping_rules], dtype=np.int64)[country]
+        free_from = np.array([-1 if r.free_from is None else r.free_from for r in shipping_rules],
+                             dtype=np.int64)[country]
+        shipping = np.where((free_from >= 0) & (cart_net >= free_from), 0, fee)
+
+        tax_rules = [rules.tax_for(c) for c in countries]
+        rate = np.array([r.rate_bp for r in tax_rules], dtype=np.int64)[country]
+        inclusive = np.array([r.inclusive for r in tax_rules], dtype=bool)[country]
+        denominator = np.where(inclusive, BP + rate, BP)
+        line_denominator = denominator[line_cart]
+        line_tax = (2 * net * rate[line_cart] + line_denominator) // (2 * line_denominator)
+        tax = np.add.reduceat(line_tax, starts) + (2 * shipping * rate + denominator) // (2 * denominator)
+        added = (~inclusive).astype(np.int64)
+
+        result.subtotal[indexes] = cart_subtotal
+        result.discount[indexes] = cart_subtotal - cart_net
+        result.shipping[indexes] = shipping
+        result.tax[indexes] = tax
+        result.total[indexes] = cart_net + shipping + added * tax
+        # Строки группы в порядке корзин результата
+        positions = np.arange(m) + np.repeat(result.offsets[indexes] - starts, counts)
+        result.line_subtotal[positions] = subtotal
+        result.line_discount[positions] = subtotal - net
+        result.line_tax[positions] = line_tax
+        result.line_total[positions] = net + added[line_cart] * line_tax
+
+    @staticmethod
+    def _allocate(amount: np.ndarray, weights: np.ndarray, totals: np.ndarray,
+                  line_cart: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        """Векторный аналог shared.money.allocate для всех корзин сразу"""
+        line_amount = amount[line_cart]
+        line_total = np.maximum(totals[line_cart], 1)
+        if int(amount.max()) * int(weights.max(initial=0)) >= 2 ** 62:
+            # Произведение не помещается в int64 - считаем в целых Python
+            line_amount, weights, line_total = (a.astype(object) for a in (line_amount, weights, line_total))
+        parts = (line_amount * weights // line_total).astype(np.int64)
+        remainders = (line_amount * weights % line_total).astype(np.int64)
+        shortfall = amount - np.add.reduceat(parts, starts)
+        # Недостающие единицы - строкам с наибольшими остатками, при равенстве - первым
+        order = np.lexsort((np.arange(len(parts)), -remainders, line_cart))
+        rank = np.arange(len(parts)) - starts[line_cart[order]]
+        parts[order] += rank < shortfall[line_cart[order]]
+        return parts
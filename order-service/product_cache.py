@@ -0,0 +1,290 @@
+"""Локальный снимок каталога (цена, наличие, название) для проверки заказов.
+
+create_order раньше принимал цену и название товара от клиента как есть.
+Запрос в catalog-service на каждый товар добавил бы сетевой вызов в каждый
+заказ, поэтому order-service держит снимок каталога в памяти:
+  * при старте и затем раз в CATALOG_RESYNC_INTERVAL секунд - полная
+    выгрузка GET /products (расхождения с кэшем считаются метрикой drift);
+  * между выгрузками - события catalog.product.updated / .deleted;
+    событие применяется, только если оно новее снимка (updated_at);
+  * промах кэша - один пакетный запрос GET /products/batch?ids=... на все
+    недостающие товары заказа; параллельные промахи по одному товару ждут
+    один запрос, неизвестные товары помнятся CATALOG_NEGATIVE_TTL секунд.
+
+Проверка заказа (validate) занимает микросекунды при попадании в кэш:
+товар существует, в наличии и цена совпадает с каталогом (в минимальных
+единицах CATALOG_CURRENCY). Каталог знает цены только в CATALOG_CURRENCY,
+поэтому позиции заказа в другой валюте отклоняются (unsupported_currency).
+Название и категория товара берутся из каталога. Режим CATALOG_VALIDATION:
+enforce - отклонять заказ, warn - только логировать и считать, off -
+не проверять.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+from prometheus_client import Counter, Gauge, Histogram
+
+from shared.messaging import Event, EventConsumer
+from shared.money import to_minor
+
+CATALOG_SERVICE_URL = os.getenv("CATALOG_SERVICE_URL", "http://catalog-service:5000")
+CATALOG_CURRENCY = os.getenv("CATALOG_CURRENCY", "RUB")
+CATALOG_VALIDATION = os.getenv("CATALOG_VALIDATION", "enforce")
+CATALOG_RESYNC_INTERVAL = float(os.getenv("CATALOG_RESYNC_INTERVAL", "300"))
+CATALOG_NEGATIVE_TTL = float(os.getenv("CATALOG_NEGATIVE_TTL", "30"))
+CATALOG_BATCH_SIZE = int(os.getenv("CATALOG_BATCH_SIZE", "100"))
+CATALOG_TIMEOUT = float(os.getenv("CATALOG_TIMEOUT", "2"))
+
+PRODUCT_UPDATED = "catalog.product.updated"
+PRODUCT_DELETED = "catalog.product.deleted"
+
+catalog_products = Gauge("order_catalog_products", "Products in the local catalog snapshot")
+catalog_sync_age = Gauge("order_catalog_sync_age_seconds", "Seconds since the last full catalog sync")
+catalog_event_age = Gauge("order_catalog_event_age_seconds", "Seconds since the last applied catalog event")
+catalog_event_lag = Histogram("order_catalog_event_lag_seconds", "Delay between a catalog change and its arrival",
+                              buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600))
+catalog_drift = Gauge("order_catalog_sync_drift", "Snapshot entries corrected by the last full sync")
+catalog_lookups = Counter("order_catalog_lookups_total", "Product lookups by result", ["result"])
+catalog_rejections = Counter("order_catalog_rejections_total", "Order items failing catalog checks", ["reason"])
+
+
+class CatalogUnavailable(Exception):
+    pass
+
+
+class CatalogValidationError(Exception):
+    def __init__(self, problems: List[Dict[str, Any]]):
+        super().__init__(f"{len(problems)} order item(s) do not match the catalog")
+        self.problems = problems
+
+
+class ProductSnapshot:
+    __slots__ = ("id", "name", "price", "price_minor", "category", "in_stock", "updated_at")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.id = str(data["id"])
+        self.name = data["name"]
+        self.price = data["price"]
+        self.price_minor = to_minor(data["price"], CATALOG_CURRENCY)
+        self.category = data.get("category")
+        self.in_stock = data.get("in_stock", True)
+        self.updated_at = float(data.get("updated_at") or 0)
+
+    def same(self, other: "ProductSnapshot") -> bool:
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class ProductCache:
+    def __init__(self, base_url: str = CATALOG_SERVICE_URL, mode: str = CATALOG_VALIDATION):
+        self.base_url = base_url
+        self.mode = mode
+        self.products: Dict[str, ProductSnapshot] = {}
+        self._not_found: Dict[str, float] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self.synced_at: Optional[float] = None
+        self.event_at: Optional[float] = None
+        self.stats = {"syncs": 0, "sync_errors": 0, "batch_fetches": 0, "events": 0, "stale_events": 0}
+        catalog_sync_age.set_function(lambda: time.time() - self.synced_at if self.synced_at else -1)
+        catalog_event_age.set_function(lambda: time.time() - self.event_at if self.event_at else -1)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=CATALOG_TIMEOUT)
+        return self._client
+
+    def _put(self, snapshot: ProductSnapshot) -> bool:
+        current = self.products.get(snapshot.id)
+        if current is not None and current.updated_at > snapshot.updated_at:
+            return False
+        self.products[snapshot.id] = snapshot
+        self._not_found.pop(snapshot.id, None)
+        return True
+
+    # Полная выгрузка
+
+    async def sync(self):
+        """Заменить снимок полной выгрузкой каталога; изменения, пришедшие событиями позже, сохраняются"""
+        started = time.time()
+        try:
+            response = await self.client.get("/products")
+            response.raise_for_status()
+            fetched = [ProductSnapshot(p) for p in response.json()["products"]]
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            self.stats["sync_errors"] += 1
+            raise CatalogUnavailable(f"Catalog sync failed: {e}")
+
+        fresh = {p.id: p for p in fetched}
+        drift = 0
+        for product_id, current in list(self.products.items()):
+            # Товар удален в каталоге, а событие об этом потерялось
+            if product_id not in fresh and current.updated_at < started:
+                del self.products[product_id]
+                drift += 1
+        for snapshot in fetched:
+            current = self.products.get(snapshot.id)
+            if current is None or not current.same(snapshot):
+                drift += self._put(snapshot)
+        self.synced_at = time.time()
+        self.stats["syncs"] += 1
+        catalog_drift.set(drift if self.stats["syncs"] > 1 else 0)
+        catalog_products.set(len(self.products))
+
+    # Пакетный запрос при промахе
+
+    async def _fetch(self, product_ids: List[str]):
+        self.stats["batch_fetches"] += 1
+        try:
+            for i in range(0, len(product_ids), CATALOG_BATCH_SIZE):
+                chunk = product_ids[i:i + CATALOG_BATCH_SIZE]
+                response = await self.client.get("/products/batch", params={"ids": ",".join(chunk)})
+                response.raise_for_status()
+                data = response.json()
+                for product in data["products"]:
+                    self._put(ProductSnapshot(product))
+                expires = time.monotonic() + CATALOG_NEGATIVE_TTL
+                for product_id in data["missing"]:
+                    self._not_found[str(product_id)] = expires
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            raise CatalogUnavailable(f"Catalog lookup failed: {e}")
+        finally:
+            catalog_products.set(len(self.products))
+
+    async def lookup(self, product_ids: Iterable[str]) -> Dict[str, Optional[ProductSnapshot]]:
+        """Снимки товаров; None - товара нет в каталоге. CatalogUnavailable, если промах не удалось дозапросить"""
+        result: Dict[str, Optional[ProductSnapshot]] = {}
+        missing = []
+        now = time.monotonic()
+        for product_id in set(product_ids):
+            snapshot = self.products.get(product_id)
+            if snapshot is not None:
+                catalog_lookups.labels("hit").inc()
+                result[product_id] = snapshot
+            elif self._not_found.get(product_id, 0) > now:
+                catalog_lookups.labels("not_found").inc()
+                result[product_id] = None
+            else:
+                catalog_lookups.labels("miss").inc()
+                missing.append(product_id)
+        if not missing:
+            return result
+
+        new = [product_id for product_id in missing if product_id not in self._inflight]
+        if new:
+            task = asyncio.ensure_future(self._fetch(new))
+            for product_id in new:
+                self._inflight[product_id] = task
+            task.add_done_callback(lambda _: [self._inflight.pop(product_id, None) for product_id in new])
+        await asyncio.gather(*{self._inflight[product_id] for product_id in missing if product_id in self._inflight})
+        for product_id in missing:
+            result[product_id] = self.products.get(product_id)
+        return result
+
+    # Проверка заказа
+
+    async def validate(self, items: List[Any], currency: str):
+        """Сверить позиции заказа (OrderItem) с каталогом; название и категория берутся из каталога"""
+        if self.mode == "off":
+            return
+        try:
+            snapshots = await self.lookup(item.product_id for item in items)
+        except CatalogUnavailable as e:
+            if self.mode == "enforce":
+                raise
+            print(f"Order items not checked: {e}")
+            return
+
+        # Курсов у каталога нет: цену в другой валюте сверить не с чем
+        priced = currency.upper() == CATALOG_CURRENCY
+        problems = []
+        for item in items:
+            snapshot = snapshots[item.product_id]
+            if snapshot is None:
+                problems.append({"product_id": item.product_id, "reason": "unknown_product"})
+                continue
+            if not snapshot.in_stock:
+                problems.append({"product_id": item.product_id, "reason": "out_of_stock"})
+            if not priced:
+                problems.append({"product_id": item.product_id, "reason": "unsupported_currency",
+                                 "currency": CATALOG_CURRENCY})
+            elif to_minor(item.price, CATALOG_CURRENCY) != snapshot.price_minor:
+                problems.append({"product_id": item.product_id, "reason": "price_changed", "price": snapshot.price})
+            item.name = snapshot.name
+            if snapshot.category:
+                item.category = snapshot.category
+
+        for problem in problems:
+            catalog_rejections.labels(problem["reason"]).inc()
+        if problems:
+            if self.mode == "enforce":
+                raise CatalogValidationError(problems)
+            print(f"Order items do not match the catalog: {problems}")
+
+    # События каталога
+
+    async def on_event(self, event: Event):
+        payload = event.payload
+        self.stats["events"] += 1
+        catalog_event_lag.observe(max(0.0, time.time() - event.timestamp))
+        if event.routing_key == PRODUCT_UPDATED:
+            applied = self._put(ProductSnapshot(payload))
+        else:
+            product_id = str(payload["id"])
+            current = self.products.get(product_id)
+            applied = current is None or current.updated_at <= float(payload.get("updated_at") or 0)
+            if applied:
+                self.products.pop(product_id, None)
+                self._not_found[product_id] = time.monotonic() + CATALOG_NEGATIVE_TTL
+        if applied:
+            self.event_at = time.time()
+        else:
+            self.stats["stale_events"] += 1
+        catalog_products.set(len(self.products))
+
+    # Фоновая синхронизация
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self):
+        delay = 1.0
+        while True:
+            try:
+                await self.sync()
+                delay = CATALOG_RESYNC_INTERVAL
+            except CatalogUnavailable as e:
+                # Пока каталог недоступен при старте, повторяем чаще
+                print(e)
+                delay = min(CATALOG_RESYNC_INTERVAL, delay * 2) if self.synced_at is None else CATALOG_RESYNC_INTERVAL
+            await asyncio.sleep(delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "products": len(self.products),
+            "not_found": len(self._not_found),
+            "synced_at": self.synced_at,
+            "last_event_at": self.event_at,
+            **self.stats
+        }
+
+
+def catalog_consumer(cache: ProductCache, queue_name: str, **kwargs) -> EventConsumer:
+    consumer = EventConsumer(queue_name, **kwargs)
+    consumer.subscribe(PRODUCT_UPDATED, PRODUCT_DELETED)(cache.on_event)
+    return consumer
@@ -0,0 +1,189 @@
+"""Маршрутизатор запросов к шардам order-service (см. sharding.py).
+
+Не хранит состояния, поэтому сам запускается несколькими uvicorn-воркерами
+на порту сервиса. Запросы проксируются в шарды через unix-сокеты:
+  POST /api/v1/orders                     - шард пользователя из тела заказа
+  /api/v1/orders/user/{user_id}...        - шард пользователя
+  /api/v1/orders/{order_id}...            - шард заказа
+  GET /api/v1/orders?user_id=...          - шард пользователя, без user_id - все шарды
+  GET .../events                          - поток SSE из шарда заказа или пользователя
+                                            передается без буферизации
+  /health                                 - сводка по всем шардам
+  /shards/{shard}/{path}                  - напрямую в шард (метрики, статистика,
+                                            карантин событий шарда)
+Остальные пути обслуживает шард 0.
+"""
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from prometheus_fastapi_instrumentator import Instrumentator
+
+from sharding import ORDER_SHARDS, shard_of, shard_socket
+
+ORDERS_PREFIX = "/api/v1/orders"
+# Заголовки соединения не проксируются
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host", "upgrade"}
+
+app = FastAPI(
+    title="Order Service Router",
+    description="Маршрутизация запросов к шардам сервиса заказов",
+    version="1.0.0",
+    docs_url=None,
+    redoc_url=None
+)
+
+Instrumentator().instrument(app).expose(app)
+
+_clients: List[httpx.AsyncClient] = []
+# Потоки SSE открыты часами: у них отдельные клиенты без лимита соединений и таймаута чтения
+_stream_clients: List[httpx.AsyncClient] = []
+
+
+def route(method: str, path: str, query: Dict[str, str], body: bytes) -> Optional[int]:
+    """Шард для запроса; None - запрос ко всем шардам"""
+    if not path.startswith(ORDERS_PREFIX):
+        return 0
+    parts = path[len(ORDERS_PREFIX):].strip("/").split("/")
+    if parts[0] == "":
+        if method == "POST":
+            try:
+                user_id = json.loads(body).get("user_id")
+            except (ValueError, AttributeError):
+                user_id = None
+            # Невалидное тело отклонит любой шард
+            return shard_of(user_id) if isinstance(user_id, str) else 0
+        user_id = query.get("user_id")
+        return shard_of(user_id) if user_id else None
+    if parts[0] == "user" and len(parts) > 1:
+        return shard_of(parts[1])
+    return shard_of(parts[0])
+
+
+async def forward(shard: int, request: Request, path: str, body: bytes) -> Response:
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+    try:
+        upstream = await _clients[shard].request(
+            request.method, path, params=request.query_params, headers=headers, content=body
+        )
+    except httpx.HTTPError as e:
+        print(f"Shard {shard} unavailable: {e}")
+        raise HTTPException(status_code=503, detail=f"Order shard {shard} unavailable")
+    return Response(
+        content=upstream.content,
+        status_code=upstream.status_code,
+        headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS}
+    )
+
+
+async def forward_stream(shard: int, request: Request, path: str) -> Response:
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+    client = _stream_clients[shard]
+    try:
+        upstream = await client.send(
+            client.build_request("GET", path, params=request.query_params, headers=headers), stream=True
+        )
+    except httpx.HTTPError as e:
+        print(f"Shard {shard} unavailable: {e}")
+        raise HTTPException(status_code=503, detail=f"Order shard {shard} unavailable")
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        status_code=upstream.status_code,
+        headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS},
+        background=BackgroundTask(upstream.aclose)
+    )
+
+
+async def gather_json(request: Request, path: str, params=None) -> List[httpx.Response]:
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+    params = request.query_params if params is None else params
+    responses = await asyncio.gather(
+        *(client.get(path, params=params, headers=headers) for client in _clients),
+        return_exceptions=True
+    )
+    for shard, response in enumerate(responses):
+        if isinstance(response, Exception):
+            print(f"Shard {shard} unavailable: {response}")
+            raise HTTPException(status_code=503, detail=f"Order shard {shard} unavailable")
+    return responses
+
+
+@app.get("/health")
+async def health_check(request: Request):
+    try:
+        responses = await gather_json(request, "/health")
+    except HTTPException as e:
+        return JSONResponse({"status": "unhealthy", "service": "order-service", "error": e.detail}, status_code=503)
+    shards = [response.json() for response in responses]
+    return {
+        "status": "healthy" if all(s.get("status") == "healthy" for s in shards) else "degraded",
+        "service": "order-service",
+        "shards": shards,
+        "order_count": sum(s.get("order_count", 0) for s in shards)
+    }
+
+
+@app.api_route("/shards/{shard}/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def shard_passthrough(shard: int, path: str, request: Request):
+    if not 0 <= shard < ORDER_SHARDS:
+        raise HTTPException(status_code=404, detail="Unknown shard")
+    return await forward(shard, request, "/" + path, await request.body())
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def proxy(path: str, request: Request):
+    path = "/" + path
+    body = await request.body()
+    shard = route(request.method, path, request.query_params, body)
+    if shard is not None:
+        if request.method == "GET" and path.endswith("/events"):
+            return await forward_stream(shard, request, path)
+        return await forward(shard, request, path, body)
+
+    # Список заказов без пользователя: объединяем ответы шардов
+    params = dict(request.query_params)
+    fields = params.get("fields")
+    # Ответы шардов сортируются по created_at, даже если клиент его не запросил
+    extra = bool(fields and fields.strip()) and "created_at" not in [f.strip() for f in fields.split(",")]
+    if extra:
+        params["fields"] = f"{fields},created_at"
+    responses = await gather_json(request, path, params)
+    for response in responses:
+        if response.status_code != 200:
+            return Response(content=response.content, status_code=response.status_code,
+                            media_type=response.headers.get("content-type"))
+    orders = [order for response in responses for order in response.json()]
+    orders.sort(key=lambda order: order["created_at"])
+    limit = int(request.query_params.get("limit", 100))
+    if extra:
+        for order in orders[:limit]:
+            del order["created_at"]
+    return orders[:limit]
+
+
+@app.on_event("startup")
+async def on_startup():
+    for shard in range(ORDER_SHARDS):
+        _clients.append(httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=shard_socket(shard)),
+            base_url="http://order-shard",
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=200)
+        ))
+        _stream_clients.append(httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=shard_socket(shard)),
+            base_url="http://order-shard",
+            timeout=httpx.Timeout(30.0, read=None),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=0)
+        ))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await asyncio.gather(*(client.aclose() for client in _clients + _stream_clients))
+    _clients.clear()
+    _stream_clients.clear()
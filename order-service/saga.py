@@ -0,0 +1,313 @@
+"""Сага заказа: оплата с таймаутом и компенсации.
+
+Шаги саги:
+  payment - ждем payment.succeeded / payment.failed не дольше SAGA_PAYMENT_TIMEOUT;
+            при неуспехе или таймауте заказ отменяется (компенсация cancel:
+            order.cancelled с товарами, по нему освобождается резерв склада);
+  late    - заказ уже отменен, но оплата еще может прийти (окно SAGA_LATE_WINDOW);
+            пришедшая оплата возвращается (компенсация refund);
+  refund  - возврат через payment-service с повторами.
+
+Состояние - компактная запись на заказ (__slots__), таймеры - в хешированном
+колесе: постановка, отмена и срабатывание стоят O(1) независимо от числа
+саг, поэтому миллионы ожидающих заказов не замедляют обработку.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+SAGA_PAYMENT_TIMEOUT = float(os.getenv("SAGA_PAYMENT_TIMEOUT", "900"))
+SAGA_LATE_WINDOW = float(os.getenv("SAGA_LATE_WINDOW", "86400"))
+SAGA_REFUND_ATTEMPTS = int(os.getenv("SAGA_REFUND_ATTEMPTS", "8"))
+SAGA_REFUND_BACKOFF = float(os.getenv("SAGA_REFUND_BACKOFF", "5"))
+SAGA_TICK = float(os.getenv("SAGA_TICK_MS", "1000")) / 1000
+# Оборот колеса - SAGA_WHEEL_SLOTS * SAGA_TICK; таймеры длиннее оборота
+# проходят по колесу несколько раз
+SAGA_WHEEL_SLOTS = int(os.getenv("SAGA_WHEEL_SLOTS", "4096"))
+
+PAYMENT, LATE, REFUND = "payment", "late", "refund"
+STEPS = (PAYMENT, LATE, REFUND)
+
+saga_in_flight = Gauge("order_saga_in_flight", "Sagas waiting in a step", ["step"])
+saga_step_duration = Histogram(
+    "order_saga_step_duration_seconds", "Time spent in a saga step", ["step", "outcome"],
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 86400)
+)
+saga_compensations = Counter("order_saga_compensations_total", "Saga compensations", ["action", "outcome"])
+
+
+class TimingWheel:
+    """Хешированное колесо таймеров с одним обработчиком на все ключи.
+
+    Таймер с задержкой d попадает в ячейку (текущий тик + d/tick) mod slots;
+    на каждом тике просматривается одна ячейка. Ключ может иметь только
+    один таймер: повторная постановка заменяет прежний.
+    """
+
+    def __init__(self, on_expire: Callable[[str], None], tick: float = SAGA_TICK, slots: int = SAGA_WHEEL_SLOTS):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots = slots
+        self._buckets: List[Dict[str, int]] = [{} for _ in range(slots)]
+        self._slot_of: Dict[str, int] = {}
+        self._now = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def schedule(self, key: str, delay: float):
+        self.cancel(key)
+        deadline = self._now + max(int(-(-delay // self.tick)), 1)
+        slot = deadline % self.slots
+        self._buckets[slot][key] = deadline
+        self._slot_of[key] = slot
+
+    def cancel(self, key: str) -> bool:
+        slot = self._slot_of.pop(key, None)
+        if slot is None:
+            return False
+        del self._buckets[slot][key]
+        return True
+
+    def advance(self) -> int:
+        """Следующий тик: вызвать обработчик для истекших таймеров ячейки"""
+        self._now += 1
+        bucket = self._buckets[self._now % self.slots]
+        if not bucket:
+            return 0
+        expired = [key for key, deadline in bucket.items() if deadline <= self._now]
+        for key in expired:
+            del bucket[key]
+            del self._slot_of[key]
+        for key in expired:
+            try:
+                self.on_expire(key)
+            except Exception as e:
+                print(f"Timer handler failed for {key}: {e}")
+        return len(expired)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # Тики отсчитываются от старта, а не от предыдущего тика: пропущенные
+        # при нагрузке тики догоняются, и таймеры не сдвигаются
+        started = time.monotonic()
+        ticks = 0
+        while True:
+            ticks += 1
+            delay = started + ticks * self.tick - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.advance()
+
+
+class SagaState:
+    __slots__ = ("step", "started_at", "step_started_at", "payment_id", "attempts")
+
+    def __init__(self, step: Optional[str], now: float):
+        self.step = step
+        self.started_at = now
+        self.step_started_at = now
+        self.payment_id: Optional[str] = None
+        self.attempts = 0
+
+
+class OrderSagas:
+    """Оркестратор саг заказов.
+
+    cancel_order(order_id, reason) - синхронная компенсация отмены (меняет
+    заказ и пишет order.cancelled в outbox); refund(order_id, payment_id) -
+    асинхронный возврат платежа.
+    """
+
+    def __init__(
+        self,
+        cancel_order: Callable[[str, str], None],
+        refund: Callable[[str, str], Awaitable[None]],
+        payment_timeout: float = SAGA_PAYMENT_TIMEOUT,
+        late_window: float = SAGA_LATE_WINDOW,
+        tick: float = SAGA_TICK,
+        slots: int = SAGA_WHEEL_SLOTS
+    ):
+        self.cancel_order = cancel_order
+        self.refund = refund
+        self.payment_timeout = payment_timeout
+        self.late_window = late_window
+        self.sagas: Dict[str, SagaState] = {}
+        self.wheel = TimingWheel(self._on_timer, tick, slots)
+        self.counts = {step: 0 for step in STEPS}
+        # Дочерние метрики кэшируются: labels() на каждой операции заметно дороже самой операции
+        self._in_flight = {step: saga_in_flight.labels(step) for step in STEPS}
+        self._durations: Dict[tuple, Any] = {}
+        self._tasks: set = set()
+        self.stats = {"started": 0, "completed": 0, "timed_out": 0, "failed": 0, "refunds": 0, "refunds_failed": 0}
+
+    def start(self):
+        self.wheel.start()
+
+    async def stop(self):
+        await self.wheel.stop()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # Переходы между шагами
+
+    def _enter(self, order_id: str, state: SagaState, step: str, timeout: Optional[float]):
+        self._count(state.step, -1)
+        state.step = step
+        state.step_started_at = time.monotonic()
+        self._count(step, 1)
+        if timeout is None:
+            self.wheel.cancel(order_id)
+        else:
+            self.wheel.schedule(order_id, timeout)
+
+    def _finish_step(self, state: SagaState, outcome: str):
+        key = (state.step, outcome)
+        histogram = self._durations.get(key)
+        if histogram is None:
+            histogram = self._durations[key] = saga_step_duration.labels(*key)
+        histogram.observe(time.monotonic() - state.step_started_at)
+
+    def _drop(self, order_id: str):
+        state = self.sagas.pop(order_id, None)
+        if state is not None:
+            self.wheel.cancel(order_id)
+            self._count(state.step, -1)
+
+    def _count(self, step: Optional[str], delta: int):
+        if step is None:
+            return
+        self.counts[step] += delta
+        self._in_flight[step].set(self.counts[step])
+
+    # События заказа и оплаты
+
+    def order_created(self, order_id: str):
+        state = SagaState(None, time.monotonic())
+        self.sagas[order_id] = state
+        self._enter(order_id, state, PAYMENT, self.payment_timeout)
+        self.stats["started"] += 1
+
+    def payment_succeeded(self, order_id: str, payment_id: Optional[str]) -> bool:
+        """True - заказ можно считать оплаченным; False - оплата пришла по
+        отмененному заказу и будет возвращена"""
+        state = self.sagas.get(order_id)
+        if state is None:
+            # Сага уже завершена или заказ создан до перезапуска
+            return True
+        if state.step == PAYMENT:
+            self._finish_step(state, "succeeded")
+            self._drop(order_id)
+            self.stats["completed"] += 1
+            return True
+        if state.step == LATE:
+            self._finish_step(state, "late_payment")
+            self._start_refund(order_id, state, payment_id)
+        return False
+
+    def payment_failed(self, order_id: str, reason: Optional[str] = None):
+        state = self.sagas.get(order_id)
+        if state is not None:
+            if state.step != PAYMENT:
+                # Заказ уже отменен или оплата возвращается
+                return
+            self._finish_step(state, "failed")
+            self._drop(order_id)
+            self.stats["failed"] += 1
+        self._compensate_cancel(order_id, reason or "payment failed")
+
+    def order_cancelled(self, order_id: str, payment_id: Optional[str] = None):
+        """Заказ отменен не сагой (пользователем или администратором)"""
+        state = self.sagas.get(order_id)
+        if state is not None and state.step == PAYMENT:
+            # Оплата может прийти позже - ее нужно будет вернуть
+            self._finish_step(state, "cancelled")
+            self._enter(order_id, state, LATE, self.late_window)
+        elif state is None and payment_id:
+            # Заказ уже оплачен: возвращаем деньги
+            state = SagaState(None, time.monotonic())
+            self.sagas[order_id] = state
+            self._start_refund(order_id, state, payment_id)
+
+    def _on_timer(self, order_id: str):
+        state = self.sagas.get(order_id)
+        if state is None:
+            return
+        if state.step == PAYMENT:
+            self._finish_step(state, "timeout")
+            self.stats["timed_out"] += 1
+            self._enter(order_id, state, LATE, self.late_window)
+            self._compensate_cancel(order_id, "payment timeout")
+        elif state.step == LATE:
+            self._finish_step(state, "expired")
+            self._drop(order_id)
+        elif state.step == REFUND:
+            self._spawn(self._refund(order_id, state))
+
+    # Компенсации
+
+    def _compensate_cancel(self, order_id: str, reason: str):
+        try:
+            self.cancel_order(order_id, reason)
+            saga_compensations.labels("cancel", "succeeded").inc()
+        except Exception as e:
+            saga_compensations.labels("cancel", "failed").inc()
+            print(f"Saga {order_id}: cancel compensation failed: {e}")
+
+    def _start_refund(self, order_id: str, state: SagaState, payment_id: Optional[str]):
+        if not payment_id:
+            print(f"Saga {order_id}: payment without payment_id cannot be refunded")
+            saga_compensations.labels("refund", "skipped").inc()
+            self._drop(order_id)
+            return
+        state.payment_id = payment_id
+        state.attempts = 0
+        self._enter(order_id, state, REFUND, None)
+        self._spawn(self._refund(order_id, state))
+
+    async def _refund(self, order_id: str, state: SagaState):
+        state.attempts += 1
+        try:
+            await self.refund(order_id, state.payment_id)
+        except Exception as e:
+            if state.attempts >= SAGA_REFUND_ATTEMPTS:
+                print(f"Saga {order_id}: refund of {state.payment_id} failed after {state.attempts} attempts: {e}")
+                saga_compensations.labels("refund", "failed").inc()
+                self.stats["refunds_failed"] += 1
+                self._finish_step(state, "failed")
+                self._drop(order_id)
+                return
+            delay = SAGA_REFUND_BACKOFF * 2 ** (state.attempts - 1)
+            print(f"Saga {order_id}: refund attempt {state.attempts} failed, retry in {delay:.1f}s: {e}")
+            self.wheel.schedule(order_id, delay)
+            return
+        saga_compensations.labels("refund", "succeeded").inc()
+        self.stats["refunds"] += 1
+        self._finish_step(state, "succeeded")
+        self._drop(order_id)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": dict(self.counts),
+            "timers": len(self.wheel),
+            "payment_timeout": self.payment_timeout,
+            **self.stats
+        }
@@ -0,0 +1,47 @@
+"""Шардирование order-service по процессам.
+
+Заказы хранятся в памяти процесса, поэтому несколько uvicorn-воркеров с
+общим портом видели бы разные данные. В режиме шардирования (ORDER_SHARDS > 1)
+запускается ORDER_SHARDS процессов приложения, каждый на своем unix-сокете,
+и маршрутизатор (router.py), который принимает запросы на порту сервиса:
+
+  - заказы пользователя живут в шарде shard_of(user_id): туда уходят
+    создание заказа и /api/v1/orders/user/{user_id};
+  - шард генерирует order_id так, что shard_of(order_id) совпадает с его
+    номером, поэтому запросы по order_id маршрутизируются без справочника;
+  - список всех заказов и /health собираются со всех шардов.
+
+У каждого шарда свои outbox, карантин и очередь событий оплаты; событие
+оплаты получают все шарды, обрабатывает только владелец заказа.
+Запуск: python cluster.py (см. там же переменные окружения).
+"""
+import os
+import zlib
+
+ORDER_SHARDS = int(os.getenv("ORDER_SHARDS", "1"))
+ORDER_SHARD = int(os.getenv("ORDER_SHARD", "0"))
+ORDER_SHARD_SOCKET_DIR = os.getenv("ORDER_SHARD_SOCKET_DIR", "data")
+
+
+def shard_of(key: str, shards: int = ORDER_SHARDS) -> int:
+    # crc32 одинаков во всех процессах, в отличие от hash() со случайной солью
+    return zlib.crc32(key.encode()) % shards if shards > 1 else 0
+
+
+def owns(key: str) -> bool:
+    """Ключ принадлежит шарду этого процесса"""
+    return shard_of(key) == ORDER_SHARD
+
+
+def shard_suffix(shard: int = ORDER_SHARD) -> str:
+    return f".shard-{shard}" if ORDER_SHARDS > 1 else ""
+
+
+def shard_path(path: str, shard: int = ORDER_SHARD) -> str:
+    """Файл данных шарда: data/outbox.db -> data/outbox.shard-2.db"""
+    root, ext = os.path.splitext(path)
+    return f"{root}{shard_suffix(shard)}{ext}"
+
+
+def shard_socket(shard: int) -> str:
+    return os.path.join(ORDER_SHARD_SOCKET_DIR, f"shard-{shard}.sock")
@@ -0,0 +1,166 @@
+"""Жизненный цикл заказа: допустимые переходы статусов, версия и история.
+
+Все изменения заказа (API, события оплаты, компенсации саги) проходят через
+transition(): переходы проверяются по таблицам ниже, версия заказа растет
+на каждое изменение, а условное обновление (expected_version, заголовок
+If-Match) отклоняется, если заказ успел измениться. Проверка и запись идут
+без await, поэтому в пределах процесса блокировки не нужны, а между
+репликами и клиентами конфликт решает версия.
+
+История хранится компактно: кортеж (версия, время, статус, статус оплаты,
+инициатор) с номерами статусов вместо строк.
+
+Производные данные (сводки пользователей и т.п.) подписываются на изменения
+через add_listener: слушатель получает вид изменения, заказ и прежние
+значения изменившихся полей.
+"""
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from models import OrderStatus, PaymentStatus
+
+ORDER_TRANSITIONS: Dict[OrderStatus, FrozenSet[OrderStatus]] = {
+    OrderStatus.PENDING: frozenset({OrderStatus.PROCESSING, OrderStatus.CANCELLED}),
+    OrderStatus.PROCESSING: frozenset({OrderStatus.SHIPPED, OrderStatus.CANCELLED, OrderStatus.REFUNDED}),
+    OrderStatus.SHIPPED: frozenset({OrderStatus.DELIVERED, OrderStatus.REFUNDED}),
+    OrderStatus.DELIVERED: frozenset({OrderStatus.REFUNDED}),
+    # Оплата, пришедшая по отмененному заказу, возвращается
+    OrderStatus.CANCELLED: frozenset({OrderStatus.REFUNDED}),
+    OrderStatus.REFUNDED: frozenset(),
+}
+
+PAYMENT_TRANSITIONS: Dict[PaymentStatus, FrozenSet[PaymentStatus]] = {
+    PaymentStatus.PENDING: frozenset({PaymentStatus.PAID, PaymentStatus.FAILED}),
+    PaymentStatus.PAID: frozenset({PaymentStatus.REFUNDED}),
+    PaymentStatus.FAILED: frozenset({PaymentStatus.REFUNDED}),
+    PaymentStatus.REFUNDED: frozenset(),
+}
+
+# Номера статусов для компактной истории
+ORDER_STATUSES: List[OrderStatus] = list(OrderStatus)
+PAYMENT_STATUSES: List[PaymentStatus] = list(PaymentStatus)
+_ORDER_INDEX = {status.value: i for i, status in enumerate(ORDER_STATUSES)}
+_PAYMENT_INDEX = {status.value: i for i, status in enumerate(PAYMENT_STATUSES)}
+
+HistoryEntry = Tuple[int, float, int, int, str]
+
+CREATED, UPDATED, DELETED = "created", "updated", "deleted"
+# (вид изменения, заказ, прежние значения изменившихся полей)
+OrderListener = Callable[[str, Dict[str, Any], Dict[str, Any]], None]
+_listeners: List[OrderListener] = []
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+class VersionConflict(Exception):
+    def __init__(self, expected: int, actual: int):
+        super().__init__(f"Order version is {actual}, expected {expected}")
+        self.expected = expected
+        self.actual = actual
+
+
+def _compile(table: Dict[Any, FrozenSet[Any]]) -> Dict[str, FrozenSet[str]]:
+    # Заказы хранят статусы строками; сравниваем строки без создания Enum
+    return {current.value: frozenset(target.value for target in targets) for current, targets in table.items()}
+
+
+_ORDER_ALLOWED = _compile(ORDER_TRANSITIONS)
+_PAYMENT_ALLOWED = _compile(PAYMENT_TRANSITIONS)
+
+
+def _value(status: Any) -> Optional[str]:
+    return getattr(status, "value", status)
+
+
+def can_transition(allowed: Dict[str, FrozenSet[str]], current: str, target: str) -> bool:
+    return current == target or target in allowed.get(current, frozenset())
+
+
+def add_listener(listener: OrderListener):
+    _listeners.append(listener)
+
+
+def _notify(kind: str, order: Dict[str, Any], before: Dict[str, Any]):
+    for listener in _listeners:
+        try:
+            listener(kind, order, before)
+        except Exception as e:
+            # Производные данные восстанавливаются перестроением, заказ важнее
+            print(f"Order listener {getattr(listener, '__name__', listener)} failed for {order.get('id')}: {e}")
+
+
+def init_order(order: Dict[str, Any], actor: str):
+    """Версия и первая запись истории нового заказа; вызывать, когда заказ сохранен"""
+    order["version"] = 1
+    order["history"] = [_entry(order, actor)]
+    _notify(CREATED, order, {})
+
+
+def remove_order(order: Dict[str, Any]):
+    """Заказ удален из хранилища"""
+    _notify(DELETED, order, {})
+
+
+def _entry(order: Dict[str, Any], actor: str) -> HistoryEntry:
+    return (order["version"], time.time(), _ORDER_INDEX[order["status"]],
+            _PAYMENT_INDEX[order["payment_status"]], actor)
+
+
+def transition(
+    order: Dict[str, Any],
+    actor: str,
+    status: Optional[OrderStatus] = None,
+    payment_status: Optional[PaymentStatus] = None,
+    expected_version: Optional[int] = None,
+    **fields
+) -> bool:
+    """Применить изменения заказа; False - изменений нет (повторная доставка события)"""
+    if expected_version is not None and order["version"] != expected_version:
+        raise VersionConflict(expected_version, order["version"])
+
+    new_status = _value(status) or order["status"]
+    new_payment = _value(payment_status) or order["payment_status"]
+    if not can_transition(_ORDER_ALLOWED, order["status"], new_status):
+        raise InvalidTransition(f"Order status cannot change from {order['status']} to {new_status}")
+    if not can_transition(_PAYMENT_ALLOWED, order["payment_status"], new_payment):
+        raise InvalidTransition(
+            f"Payment status cannot change from {order['payment_status']} to {new_payment}"
+        )
+
+    changed_fields = {k: v for k, v in fields.items() if order.get(k) != v}
+    status_changed = new_status != order["status"] or new_payment != order["payment_status"]
+    if not status_changed and not changed_fields:
+        return False
+
+    before = {k: order.get(k) for k in changed_fields}
+    before["version"] = order["version"]
+    if new_status != order["status"]:
+        before["status"] = order["status"]
+    if new_payment != order["payment_status"]:
+        before["payment_status"] = order["payment_status"]
+
+    order.update(changed_fields)
+    order["status"] = new_status
+    order["payment_status"] = new_payment
+    order["version"] += 1
+    order["updated_at"] = datetime.utcnow().isoformat()
+    if status_changed:
+        order["history"].append(_entry(order, actor))
+    _notify(UPDATED, order, before)
+    return True
+
+
+def render_history(order: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "version": version,
+            "at": at,
+            "status": ORDER_STATUSES[status].value,
+            "payment_status": PAYMENT_STATUSES[payment].value,
+            "actor": actor
+        }
+        for version, at, status, payment, actor in order["history"]
+    ]
@@ -0,0 +1,212 @@
+"""Сводки заказов по пользователям, обновляемые по изменениям заказов.
+
+Сводка пользователя - число заказов, число заказов по статусам, сумма всех
+заказов, фактически оплаченная сумма и время последнего заказа. Раньше ее
+приходилось считать полным просмотром заказов; теперь UserSummaries
+подписан на изменения заказов (state_machine.add_listener) и на каждое
+создание, изменение и удаление вычитает прежний вклад заказа и добавляет
+новый, поэтому чтение сводки стоит O(1).
+
+Суммы хранятся в минимальных единицах валюты заказа (shared.money), чтобы
+сложения и вычитания не копили ошибку округления, и отдельно по валютам:
+заказы в рублях и долларах не складываются. Оплаченная сумма заказа -
+total_amount минус refunded_amount, пока оплата в статусе paid, и 0 в
+остальных случаях.
+
+Время последнего заказа при удалении самого свежего заказа пересчитывается
+по заказам пользователя - это единственный не O(1) случай.
+
+rebuild() пересчитывает все сводки с нуля, check() сравнивает текущие
+сводки с пересчитанными; фоновая проверка раз в SUMMARY_CHECK_INTERVAL
+секунд при расхождении перестраивает сводки.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from models import PaymentStatus
+from shared.money import from_minor, to_minor
+from state_machine import CREATED, DELETED
+
+SUMMARY_CHECK_INTERVAL = float(os.getenv("SUMMARY_CHECK_INTERVAL", "3600"))
+
+summary_users = Gauge("order_summary_users", "Users with an order summary")
+summary_mismatches = Gauge("order_summary_mismatches", "Users whose summary differed from a full recount at the last check")
+summary_rebuilds = Counter("order_summary_rebuilds_total", "Full summary rebuilds", ["reason"])
+
+_PAID = PaymentStatus.PAID.value
+
+# Заказы, созданные до появления валюты у заказа
+DEFAULT_CURRENCY = "RUB"
+
+# Вклад заказа в сводку: (user_id, статус, валюта, сумма, оплачено, created_at)
+Contribution = Tuple[str, str, str, int, int, str]
+
+
+def _minor(amount: Optional[float], currency: str) -> int:
+    return to_minor(amount or 0, currency)
+
+
+def _contribution(order: Dict[str, Any], before: Optional[Dict[str, Any]] = None) -> Contribution:
+    """Вклад заказа; с before - вклад до изменения"""
+    def get(key):
+        return before[key] if before and key in before else order.get(key)
+
+    currency = (get("currency") or DEFAULT_CURRENCY).upper()
+    total = _minor(get("total_amount"), currency)
+    spent = total - _minor(get("refunded_amount"), currency) if get("payment_status") == _PAID else 0
+    return get("user_id"), get("status"), currency, total, spent, get("created_at")
+
+
+class UserSummary:
+    __slots__ = ("orders", "by_status", "total", "spent", "last_order_at")
+
+    def __init__(self):
+        self.orders = 0
+        self.by_status: Dict[str, int] = {}
+        # {валюта: сумма в минимальных единицах}
+        self.total: Dict[str, int] = {}
+        self.spent: Dict[str, int] = {}
+        self.last_order_at: Optional[str] = None
+
+    @staticmethod
+    def _add_to(sums: Dict[str, int], currency: str, value: int):
+        value += sums.get(currency, 0)
+        if value:
+            sums[currency] = value
+        else:
+            sums.pop(currency, None)
+
+    def add(self, status: str, currency: str, total: int, spent: int, created_at: str, sign: int):
+        self.orders += sign
+        count = self.by_status.get(status, 0) + sign
+        if count:
+            self.by_status[status] = count
+        else:
+            self.by_status.pop(status, None)
+        self._add_to(self.total, currency, sign * total)
+        self._add_to(self.spent, currency, sign * spent)
+        if sign > 0 and (self.last_order_at is None or created_at > self.last_order_at):
+            self.last_order_at = created_at
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "order_count": self.orders,
+            "orders_by_status": dict(self.by_status),
+            "total_amount": {currency: from_minor(value, currency) for currency, value in self.total.items()},
+            "total_spent": {currency: from_minor(value, currency) for currency, value in self.spent.items()},
+            "last_order_at": self.last_order_at
+        }
+
+
+class UserSummaries:
+    """Сводки пользователей; orders() - все заказы, источник для пересчета"""
+
+    def __init__(self, orders: Callable[[], Iterable[Dict[str, Any]]]):
+        self.orders = orders
+        self.summaries: Dict[str, UserSummary] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"rebuilds": 0, "checks": 0, "last_mismatches": 0, "last_check_at": None}
+
+    def __call__(self, kind: str, order: Dict[str, Any], before: Dict[str, Any]):
+        """Слушатель изменений заказов (state_machine.add_listener)"""
+        if kind == CREATED:
+            self._apply(_contribution(order), 1)
+        elif kind == DELETED:
+            self._remove(_contribution(order))
+        else:
+            old, new = _contribution(order, before), _contribution(order)
+            if old == new:
+                return
+            if old[0] == new[0] and old[5] == new[5]:
+                # Тот же пользователь и время: last_order_at не меняется
+                self._apply(old, -1)
+            else:
+                self._remove(old)
+            self._apply(new, 1)
+
+    def _apply(self, contribution: Contribution, sign: int) -> UserSummary:
+        user_id, status, currency, total, spent, created_at = contribution
+        summary = self.summaries.get(user_id)
+        if summary is None:
+            summary = self.summaries[user_id] = UserSummary()
+            summary_users.set(len(self.summaries))
+        summary.add(status, currency, total, spent, created_at, sign)
+        return summary
+
+    def _remove(self, contribution: Contribution):
+        summary = self._apply(contribution, -1)
+        user_id, created_at = contribution[0], contribution[5]
+        if summary.orders == 0:
+            del self.summaries[user_id]
+            summary_users.set(len(self.summaries))
+        elif created_at == summary.last_order_at:
+            # Удален самый свежий заказ
+            summary.last_order_at = max(
+                (o["created_at"] for o in self.orders() if o["user_id"] == user_id), default=None
+            )
+
+    def get(self, user_id: str) -> Dict[str, Any]:
+        summary = self.summaries.get(user_id) or UserSummary()
+        return {"user_id": user_id, **summary.as_dict()}
+
+    # Пересчет и проверка
+
+    def _recount(self) -> Dict[str, UserSummary]:
+        summaries: Dict[str, UserSummary] = {}
+        for order in self.orders():
+            user_id, status, currency, total, spent, created_at = _contribution(order)
+            summary = summaries.get(user_id)
+            if summary is None:
+                summary = summaries[user_id] = UserSummary()
+            summary.add(status, currency, total, spent, created_at, 1)
+        return summaries
+
+    def rebuild(self, reason: str = "manual") -> int:
+        """Пересчитать все сводки с нуля; без await, поэтому изменения заказов
+        не вклиниваются между пересчетом и заменой"""
+        self.summaries = self._recount()
+        summary_users.set(len(self.summaries))
+        summary_rebuilds.labels(reason).inc()
+        self.stats["rebuilds"] += 1
+        return len(self.summaries)
+
+    def check(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Пользователи, чьи сводки расходятся с пересчетом (не больше limit)"""
+        expected = self._recount()
+        mismatches = []
+        count = 0
+        for user_id in expected.keys() | self.summaries.keys():
+            want = expected[user_id].as_dict() if user_id in expected else None
+            have = self.summaries[user_id].as_dict() if user_id in self.summaries else None
+            if want != have:
+                count += 1
+                if len(mismatches) < limit:
+                    mismatches.append({"user_id": user_id, "expected": want, "actual": have})
+        summary_mismatches.set(count)
+        self.stats["checks"] += 1
+        self.stats["last_mismatches"] = count
+        self.stats["last_check_at"] = time.time()
+        return mismatches
+
+    def start(self, interval: float = SUMMARY_CHECK_INTERVAL):
+        if interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            mismatches = self.check(limit=5)
+            if mismatches:
+                print(f"Order summaries diverged for {self.stats['last_mismatches']} users "
+                      f"(e.g. {mismatches[0]}), rebuilding")
+                self.rebuild("check")
@@ -1,12 +1,31 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import uuid
 import time
 import asyncio
+import os
+import random
+import json
+from urllib.parse import parse_qsl
 from pydantic import BaseModel, Field
 from enum import Enum
 
+from payment_worker import PaymentPipeline, EventBatchPublisher, OrderEventsConsumer
+from payment_gateways import StripeGateway, YooMoneyGateway
+from payment_store import PaymentRepository, PaymentNotFound
+from refunds import RefundEngine, RefundError, RefundJobRegistry, REFUNDABLE_STATUSES, REFUND_JOB_CONCURRENCY
+from webhooks import (
+    WebhookProcessor, WebhookSignatureError, STRIPE_WEBHOOK_SECRET, YOOMONEY_NOTIFICATION_SECRET,
+    WEBHOOK_ALLOW_UNSIGNED, verify_stripe_signature, verify_yoomoney_signature
+)
+from grpc_server import PaymentServicer, create_server, register_in_consul, deregister_from_consul
+from shared.authz import Permission, requires
+from shared.dead_letters import QuarantineStore, dead_letter_router
+from shared.resilience import breaker_status, get_breaker
+from prometheus_fastapi_instrumentator import Instrumentator
+
 # Модели (упрощенные)
 class PaymentMethod(str, Enum):
     CARD = "card"
@@ -21,6 +40,19 @@ class PaymentCreate(BaseModel):
     payment_method: PaymentMethod = Field(..., description="Метод оплаты")
     description: Optional[str] = None
 
+class RefundCreate(BaseModel):
+    amount: Optional[float] = Field(None, gt=0, description="Сумма возврата; по умолчанию весь остаток")
+    reason: Optional[str] = None
+
+class RefundJobCreate(BaseModel):
+    payment_ids: Optional[List[str]] = Field(None, description="Платежи для возврата")
+    start: Optional[float] = Field(None, description="Начало окна, unix time (если нет payment_ids)")
+    end: Optional[float] = Field(None, description="Конец окна, unix time")
+    gateway: Optional[str] = Field(None, description="Только платежи этого шлюза")
+    amount: Optional[float] = Field(None, gt=0, description="Сумма возврата на платеж; по умолчанию весь остаток")
+    reason: Optional[str] = None
+    concurrency: int = Field(default=REFUND_JOB_CONCURRENCY, ge=1, le=256)
+
 class PaymentResponse(BaseModel):
     payment_id: str
     status: str
@@ -40,13 +72,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+Instrumentator().instrument(app).expose(app)
+
 # Имитация базы данных
-payments_db = {}
+payments_db = PaymentRepository()
+
+# Параметры имитации шлюза для нагрузочного тестирования
+STUB_GATEWAY_LATENCY_MS = float(os.getenv("STUB_GATEWAY_LATENCY_MS", "0"))
+STUB_GATEWAY_FAILURE_RATE = float(os.getenv("STUB_GATEWAY_FAILURE_RATE", "0"))
 
 # Заглушка для платежных шлюзов
 class StubPaymentGateway:
-    async def create_payment(self, payment_data: PaymentCreate) -> Dict[str, Any]:
+    def __init__(self, latency_ms: float = STUB_GATEWAY_LATENCY_MS, failure_rate: float = STUB_GATEWAY_FAILURE_RATE):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+
+    async def create_payment(self, payment_data: PaymentCreate, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         """Создание фиктивного платежа"""
+        if self.latency_ms:
+            # Разброс ±50%, чтобы ответы не приходили синхронно
+            await asyncio.sleep(self.latency_ms * random.uniform(0.5, 1.5) / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise Exception("Simulated gateway failure")
+
         payment_id = str(uuid.uuid4())
         
         # Генерируем фиктивные данные в зависимости от метода оплаты
@@ -77,31 +125,73 @@ class StubPaymentGateway:
         return response
     
     async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
-        """Получение фиктивного статуса"""
-        # Проверяем, есть ли платеж в нашей "базе"
-        if payment_id in payments_db:
-            return payments_db[payment_id]
-        
-        # Иначе возвращаем фиктивный статус
-        return {
-            "payment_id": payment_id,
-            "status": "succeeded",
-            "message": "Payment completed successfully (stub)",
-            "timestamp": time.time()
-        }
+        """Статус платежа из хранилища; неизвестный id - PaymentNotFound"""
+        return payments_db.require(payment_id)
     
-    async def refund_payment(self, payment_id: str, amount: Optional[float] = None) -> Dict[str, Any]:
-        """Фиктивный возврат платежа"""
+    async def refund_payment(
+        self,
+        payment_id: str,
+        amount: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+        currency: str = "RUB"
+    ) -> Dict[str, Any]:
+        """Фиктивный возврат платежа; без amount возвращается вся сумма платежа"""
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms * random.uniform(0.5, 1.5) / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise Exception("Simulated gateway failure")
         return {
-            "refund_id": f"re_{uuid.uuid4().hex[:8]}",
+            "refund_id": idempotency_key or f"re_{uuid.uuid4().hex[:8]}",
             "status": "succeeded",
-            "amount": amount or 100.0,
+            "amount": amount if amount is not None else payments_db.require(payment_id)["amount"],
             "message": "Refund processed successfully (stub)"
         }
 
 # Инициализируем заглушку
 stub_gateway = StubPaymentGateway()
 
+# Реальные адаптеры доступны по имени (например, GET /{payment_id}/status?gateway=stripe)
+gateways = {
+    "stub": stub_gateway,
+    "stripe": StripeGateway(),
+    "yoomoney": YooMoneyGateway()
+}
+
+def payment_from_order_event(payload: Dict[str, Any]) -> PaymentCreate:
+    """Платеж по событию order.created"""
+    return PaymentCreate(
+        order_id=payload["order_id"],
+        user_id=payload["user_id"],
+        amount=payload["total_amount"],
+        currency=payload.get("currency") or "RUB",
+        payment_method=payload.get("payment_method", PaymentMethod.CARD),
+        description=f"Order {payload['order_id']}"
+    )
+
+def payment_from_grpc_request(request) -> PaymentCreate:
+    """Платеж по gRPC PaymentRequest"""
+    return PaymentCreate(
+        order_id=request.order_id,
+        user_id=request.user_id,
+        amount=request.amount,
+        currency=request.currency or "RUB",
+        payment_method=request.payment_method or PaymentMethod.CARD
+    )
+
+payment_events = EventBatchPublisher()
+payment_pipeline = PaymentPipeline(gateways, payments_db, payment_events)
+refund_engine = RefundEngine(payments_db, gateways, payment_events)
+refund_jobs = RefundJobRegistry(refund_engine)
+webhook_processor = WebhookProcessor(payments_db, payment_events)
+replay_tasks = set()
+# order.created, которые не удалось превратить в платеж
+quarantine = QuarantineStore()
+order_events_consumer = OrderEventsConsumer(payment_pipeline, payment_events, payment_from_order_event, quarantine)
+app.include_router(dead_letter_router(quarantine, order_events_consumer.consumer))
+# gRPC-сервер создается при старте, внутри event loop uvicorn
+grpc_server = None
+consul_service_id = None
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -113,7 +203,14 @@ async def root():
             "health": "GET /health",
             "create": "POST /create",
             "status": "GET /{payment_id}/status",
-            "refund": "POST /{payment_id}/refund"
+            "refund": "POST /{payment_id}/refund",
+            "refund_jobs": "POST /refunds/jobs, GET /refunds/jobs/{job_id}",
+            "by_order": "GET /by-order/{order_id}",
+            "by_user": "GET /by-user/{user_id}",
+            "reconciliation": "GET /reconciliation?start=&end=",
+            "webhooks": "POST /webhooks/stripe, POST /webhooks/yoomoney",
+            "webhook_replay": "POST /webhooks/replay?from_seq=&to_seq=&rate=",
+            "grpc": "PaymentService on port 50051"
         }
     }
 
@@ -124,6 +221,9 @@ async def health_check():
         "status": "healthy",
         "service": "payment-service-stub",
         "timestamp": time.time(),
+        "queue_depth": payment_pipeline.queue_depth,
+        "webhook_queue_depth": webhook_processor.queue_depth,
+        "payments": len(payments_db),
         "note": "This is a stub service for testing"
     }
 
@@ -133,18 +233,17 @@ async def create_payment(payment_data: PaymentCreate):
     Создание фиктивного платежа
     """
     try:
-        # Используем заглушку вместо реального шлюза
-        result = await stub_gateway.create_payment(payment_data)
+        # Платеж проходит через тот же конвейер, что и события order.created
+        record = await payment_pipeline.process(payment_data)
+        result = {k: v for k, v in record.items() if k not in ("order_id", "user_id", "gateway", "timestamp", "description", "error", "history")}
         
-        # Сохраняем в "базу"
-        payments_db[result.get("payment_id", str(uuid.uuid4()))] = {
-            **result,
-            "order_id": payment_data.order_id,
-            "user_id": payment_data.user_id,
-            "gateway": "stub",
-            "timestamp": time.time(),
-            "description": payment_data.description
-        }
+        if record["status"] == "failed":
+            return {
+                "success": False,
+                "error": record["error"],
+                "payment_id": record["payment_id"],
+                "message": "Payment creation failed in stub"
+            }
         
         return {
             "success": True,
@@ -160,18 +259,67 @@ async def create_payment(payment_data: PaymentCreate):
             "message": "Payment creation failed in stub"
         }
 
+@app.get("/by-order/{order_id}")
+async def get_payments_by_order(order_id: str):
+    """Все платежи заказа"""
+    payments = payments_db.by_order(order_id)
+    return {"order_id": order_id, "payments": payments, "total": len(payments)}
+
+@app.get("/by-user/{user_id}")
+async def get_payments_by_user(
+    user_id: str,
+    status: Optional[str] = Query(None, description="Фильтр по статусу"),
+    limit: int = Query(100, ge=1, le=1000, description="Лимит результатов")
+):
+    """Платежи пользователя, новые первыми"""
+    payments = payments_db.by_user(user_id, status=status, limit=limit)
+    return {"user_id": user_id, "payments": payments, "total": len(payments)}
+
+@app.get("/reconciliation")
+async def reconciliation(
+    start: float = Query(..., description="Начало окна, unix time"),
+    end: float = Query(..., description="Конец окна (не включая), unix time"),
+    status: Optional[str] = Query(None, description="Фильтр по статусу")
+):
+    """Платежи за окно времени в формате NDJSON, потоком"""
+    async def rows():
+        chunk = []
+        for record in payments_db.iter_window(start, end, status=status):
+            chunk.append(json.dumps(record))
+            if len(chunk) >= 500:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+@app.get("/circuit-breaker/status")
+async def circuit_breaker_status():
+    """
+    Текущее состояние circuit breaker'ов и bulkhead'ов шлюзов
+    """
+    breakers = breaker_status()
+    return {
+        "circuit_breakers": breakers,
+        "total": len(breakers)
+    }
+
 @app.get("/{payment_id}/status")
 async def get_payment_status(payment_id: str, gateway: str = "stub"):
     """
     Получение статуса фиктивного платежа
     """
+    if gateway not in gateways:
+        raise HTTPException(status_code=400, detail=f"Unknown gateway: {gateway}")
     try:
-        result = await stub_gateway.get_payment_status(payment_id)
+        result = await get_breaker(f"gateway.{gateway}").call(gateways[gateway].get_payment_status, payment_id)
         return {
             "success": True,
             "status": result,
-            "source": "stub_gateway"
+            "source": f"{gateway}_gateway"
         }
+    except PaymentNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         return {
             "success": False,
@@ -180,69 +328,183 @@ async def get_payment_status(payment_id: str, gateway: str = "stub"):
         }
 
 @app.post("/{payment_id}/refund")
-async def refund_payment(payment_id: str, amount: Optional[float] = None):
+async def refund_payment(
+    payment_id: str,
+    refund_data: Optional[RefundCreate] = None,
+    amount: Optional[float] = Query(None, gt=0, description="Сумма возврата (прежний способ); тело запроса важнее")
+):
     """
-    Фиктивный возврат платежа
+    Возврат платежа: полный или частичный в пределах остатка
     """
+    refund_data = refund_data or RefundCreate()
+    # Старые клиенты передают сумму параметром ?amount= - без нее вернулся бы весь остаток
+    if refund_data.amount is None and amount is not None:
+        refund_data.amount = amount
     try:
-        result = await stub_gateway.refund_payment(payment_id, amount)
-        return {
-            "success": True,
-            "refund": result,
-            "message": "Refund processed (stub)"
-        }
+        result = await refund_engine.refund(payment_id, refund_data.amount, refund_data.reason)
+    except PaymentNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RefundError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         return {
             "success": False,
             "error": str(e),
-            "message": "Refund failed in stub"
+            "message": "Refund failed"
         }
+    record = payments_db.require(payment_id)
+    return {
+        "success": True,
+        "refund": result,
+        "payment_status": record["status"],
+        "refunded_amount": record["refunded_amount"],
+        "refundable_amount": refund_engine.refundable_amount(record),
+        "message": "Refund processed"
+    }
 
-@app.get("/circuit-breaker/status")
-async def circuit_breaker_status():
+# Массовый возврат двигает деньги по многим платежам: только с правом process:payments
+@app.post("/refunds/jobs", status_code=202, dependencies=[Depends(requires(Permission.PROCESS_PAYMENTS))])
+async def create_refund_job(job_data: RefundJobCreate):
     """
-    Заглушка для Circuit Breaker статуса
+    Массовый возврат: по списку платежей или по всем оплаченным за окно времени
     """
-    return {
-        "circuit_breakers": [
-            {
-                "name": "create_payment",
-                "state": "CLOSED",
-                "failure_count": 0,
-                "open_until": None
-            },
-            {
-                "name": "get_status",
-                "state": "CLOSED",
-                "failure_count": 0,
-                "open_until": None
-            }
-        ],
-        "note": "Circuit breakers are disabled in stub mode",
-        "total": 2
-    }
+    if job_data.payment_ids:
+        payment_ids = job_data.payment_ids
+    elif job_data.start is not None and job_data.end is not None:
+        payment_ids = [
+            record["payment_id"]
+            for status in REFUNDABLE_STATUSES
+            for record in payments_db.iter_window(job_data.start, job_data.end, status=status)
+            if job_data.gateway is None or record["gateway"] == job_data.gateway
+        ]
+    else:
+        raise HTTPException(status_code=400, detail="Either payment_ids or start/end is required")
+
+    job = refund_jobs.submit(
+        payment_ids,
+        amount=job_data.amount,
+        reason=job_data.reason,
+        concurrency=job_data.concurrency
+    )
+    return job.snapshot()
+
+@app.get("/refunds/jobs", dependencies=[Depends(requires(Permission.PROCESS_PAYMENTS))])
+async def list_refund_jobs():
+    return {"jobs": [job.snapshot() for job in refund_jobs.all()]}
+
+@app.get("/refunds/jobs/{job_id}", dependencies=[Depends(requires(Permission.PROCESS_PAYMENTS))])
+async def get_refund_job(job_id: str):
+    """Прогресс массового возврата"""
+    job = refund_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Refund job not found")
+    return job.snapshot()
 
-# Вебхуки-заглушки
+@app.delete("/refunds/jobs/{job_id}", dependencies=[Depends(requires(Permission.PROCESS_PAYMENTS))])
+async def cancel_refund_job(job_id: str):
+    job = refund_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Refund job not found")
+    job.cancel()
+    return {"job_id": job_id, "cancelled": True}
+
+# Вебхуки: проверка подписи, дедупликация и запись в журнал; статусы меняют воркеры
 @app.post("/webhooks/stripe")
 async def stripe_webhook(request: Request):
-    """Заглушка для Stripe webhook"""
-    return {
-        "success": True,
-        "message": "Webhook received (stub)",
-        "event": "payment_intent.succeeded",
-        "note": "This is a stub - no real webhook processing"
-    }
+    """Stripe webhook"""
+    payload = await request.body()
+    if STRIPE_WEBHOOK_SECRET:
+        try:
+            verify_stripe_signature(payload, request.headers.get("Stripe-Signature", ""), STRIPE_WEBHOOK_SECRET)
+        except WebhookSignatureError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif not WEBHOOK_ALLOW_UNSIGNED:
+        raise HTTPException(status_code=503, detail="STRIPE_WEBHOOK_SECRET is not configured")
+    try:
+        event_id = json.loads(payload)["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid Stripe event")
+
+    accepted = await webhook_processor.ingest("stripe", event_id, payload.decode())
+    return {"received": True, "duplicate": not accepted}
 
 @app.post("/webhooks/yoomoney")
 async def yoomoney_webhook(request: Request):
-    """Заглушка для YooMoney webhook"""
+    """YooMoney HTTP-уведомление (application/x-www-form-urlencoded)"""
+    body = (await request.body()).decode()
+    form = dict(parse_qsl(body))
+    if YOOMONEY_NOTIFICATION_SECRET:
+        try:
+            verify_yoomoney_signature(form, YOOMONEY_NOTIFICATION_SECRET)
+        except WebhookSignatureError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif not WEBHOOK_ALLOW_UNSIGNED:
+        raise HTTPException(status_code=503, detail="YOOMONEY_NOTIFICATION_SECRET is not configured")
+    if not form.get("operation_id"):
+        raise HTTPException(status_code=400, detail="Invalid YooMoney notification")
+
+    accepted = await webhook_processor.ingest("yoomoney", form["operation_id"], body)
+    return {"received": True, "duplicate": not accepted}
+
+@app.post("/webhooks/replay")
+async def replay_webhooks(
+    from_seq: int = Query(0, ge=0, description="Первая запись журнала"),
+    to_seq: Optional[int] = Query(None, ge=0, description="Последняя запись журнала (включительно)"),
+    rate: Optional[float] = Query(None, gt=0, description="Событий в секунду")
+):
+    """Повторно применить вебхуки из журнала (дедупликация не применяется)"""
+    async def run():
+        try:
+            count = await webhook_processor.replay(from_seq, to_seq, rate)
+            print(f"Webhook replay finished: {count} events")
+        except Exception as e:
+            print(f"Webhook replay failed: {e}")
+
+    task = asyncio.create_task(run())
+    replay_tasks.add(task)
+    task.add_done_callback(replay_tasks.discard)
+    return {"scheduled": True, "from_seq": from_seq, "to_seq": to_seq, "last_seq": webhook_processor.journal.last_seq}
+
+@app.get("/webhooks/stats")
+async def webhook_stats():
     return {
-        "success": True,
-        "message": "Webhook received (stub)",
-        "event": "p2p-incoming",
-        "note": "This is a stub - no real webhook processing"
+        **webhook_processor.stats,
+        "queue_depth": webhook_processor.queue_depth,
+        "last_seq": webhook_processor.journal.last_seq,
+        "processed_seq": webhook_processor.journal.processed_seq
     }
 
+@app.on_event("startup")
+async def on_startup():
+    global grpc_server, consul_service_id
+    payment_pipeline.start()
+    await webhook_processor.start()
+    if not STRIPE_WEBHOOK_SECRET or not YOOMONEY_NOTIFICATION_SECRET:
+        if WEBHOOK_ALLOW_UNSIGNED:
+            print("Warning: webhook secret not set, unsigned webhooks are accepted (WEBHOOK_ALLOW_UNSIGNED=1)")
+        else:
+            print("Warning: webhook secret not set, webhooks of that provider are rejected")
+    grpc_server = create_server(PaymentServicer(payment_pipeline, gateways, payment_from_grpc_request))
+    await grpc_server.start()
+    consul_service_id = await register_in_consul()
+    await asyncio.sleep(2)
+    await order_events_consumer.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if consul_service_id:
+        await deregister_from_consul(consul_service_id)
+    if grpc_server:
+        await grpc_server.stop(grace=5)
+    await order_events_consumer.stop()
+    quarantine.close()
+    refund_jobs.cancel_all()
+    await webhook_processor.stop()
+    await payment_pipeline.stop()
+    for gateway in gateways.values():
+        if hasattr(gateway, "close"):
+            await gateway.close()
+
 if __name__ == "__main__":
     import uvicorn
     print("=" * 50)
@@ -0,0 +1,113 @@
+"""Сравнение пропускной способности: REST POST /create, unary ProcessPayment и поток ProcessPayments.
+
+Запуск при работающем payment-service:
+    python benchmark_grpc.py --rest http://localhost:5003 --grpc localhost:50051 -n 5000 -c 100
+"""
+import argparse
+import asyncio
+import time
+
+import grpc
+import httpx
+
+import payment_service_pb2
+import payment_service_pb2_grpc
+
+
+def report(name: str, count: int, errors: int, elapsed: float):
+    print(f"{name:<22} {count:>7} req  {elapsed:>7.2f}s  {count / elapsed:>9.0f} req/s  errors: {errors}")
+
+
+async def bench_rest(url: str, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async with httpx.AsyncClient(
+        base_url=url,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        timeout=30.0
+    ) as client:
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                response = await client.post("/create", json={
+                    "order_id": f"bench_rest_{i}",
+                    "user_id": "bench",
+                    "amount": 100.0,
+                    "currency": "RUB",
+                    "payment_method": "card"
+                })
+                if response.status_code != 200 or not response.json().get("success"):
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(total)])
+        report("REST /create", total, errors, time.perf_counter() - started)
+
+
+def payment_request(prefix: str, i: int) -> payment_service_pb2.PaymentRequest:
+    return payment_service_pb2.PaymentRequest(
+        order_id=f"{prefix}_{i}",
+        amount=100.0,
+        currency="RUB",
+        payment_method="card",
+        user_id="bench"
+    )
+
+
+async def bench_unary(target: str, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async with grpc.aio.insecure_channel(target) as channel:
+        stub = payment_service_pb2_grpc.PaymentServiceStub(channel)
+
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                response = await stub.ProcessPayment(payment_request("bench_unary", i), timeout=30)
+                if response.status == "failed":
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(total)])
+        report("gRPC unary", total, errors, time.perf_counter() - started)
+
+
+async def bench_stream(target: str, total: int):
+    errors = 0
+    received = 0
+
+    async with grpc.aio.insecure_channel(target) as channel:
+        stub = payment_service_pb2_grpc.PaymentServiceStub(channel)
+
+        async def requests():
+            for i in range(total):
+                yield payment_request("bench_stream", i)
+
+        started = time.perf_counter()
+        async for response in stub.ProcessPayments(requests()):
+            received += 1
+            if response.status == "failed":
+                errors += 1
+        report("gRPC stream", received, errors, time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rest", default="http://localhost:5003")
+    parser.add_argument("--grpc", default="localhost:50051")
+    parser.add_argument("-n", "--requests", type=int, default=5000)
+    parser.add_argument("-c", "--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"Payments: {args.requests}, concurrency: {args.concurrency}")
+    print("=" * 60)
+    await bench_rest(args.rest, args.requests, args.concurrency)
+    await bench_unary(args.grpc, args.requests, args.concurrency)
+    await bench_stream(args.grpc, args.requests)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
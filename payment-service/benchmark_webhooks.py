@@ -0,0 +1,207 @@
+"""Нагрузочный тест приема вебхуков: скрипт играет роль провайдеров.
+
+Создает пачку ожидающих оплаты платежей через POST /create, затем с заданной
+частотой (открытая модель нагрузки) шлет подписанные уведомления Stripe и
+YooMoney по этим платежам, часть - повторно, как делают провайдеры.
+Отчет: время ответа вебхука (p50/p95/p99), достигнутая частота и время,
+за которое воркеры разобрали журнал.
+
+Секреты должны совпадать с переменными окружения сервиса:
+    STRIPE_WEBHOOK_SECRET=whsec_test YOOMONEY_NOTIFICATION_SECRET=ym_test \\
+        python benchmark_webhooks.py --url http://localhost:5003 --rate 5000 --duration 10 --processes 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import time
+import uuid
+from urllib.parse import urlencode
+
+import httpx
+
+from webhooks import sign_stripe_payload, yoomoney_hash
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def create_payments(url: str, count: int, concurrency: int = 100):
+    """Платежи YooMoney остаются в статусе pending до уведомления"""
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=30.0) as client:
+        async def one(i: int):
+            async with semaphore:
+                response = await client.post("/create", json={
+                    "order_id": f"bench_webhook_{i}",
+                    "user_id": "bench",
+                    "amount": 100.0,
+                    "currency": "RUB",
+                    "payment_method": "yoomoney"
+                })
+                return response.json()["payment_data"]["payment_id"]
+        return await asyncio.gather(*[one(i) for i in range(count)])
+
+
+def stripe_webhook(payment_id: str, secret: str):
+    body = json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": "payment_intent.succeeded",
+        "data": {"object": {"id": payment_id, "object": "payment_intent"}}
+    }).encode()
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["Stripe-Signature"] = sign_stripe_payload(body, secret)
+    return "/webhooks/stripe", body, headers
+
+
+def yoomoney_webhook(payment_id: str, secret: str):
+    form = {
+        "notification_type": "p2p-incoming",
+        "operation_id": uuid.uuid4().hex,
+        "amount": "100.00",
+        "currency": "643",
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "sender": "41001000040",
+        "codepro": "false",
+        "label": payment_id
+    }
+    form["sha1_hash"] = yoomoney_hash(form, secret)
+    return "/webhooks/yoomoney", urlencode(form).encode(), {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+async def send_load(url: str, payment_ids, rate: float, duration: float, max_in_flight: int,
+                    duplicate_rate: float, stripe_secret: str, yoomoney_secret: str) -> dict:
+    latencies = []
+    statuses = {}
+    duplicates = 0
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    sent = []
+
+    async with httpx.AsyncClient(
+        base_url=url,
+        limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+        timeout=30.0
+    ) as client:
+        async def send(path: str, body: bytes, headers: dict):
+            nonlocal duplicates
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, content=body, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code == 200 and response.json().get("duplicate"):
+                    duplicates += 1
+            except Exception as e:
+                statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+            finally:
+                in_flight.release()
+
+        total = int(rate * duration)
+        started = time.monotonic()
+        for i in range(total):
+            delay = started + i / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if sent and random.random() < duplicate_rate:
+                # Провайдер повторяет уже доставленное событие
+                request = random.choice(sent)
+            else:
+                payment_id = random.choice(payment_ids)
+                if random.random() < 0.5:
+                    request = stripe_webhook(payment_id, stripe_secret)
+                else:
+                    request = yoomoney_webhook(payment_id, yoomoney_secret)
+                if len(sent) < 10000:
+                    sent.append(request)
+            await in_flight.acquire()
+            task = asyncio.create_task(send(*request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+
+    return {"latencies": latencies, "statuses": statuses, "duplicates": duplicates, "elapsed": elapsed}
+
+
+def run_worker(kwargs: dict) -> dict:
+    return asyncio.run(send_load(**kwargs))
+
+
+async def wait_drained(url: str, timeout: float = 120.0) -> dict:
+    async with httpx.AsyncClient(base_url=url, timeout=10.0) as client:
+        deadline = time.monotonic() + timeout
+        while True:
+            stats = (await client.get("/webhooks/stats")).json()
+            if stats["processed_seq"] >= stats["last_seq"] or time.monotonic() > deadline:
+                return stats
+            await asyncio.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5003")
+    parser.add_argument("--rate", type=float, default=5000, help="вебхуков в секунду суммарно")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--payments", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=4, help="процессов-отправителей")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="на процесс")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    stripe_secret = os.getenv("STRIPE_WEBHOOK_SECRET", "")
+    yoomoney_secret = os.getenv("YOOMONEY_NOTIFICATION_SECRET", "")
+
+    print(f"Creating {args.payments} pending payments...")
+    payment_ids = asyncio.run(create_payments(args.url, args.payments))
+    before = asyncio.run(wait_drained(args.url))
+
+    print("=" * 60)
+    print(f"Webhooks: {args.rate:.0f}/s for {args.duration:.0f}s, {args.processes} processes")
+    print("=" * 60)
+    worker_args = [{
+        "url": args.url,
+        "payment_ids": payment_ids,
+        "rate": args.rate / args.processes,
+        "duration": args.duration,
+        "max_in_flight": args.max_in_flight,
+        "duplicate_rate": args.duplicate_rate,
+        "stripe_secret": stripe_secret,
+        "yoomoney_secret": yoomoney_secret
+    } for _ in range(args.processes)]
+
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.map(run_worker, worker_args)
+    sent_at = time.monotonic()
+    after = asyncio.run(wait_drained(args.url))
+    drain = time.monotonic() - sent_at
+
+    latencies = [latency for result in results for latency in result["latencies"]]
+    statuses = {}
+    for result in results:
+        for status, count in result["statuses"].items():
+            statuses[status] = statuses.get(status, 0) + count
+    elapsed = max(result["elapsed"] for result in results)
+
+    print(f"sent:        {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s)")
+    print(f"responses:   {statuses}")
+    print(f"duplicates:  {sum(result['duplicates'] for result in results)}")
+    print(f"ack latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms  "
+          f"max {max(latencies, default=0) * 1000:.1f}ms")
+    print(f"processing:  applied {after['applied'] - before['applied']}, "
+          f"ignored {after['ignored'] - before['ignored']}, "
+          f"drained {drain:.2f}s after last ack, backlog {after['last_seq'] - after['processed_seq']}")
+
+
+if __name__ == "__main__":
+    main()
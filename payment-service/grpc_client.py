@@ -1,94 +1,399 @@
+"""Асинхронный клиент PaymentService.
+
+- пул каналов: несколько HTTP/2-соединений на каждую реплику payment-service;
+- реплики берутся из Consul (PAYMENT_SERVICE_DISCOVERY=consul) или из
+  PAYMENT_SERVICE_GRPC_HOST/PORT, запрос уходит на менее загруженную из двух
+  случайных реплик, реплики с разомкнутым breaker'ом пропускаются;
+- keepalive и retry-политика для идемпотентных методов задаются service config;
+- таймаут вызова не превышает оставшийся бюджет входящего запроса
+  (shared.deadlines);
+- submit_payment мультиплексирует платежи в долгоживущий поток ProcessPayments.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
 import grpc
+import httpx
+
 import payment_service_pb2
 import payment_service_pb2_grpc
-import time
-import random
-from circuitbreaker import circuit
+from shared.deadlines import remaining_budget
+from shared.resilience import CircuitState, get_breaker
+
+CONSUL_ADDR = os.getenv("CONSUL_ADDR", "http://consul:8500")
+PAYMENT_SERVICE_DISCOVERY = os.getenv("PAYMENT_SERVICE_DISCOVERY", "static")
+PAYMENT_SERVICE_NAME = os.getenv("PAYMENT_SERVICE_NAME", "payment-service-grpc")
+PAYMENT_SERVICE_GRPC_HOST = os.getenv("PAYMENT_SERVICE_GRPC_HOST", "localhost")
+PAYMENT_SERVICE_GRPC_PORT = int(os.getenv("PAYMENT_SERVICE_GRPC_PORT", "50051"))
+CHANNELS_PER_ENDPOINT = int(os.getenv("PAYMENT_GRPC_CHANNELS", "2"))
+DEFAULT_TIMEOUT = float(os.getenv("PAYMENT_GRPC_TIMEOUT", "5"))
+DISCOVERY_INTERVAL = float(os.getenv("PAYMENT_GRPC_DISCOVERY_INTERVAL", "30"))
+# Сколько вызовов одновременно отправляется на одну реплику; остальные ждут в пределах своего таймаута
+MAX_IN_FLIGHT_PER_ENDPOINT = int(os.getenv("PAYMENT_GRPC_MAX_IN_FLIGHT", "1000"))
+
+_SERVICE = "payment.PaymentService"
+
+# Повторяются только идемпотентные чтения; ProcessPayment не повторяется,
+# иначе при потере ответа платеж может быть создан дважды
+SERVICE_CONFIG = json.dumps({
+    "methodConfig": [
+        {
+            "name": [
+                {"service": _SERVICE, "method": "GetPaymentStatus"},
+                {"service": _SERVICE, "method": "GetPaymentStatuses"}
+            ],
+            "retryPolicy": {
+                "maxAttempts": 3,
+                "initialBackoff": "0.05s",
+                "maxBackoff": "0.5s",
+                "backoffMultiplier": 2,
+                "retryableStatusCodes": ["UNAVAILABLE"]
+            }
+        }
+    ]
+})
+
+CHANNEL_OPTIONS = [
+    ("grpc.service_config", SERVICE_CONFIG),
+    ("grpc.enable_retries", 1),
+    ("grpc.keepalive_time_ms", 20000),
+    ("grpc.keepalive_timeout_ms", 5000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    # Иначе каналы с одинаковыми настройками делят одно TCP-соединение и пул теряет смысл
+    ("grpc.use_local_subchannel_pool", 1),
+]
+
+
+class PaymentServiceUnavailable(Exception):
+    """Платежный сервис не ответил; статус платежа неизвестен"""
+
+
+class PaymentDeadlineExceeded(PaymentServiceUnavailable):
+    pass
+
+
+class _PaymentStream:
+    """Долгоживущий поток ProcessPayments; ответы сопоставляются с запросами по order_id"""
+
+    def __init__(self, stub):
+        self.stub = stub
+        self._outbox: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _requests(self):
+        while True:
+            request = await self._outbox.get()
+            if request is None:
+                return
+            yield request
+
+    async def _run(self):
+        try:
+            async for response in self.stub.ProcessPayments(self._requests()):
+                waiters = self._pending.get(response.order_id)
+                if not waiters:
+                    continue
+                future = waiters.pop(0)
+                if not waiters:
+                    del self._pending[response.order_id]
+                if not future.done():
+                    future.set_result(response)
+        except Exception as e:
+            error = PaymentServiceUnavailable(f"Payment stream failed: {e}")
+        else:
+            error = PaymentServiceUnavailable("Payment stream closed")
+        finally:
+            self._task = None
+        # Новые запросы откроют поток заново, ожидающие получают ошибку
+        pending, self._pending = self._pending, {}
+        self._outbox = asyncio.Queue()
+        for waiters in pending.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def submit(self, request, timeout: float):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(request.order_id, []).append(future)
+        await self._outbox.put(request)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            waiters = self._pending.get(request.order_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            raise
+
+    async def close(self):
+        if self._task:
+            await self._outbox.put(None)
+            self._task.cancel()
+
+
+class _Endpoint:
+    def __init__(self, address: str, channels: int):
+        self.address = address
+        self.channels = [grpc.aio.insecure_channel(address, options=CHANNEL_OPTIONS) for _ in range(channels)]
+        self.stubs = [payment_service_pb2_grpc.PaymentServiceStub(channel) for channel in self.channels]
+        self.streams = [_PaymentStream(stub) for stub in self.stubs]
+        self.breaker = get_breaker(
+            f"grpc.{address}",
+            minimum_calls=3,
+            failure_rate_threshold=0.5,
+            open_timeout=10,
+            max_concurrent=MAX_IN_FLIGHT_PER_ENDPOINT
+        )
+        self.in_flight = 0
+        self._next = 0
+
+    def index(self) -> int:
+        self._next = (self._next + 1) % len(self.stubs)
+        return self._next
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != CircuitState.OPEN
+
+    async def close(self):
+        for stream in self.streams:
+            await stream.close()
+        for channel in self.channels:
+            await channel.close()
+
 
 class PaymentClient:
-    def __init__(self, host='localhost', port=50051):
-        self.channel = grpc.insecure_channel(f'{host}:{port}')
-        self.stub = payment_service_pb2_grpc.PaymentServiceStub(self.channel)
-    
-    @circuit(failure_threshold=3, recovery_timeout=10)
-    def process_payment(self, order_id, amount, user_id="user_123"):
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        discovery: str = PAYMENT_SERVICE_DISCOVERY,
+        channels_per_endpoint: int = CHANNELS_PER_ENDPOINT,
+        default_timeout: float = DEFAULT_TIMEOUT
+    ):
+        # Явно указанный адрес отключает поиск реплик
+        self.discovery = "static" if host else discovery
+        self.static_address = f"{host or PAYMENT_SERVICE_GRPC_HOST}:{port or PAYMENT_SERVICE_GRPC_PORT}"
+        self.channels_per_endpoint = channels_per_endpoint
+        self.default_timeout = default_timeout
+        self.endpoints: Dict[str, _Endpoint] = {}
+        self._discovery_task: Optional[asyncio.Task] = None
+        self._discovered_at = 0.0
+
+    async def start(self):
+        await self._refresh()
+        if self.discovery == "consul" and self._discovery_task is None:
+            self._discovery_task = asyncio.create_task(self._discovery_loop())
+
+    async def close(self):
+        if self._discovery_task:
+            self._discovery_task.cancel()
+            self._discovery_task = None
+        for endpoint in self.endpoints.values():
+            await endpoint.close()
+        self.endpoints = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # --- обнаружение реплик ---
+
+    async def _discover(self) -> List[str]:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(
+                f"{CONSUL_ADDR}/v1/health/service/{PAYMENT_SERVICE_NAME}",
+                params={"passing": "true"},
+                timeout=3.0
+            )
+            response.raise_for_status()
+        return [
+            f"{entry['Service']['Address'] or entry['Node']['Address']}:{entry['Service']['Port']}"
+            for entry in response.json()
+        ]
+
+    async def _refresh(self):
+        addresses = [self.static_address]
+        if self.discovery == "consul":
+            try:
+                addresses = await self._discover() or addresses
+            except Exception as e:
+                print(f"Payment service discovery failed, using {self.static_address}: {e}")
+
+        for address in addresses:
+            if address not in self.endpoints:
+                self.endpoints[address] = _Endpoint(address, self.channels_per_endpoint)
+        for address in list(self.endpoints):
+            if address not in addresses:
+                await self.endpoints.pop(address).close()
+        self._discovered_at = time.monotonic()
+
+    async def _discovery_loop(self):
+        while True:
+            await asyncio.sleep(DISCOVERY_INTERVAL)
+            await self._refresh()
+
+    def _pick(self) -> _Endpoint:
+        if not self.endpoints:
+            raise PaymentServiceUnavailable("Payment client is not started")
+        candidates = [e for e in self.endpoints.values() if e.available] or list(self.endpoints.values())
+        if len(candidates) == 1:
+            return candidates[0]
+        # "Power of two choices": менее загруженная из двух случайных реплик
+        a, b = random.sample(candidates, 2)
+        return a if a.in_flight <= b.in_flight else b
+
+    def _timeout(self, timeout: Optional[float]) -> float:
+        timeout = timeout or self.default_timeout
+        budget = remaining_budget()
+        if budget is not None:
+            timeout = min(timeout, budget)
+        if timeout <= 0:
+            raise PaymentDeadlineExceeded("Request budget exhausted before calling payment-service")
+        return timeout
+
+    async def _call(self, invoke, timeout: Optional[float]):
+        timeout = self._timeout(timeout)
+        endpoint = self._pick()
+        endpoint.in_flight += 1
         try:
-            request = payment_service_pb2.PaymentRequest(
-                order_id=order_id,
-                amount=amount,
-                currency="USD",
-                payment_method="card",
-                user_id=user_id
+            # Общий таймаут включает и ожидание места в bulkhead
+            return await asyncio.wait_for(
+                endpoint.breaker.call(invoke, endpoint, endpoint.index(), timeout),
+                timeout
             )
-            response = self.stub.ProcessPayment(request, timeout=5)
-            return response
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+                raise PaymentDeadlineExceeded(e.details())
+            raise PaymentServiceUnavailable(f"{e.code().name}: {e.details()}")
+        except asyncio.TimeoutError:
+            raise PaymentDeadlineExceeded(f"No response from {endpoint.address} in {timeout:.2f}s")
+        except PaymentServiceUnavailable:
+            raise
         except Exception as e:
-            print(f"gRPC call failed: {e}")
-            # Fallback response
-            return payment_service_pb2.PaymentResponse(
-                payment_id="",
-                status="processing",
-                message="Payment service unavailable, using fallback",
-                gateway="fallback"
-            )
-    
-    def get_status(self, payment_id, gateway="stripe"):
-        request = payment_service_pb2.PaymentStatusRequest(
-            payment_id=payment_id,
-            gateway=gateway
+            raise PaymentServiceUnavailable(str(e))
+        finally:
+            endpoint.in_flight -= 1
+
+    # --- API ---
+
+    @staticmethod
+    def _payment_request(order_id, amount, user_id, currency, payment_method):
+        return payment_service_pb2.PaymentRequest(
+            order_id=order_id,
+            amount=amount,
+            currency=currency,
+            payment_method=payment_method,
+            user_id=user_id
+        )
+
+    async def process_payment(self, order_id, amount, user_id="user_123", currency="RUB",
+                              payment_method="card", timeout: Optional[float] = None):
+        """Unary ProcessPayment; при недоступности сервиса - PaymentServiceUnavailable"""
+        request = self._payment_request(order_id, amount, user_id, currency, payment_method)
+        return await self._call(
+            lambda endpoint, i, t: endpoint.stubs[i].ProcessPayment(request, timeout=t),
+            timeout
+        )
+
+    async def submit_payment(self, order_id, amount, user_id="user_123", currency="RUB",
+                             payment_method="card", timeout: Optional[float] = None):
+        """То же, что process_payment, но через общий поток ProcessPayments"""
+        request = self._payment_request(order_id, amount, user_id, currency, payment_method)
+        return await self._call(
+            lambda endpoint, i, t: endpoint.streams[i].submit(request, t),
+            timeout
         )
-        return self.stub.GetPaymentStatus(request, timeout=5)
 
-def test_circuit_breaker():
+    async def get_status(self, payment_id, gateway="stub", timeout: Optional[float] = None):
+        request = payment_service_pb2.PaymentStatusRequest(payment_id=payment_id, gateway=gateway)
+        return await self._call(
+            lambda endpoint, i, t: endpoint.stubs[i].GetPaymentStatus(request, timeout=t),
+            timeout
+        )
+
+    async def get_statuses(self, payment_ids: List[str], gateway="stub", timeout: Optional[float] = None):
+        request = payment_service_pb2.PaymentStatusBatchRequest(requests=[
+            payment_service_pb2.PaymentStatusRequest(payment_id=payment_id, gateway=gateway)
+            for payment_id in payment_ids
+        ])
+        response = await self._call(
+            lambda endpoint, i, t: endpoint.stubs[i].GetPaymentStatuses(request, timeout=t),
+            timeout
+        )
+        return list(response.statuses)
+
+async def test_circuit_breaker():
     """Тестирование Circuit Breaker через gRPC"""
-    client = PaymentClient()
-    
-    print("Testing gRPC with Circuit Breaker...")
-    print("=" * 60)
-    
-    success = 0
-    fallback = 0
-    
-    # Симулируем сбои для тестирования Circuit Breaker
-    for i in range(20):
-        try:
-            response = client.process_payment(f"order_{i}", 100.0 + i*10)
-            
-            if response.gateway == "fallback":
-                fallback += 1
-                print(f"Request {i}: FALLBACK - {response.message}")
-            else:
+    async with PaymentClient(host='localhost', port=50051) as client:
+        print("Testing gRPC with Circuit Breaker...")
+        print("=" * 60)
+
+        success = 0
+        unavailable = 0
+
+        for i in range(20):
+            try:
+                response = await client.process_payment(f"order_{i}", 100.0 + i*10)
                 success += 1
                 print(f"Request {i}: SUCCESS - {response.status} via {response.gateway}")
-                
-        except Exception as e:
-            print(f"Request {i}: EXCEPTION - {str(e)}")
-        
-        time.sleep(0.5)
-    
-    print("=" * 60)
-    print(f"Results: {success} successes, {fallback} fallbacks")
-    print(f"Circuit Breaker triggered: {fallback > 0}")
-
-def simulate_service_outage():
+            except PaymentServiceUnavailable as e:
+                unavailable += 1
+                print(f"Request {i}: UNAVAILABLE - {e}")
+
+            await asyncio.sleep(0.5)
+
+        print("=" * 60)
+        print(f"Results: {success} successes, {unavailable} unavailable")
+        for endpoint in client.endpoints.values():
+            print(f"Breaker state: {endpoint.breaker.snapshot()}")
+
+async def test_streaming(count=1000):
+    """Пачка платежей через общий поток"""
+    async with PaymentClient(host='localhost', port=50051) as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(
+            *[client.submit_payment(f"stream_{i}", 10.0) for i in range(count)],
+            return_exceptions=True
+        )
+        elapsed = time.perf_counter() - started
+        failed = sum(isinstance(r, Exception) for r in responses)
+        print(f"\nStreamed {count} payments in {elapsed:.2f}s ({count / elapsed:.0f}/s), errors: {failed}")
+
+async def simulate_service_outage():
     """Симуляция полной недоступности сервиса"""
     print("\n=== Simulating service outage ===")
     print("Expecting Circuit Breaker to open after multiple failures")
-    
-    client = PaymentClient(host='localhost', port=9999)  # Неверный порт
-    
-    for i in range(10):
-        response = client.process_payment(f"outage_{i}", 50.0)
-        print(f"Outage test {i}: {response.status} - {response.message}")
-        time.sleep(0.3)
+
+    async with PaymentClient(host='localhost', port=9999) as client:  # Неверный порт
+        endpoint = next(iter(client.endpoints.values()))
+        for i in range(10):
+            try:
+                await client.process_payment(f"outage_{i}", 50.0, timeout=1)
+            except PaymentServiceUnavailable as e:
+                print(f"Outage test {i}: {type(e).__name__} - {e} [{endpoint.breaker.state.value}]")
+            await asyncio.sleep(0.3)
 
 if __name__ == "__main__":
     # Даем сервису время на запуск
     print("Waiting for service to start...")
     time.sleep(5)
-    
+
     # Тест нормальной работы
-    test_circuit_breaker()
-    
+    asyncio.run(test_circuit_breaker())
+
+    # Поток платежей
+    asyncio.run(test_streaming())
+
     # Тест с недоступным сервисом
-    simulate_service_outage()
\ No newline at end of file
+    asyncio.run(simulate_service_outage())
@@ -0,0 +1,186 @@
+"""gRPC-сервер PaymentService на grpc.aio.
+
+Работает в том же event loop, что и FastAPI, и использует те же конвейер
+платежей, хранилище и шлюзы, поэтому REST и gRPC видят одни и те же данные.
+"""
+import asyncio
+import os
+import socket
+from typing import Any, Callable, Dict, Optional
+
+import grpc
+import httpx
+
+import payment_service_pb2
+import payment_service_pb2_grpc
+from payment_worker import PaymentPipeline
+from shared.resilience import get_breaker
+
+GRPC_PORT = int(os.getenv("GRPC_PORT", "50051"))
+# Сколько платежей одного потока ProcessPayments обрабатывается одновременно
+STREAM_MAX_IN_FLIGHT = int(os.getenv("GRPC_STREAM_MAX_IN_FLIGHT", "256"))
+
+CONSUL_ADDR = os.getenv("CONSUL_ADDR", "http://consul:8500")
+PAYMENT_SERVICE_NAME = os.getenv("PAYMENT_SERVICE_NAME", "payment-service-grpc")
+
+
+class PaymentServicer(payment_service_pb2_grpc.PaymentServiceServicer):
+    def __init__(self, pipeline: PaymentPipeline, gateways: Dict[str, Any], payment_factory: Callable):
+        self.pipeline = pipeline
+        self.gateways = gateways
+        self.payment_factory = payment_factory
+
+    async def _process(self, request) -> payment_service_pb2.PaymentResponse:
+        try:
+            payment_data = self.payment_factory(request)
+        except Exception as e:
+            return payment_service_pb2.PaymentResponse(
+                status="failed",
+                message=f"Invalid payment request: {e}",
+                order_id=request.order_id
+            )
+
+        record = await self.pipeline.process(payment_data)
+        return payment_service_pb2.PaymentResponse(
+            payment_id=record["payment_id"],
+            status=record["status"],
+            message=record["error"] or "Payment processed",
+            gateway=record["gateway"],
+            order_id=record["order_id"]
+        )
+
+    async def _status(self, request) -> payment_service_pb2.PaymentStatusResponse:
+        gateway = request.gateway or "stub"
+        if gateway not in self.gateways:
+            return payment_service_pb2.PaymentStatusResponse(
+                payment_id=request.payment_id,
+                status="unknown",
+                message=f"Unknown gateway: {gateway}"
+            )
+        try:
+            result = await get_breaker(f"gateway.{gateway}").call(
+                self.gateways[gateway].get_payment_status, request.payment_id
+            )
+        except Exception as e:
+            return payment_service_pb2.PaymentStatusResponse(
+                payment_id=request.payment_id,
+                status="unknown",
+                message=str(e)
+            )
+        return payment_service_pb2.PaymentStatusResponse(
+            payment_id=request.payment_id,
+            status=result.get("status", "unknown"),
+            message=result.get("message") or result.get("error") or ""
+        )
+
+    async def ProcessPayment(self, request, context):
+        return await self._process(request)
+
+    async def GetPaymentStatus(self, request, context):
+        return await self._status(request)
+
+    async def ProcessPayments(self, request_iterator, context):
+        # Ответы, ожидающие отправки, тоже занимают место в in_flight: клиент,
+        # который не читает ответы, останавливает чтение своих запросов
+        results: asyncio.Queue = asyncio.Queue(maxsize=STREAM_MAX_IN_FLIGHT)
+        in_flight = asyncio.Semaphore(STREAM_MAX_IN_FLIGHT)
+        done = object()
+
+        async def handle(request):
+            try:
+                try:
+                    response = await self._process(request)
+                except Exception as e:
+                    response = payment_service_pb2.PaymentResponse(
+                        status="failed",
+                        message=str(e),
+                        order_id=request.order_id
+                    )
+                await results.put(response)
+            finally:
+                in_flight.release()
+
+        # Задачи запросов потока: при отмене вызова или обрыве потока они
+        # отменяются вместе с чтением, а не остаются ждать места в results
+        tasks = set()
+
+        async def read():
+            try:
+                async for request in request_iterator:
+                    # Чтение потока останавливается, пока не освободится место,
+                    # что дает клиенту обратное давление через flow control HTTP/2
+                    await in_flight.acquire()
+                    task = asyncio.create_task(handle(request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+            except Exception as e:
+                print(f"ProcessPayments stream aborted: {e}")
+            await results.put(done)
+
+        reader = asyncio.create_task(read())
+        try:
+            while True:
+                response = await results.get()
+                if response is done:
+                    break
+                yield response
+        finally:
+            reader.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(reader, *tasks, return_exceptions=True)
+
+    async def GetPaymentStatuses(self, request, context):
+        statuses = await asyncio.gather(*[self._status(r) for r in request.requests])
+        return payment_service_pb2.PaymentStatusBatchResponse(statuses=statuses)
+
+
+def create_server(servicer: PaymentServicer, port: int = GRPC_PORT) -> grpc.aio.Server:
+    server = grpc.aio.server(options=[
+        ("grpc.max_concurrent_streams", 1000),
+        ("grpc.keepalive_time_ms", 30000),
+        ("grpc.keepalive_permit_without_calls", 1),
+        # Клиенты пингуют каждые 20s (grpc_client.CHANNEL_OPTIONS); без этого
+        # сервер считает такие пинги слишком частыми и закрывает соединение
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+        ("grpc.http2.max_ping_strikes", 0),
+    ])
+    payment_service_pb2_grpc.add_PaymentServiceServicer_to_server(servicer, server)
+    server.add_insecure_port(f"[::]:{port}")
+    return server
+
+
+async def register_in_consul(port: int = GRPC_PORT) -> Optional[str]:
+    """Зарегистрировать gRPC-порт этой реплики в Consul, чтобы клиенты могли балансировать нагрузку"""
+    hostname = socket.gethostname()
+    service_id = f"{PAYMENT_SERVICE_NAME}-{hostname}"
+    try:
+        address = socket.gethostbyname(hostname)
+        async with httpx.AsyncClient() as client:
+            response = await client.put(f"{CONSUL_ADDR}/v1/agent/service/register", json={
+                "ID": service_id,
+                "Name": PAYMENT_SERVICE_NAME,
+                "Address": address,
+                "Port": port,
+                "Check": {
+                    "TCP": f"{address}:{port}",
+                    "Interval": "10s",
+                    "DeregisterCriticalServiceAfter": "1m"
+                }
+            }, timeout=5.0)
+            response.raise_for_status()
+        print(f"Registered {service_id} ({address}:{port}) in Consul")
+        return service_id
+    except Exception as e:
+        print(f"Could not register in Consul: {e}")
+        return None
+
+
+async def deregister_from_consul(service_id: str):
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.put(f"{CONSUL_ADDR}/v1/agent/service/deregister/{service_id}", timeout=5.0)
+    except Exception as e:
+        print(f"Could not deregister from Consul: {e}")
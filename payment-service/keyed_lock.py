@@ -0,0 +1,46 @@
+"""Блокировки по ключу (платеж, заказ) для сервиса платежей."""
+import asyncio
+from typing import Dict
+
+
+class KeyedLock:
+    """asyncio.Lock на ключ; блокировка удаляется, когда ее никто не держит и не ждет"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def __call__(self, key: str) -> "_KeyedLockContext":
+        return _KeyedLockContext(self, key)
+
+
+class _KeyedLockContext:
+    def __init__(self, owner: KeyedLock, key: str):
+        self.owner = owner
+        self.key = key
+
+    async def __aenter__(self):
+        owner = self.owner
+        lock = owner._locks.get(self.key)
+        if lock is None:
+            lock = owner._locks[self.key] = asyncio.Lock()
+        owner._users[self.key] = owner._users.get(self.key, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_user()
+            raise
+
+    async def __aexit__(self, *exc):
+        self.owner._locks[self.key].release()
+        self._release_user()
+
+    def _release_user(self):
+        owner = self.owner
+        owner._users[self.key] -= 1
+        if not owner._users[self.key]:
+            del owner._users[self.key]
+            del owner._locks[self.key]
@@ -0,0 +1,133 @@
+"""Локальная заглушка API Stripe и YooMoney для проверки адаптеров из payment_gateways.py.
+
+Запуск:
+    uvicorn mock_providers:app --port 12111
+    STRIPE_API_BASE=http://localhost:12111 YOOMONEY_API_BASE=http://localhost:12111 YOOMONEY_TOKEN=test ...
+
+MOCK_LATENCY_MS и MOCK_ERROR_RATE добавляют задержку и ответы 503,
+чтобы проверить таймауты и повторы.
+"""
+import asyncio
+import os
+import random
+import time
+import uuid
+from typing import Dict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MOCK_LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "0"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+
+app = FastAPI(title="Mock payment providers")
+
+payment_intents: Dict[str, dict] = {}
+# Ответы по Idempotency-Key, как у настоящего Stripe
+idempotent_responses: Dict[str, dict] = {}
+# label -> операция YooMoney
+operations: Dict[str, dict] = {}
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    if MOCK_LATENCY_MS:
+        await asyncio.sleep(MOCK_LATENCY_MS / 1000)
+    if MOCK_ERROR_RATE and random.random() < MOCK_ERROR_RATE:
+        return JSONResponse({"error": {"message": "Injected failure"}}, status_code=503)
+    return await call_next(request)
+
+
+def _idempotent(request: Request, build):
+    key = request.headers.get("Idempotency-Key")
+    if key and key in idempotent_responses:
+        return idempotent_responses[key]
+    response = build()
+    if key:
+        idempotent_responses[key] = response
+    return response
+
+
+def _metadata(form) -> Dict[str, str]:
+    return {k[len("metadata["):-1]: v for k, v in form.items() if k.startswith("metadata[")}
+
+
+@app.post("/v1/payment_intents")
+async def create_payment_intent(request: Request):
+    form = await request.form()
+
+    def build():
+        intent_id = f"pi_{uuid.uuid4().hex[:24]}"
+        intent = {
+            "id": intent_id,
+            "object": "payment_intent",
+            "client_secret": f"{intent_id}_secret_{uuid.uuid4().hex[:8]}",
+            "amount": int(form["amount"]),
+            "amount_refunded": 0,
+            "currency": form["currency"],
+            "status": "succeeded",
+            "description": form.get("description"),
+            "metadata": _metadata(form),
+            "created": int(time.time())
+        }
+        payment_intents[intent_id] = intent
+        return intent
+
+    return _idempotent(request, build)
+
+
+@app.get("/v1/payment_intents/{intent_id}")
+async def retrieve_payment_intent(intent_id: str):
+    intent = payment_intents.get(intent_id)
+    if not intent:
+        return JSONResponse({"error": {"message": f"No such payment_intent: '{intent_id}'"}}, status_code=404)
+    return intent
+
+
+@app.post("/v1/refunds")
+async def create_refund(request: Request):
+    form = await request.form()
+    intent = payment_intents.get(form.get("payment_intent"))
+    if not intent:
+        return JSONResponse({"error": {"message": "No such payment_intent"}}, status_code=404)
+
+    amount = int(form.get("amount", intent["amount"] - intent["amount_refunded"]))
+    if amount > intent["amount"] - intent["amount_refunded"]:
+        return JSONResponse({"error": {"message": "Refund amount exceeds charge"}}, status_code=400)
+
+    def build():
+        intent["amount_refunded"] += amount
+        return {
+            "id": f"re_{uuid.uuid4().hex[:24]}",
+            "object": "refund",
+            "amount": amount,
+            "payment_intent": intent["id"],
+            "status": "succeeded"
+        }
+
+    return _idempotent(request, build)
+
+
+@app.post("/api/operation-history")
+async def operation_history(request: Request):
+    form = await request.form()
+    operation = operations.get(form.get("label"))
+    return {"operations": [operation] if operation else []}
+
+
+@app.post("/mock/yoomoney/{label}/pay")
+async def simulate_yoomoney_payment(label: str, amount: float = 100.0):
+    """Отметить платеж YooMoney как оплаченный"""
+    operations[label] = {
+        "operation_id": uuid.uuid4().hex,
+        "status": "success",
+        "amount": amount,
+        "label": label,
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+    return operations[label]
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=12111)
@@ -1,79 +1,196 @@
-import stripe
+import asyncio
+import random
 import uuid
 from typing import Dict, Any, Optional
 import os
+
+import httpx
+
 from models import PaymentCreate
+from shared.money import from_minor, to_minor
+
+# Повторяемые ответы провайдера: перегрузка и временные ошибки
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class GatewayError(Exception):
+    pass
+
+
+class HTTPGateway:
+    """Базовый адаптер: общий keep-alive пул на провайдера, лимит параллелизма,
+    таймауты и повторы с jitter для идемпотентных запросов"""
+
+    name = "http"
+
+    def __init__(
+        self,
+        base_url: str,
+        headers: Optional[Dict[str, str]] = None,
+        max_connections: int = 50,
+        concurrency: int = 50,
+        timeout: float = 10.0,
+        connect_timeout: float = 3.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.1,
+        backoff_max: float = 2.0
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout)
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    async def close(self):
+        await self.client.aclose()
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": равномерно от 0 до экспоненциальной границы
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _request(self, method: str, url: str, idempotent: bool, **kwargs) -> Dict[str, Any]:
+        attempts = self.max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                async with self._semaphore:
+                    response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                # Таймауты и обрывы соединения; неидемпотентный запрос мог дойти до провайдера
+                if last:
+                    raise GatewayError(f"{self.name} request failed: {e!r}")
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            if response.status_code in RETRYABLE_STATUS_CODES and not last:
+                retry_after = response.headers.get("Retry-After")
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else self._backoff(attempt)
+                await asyncio.sleep(min(delay, self.backoff_max))
+                continue
+
+            if response.status_code >= 400:
+                raise GatewayError(f"{self.name} error {response.status_code}: {response.text}")
+            return response.json()
+
+        raise GatewayError(f"{self.name} request failed after {attempts} attempts")
+
+
+def _to_minor(amount: float, currency: str) -> int:
+    # Stripe принимает суммы в минимальных единицах валюты (у JPY их нет, у KWD - тысячные)
+    return to_minor(amount, currency)
+
+
+def _from_minor(data: Dict[str, Any]) -> float:
+    return from_minor(data["amount"], data.get("currency") or "RUB")
+
+
+class StripeGateway(HTTPGateway):
+    name = "stripe"
 
-class StripeGateway:
     def __init__(self):
         self.stripe_api_key = os.getenv("STRIPE_SECRET_KEY", "sk_test_xxx")
-        stripe.api_key = self.stripe_api_key
-    
-    async def create_payment(self, payment_data: PaymentCreate) -> Dict[str, Any]:
-        """Создание платежа в Stripe"""
-        try:
-            payment_intent = stripe.PaymentIntent.create(
-                amount=int(payment_data.amount * 100),
-                currency=payment_data.currency.lower(),
-                metadata={
-                    "order_id": payment_data.order_id,
-                    "user_id": payment_data.user_id,
-                    **(payment_data.metadata or {})
-                },
-                description=payment_data.description,
-                automatic_payment_methods={"enabled": True},
-            )
-            
-            return {
-                "payment_id": payment_intent.id,
-                "client_secret": payment_intent.client_secret,
-                "status": payment_intent.status,
-                "amount": payment_intent.amount / 100,
-                "currency": payment_intent.currency
-            }
-        except Exception as e:
-            raise Exception(f"Stripe error: {str(e)}")
-    
+        super().__init__(
+            base_url=os.getenv("STRIPE_API_BASE", "https://api.stripe.com"),
+            headers={"Authorization": f"Bearer {self.stripe_api_key}"},
+            max_connections=int(os.getenv("STRIPE_MAX_CONNECTIONS", "50")),
+            concurrency=int(os.getenv("STRIPE_CONCURRENCY", "50")),
+            timeout=float(os.getenv("STRIPE_TIMEOUT", "10"))
+        )
+
+    async def create_payment(self, payment_data: PaymentCreate, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Создание платежа в Stripe; idempotency_key - один на заказ, чтобы повтор не списал деньги дважды"""
+        data = {
+            "amount": _to_minor(payment_data.amount, payment_data.currency),
+            "currency": payment_data.currency.lower(),
+            "metadata[order_id]": payment_data.order_id,
+            "metadata[user_id]": payment_data.user_id,
+            "automatic_payment_methods[enabled]": "true",
+        }
+        for key, value in (getattr(payment_data, "metadata", None) or {}).items():
+            data[f"metadata[{key}]"] = value
+        if payment_data.description:
+            data["description"] = payment_data.description
+
+        # Idempotency-Key делает повтор POST безопасным, в том числе после перезапуска
+        # сервиса и повторной доставки order.created
+        payment_intent = await self._request(
+            "POST", "/v1/payment_intents",
+            idempotent=True,
+            data=data,
+            headers={"Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        )
+        return {
+            "payment_id": payment_intent["id"],
+            "client_secret": payment_intent.get("client_secret"),
+            "status": payment_intent["status"],
+            "amount": _from_minor(payment_intent),
+            "currency": payment_intent["currency"]
+        }
+
     async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
         """Получение статуса платежа"""
-        try:
-            payment_intent = stripe.PaymentIntent.retrieve(payment_id)
-            return {
-                "id": payment_intent.id,
-                "status": payment_intent.status,
-                "amount": payment_intent.amount / 100,
-                "metadata": payment_intent.metadata
-            }
-        except Exception as e:
-            raise Exception(f"Stripe error: {str(e)}")
-    
-    async def refund_payment(self, payment_id: str, amount: Optional[float] = None) -> Dict[str, Any]:
+        payment_intent = await self._request("GET", f"/v1/payment_intents/{payment_id}", idempotent=True)
+        return {
+            "id": payment_intent["id"],
+            "status": payment_intent["status"],
+            "amount": _from_minor(payment_intent),
+            "metadata": payment_intent.get("metadata", {})
+        }
+
+    async def refund_payment(
+        self,
+        payment_id: str,
+        amount: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+        currency: str = "RUB"
+    ) -> Dict[str, Any]:
         """Возврат платежа"""
-        try:
-            refund_params = {"payment_intent": payment_id}
-            if amount:
-                refund_params["amount"] = int(amount * 100)
-            
-            refund = stripe.Refund.create(**refund_params)
-            return {
-                "refund_id": refund.id,
-                "status": refund.status,
-                "amount": refund.amount / 100
-            }
-        except Exception as e:
-            raise Exception(f"Stripe refund error: {str(e)}")
+        data = {"payment_intent": payment_id}
+        if amount:
+            data["amount"] = _to_minor(amount, currency)
+
+        refund = await self._request(
+            "POST", "/v1/refunds",
+            idempotent=True,
+            data=data,
+            headers={"Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        )
+        return {
+            "refund_id": refund["id"],
+            "status": refund["status"],
+            "amount": _from_minor(refund)
+        }
+
+class YooMoneyGateway(HTTPGateway):
+    name = "yoomoney"
 
-class YooMoneyGateway:
     def __init__(self):
         self.receiver_wallet = os.getenv("YOOMONEY_WALLET", "410011111111111")
-    
-    async def create_payment(self, payment_data: PaymentCreate) -> Dict[str, Any]:
+        self.token = os.getenv("YOOMONEY_TOKEN")
+        super().__init__(
+            base_url=os.getenv("YOOMONEY_API_BASE", "https://yoomoney.ru"),
+            headers={"Authorization": f"Bearer {self.token}"} if self.token else None,
+            max_connections=int(os.getenv("YOOMONEY_MAX_CONNECTIONS", "20")),
+            concurrency=int(os.getenv("YOOMONEY_CONCURRENCY", "20")),
+            timeout=float(os.getenv("YOOMONEY_TIMEOUT", "10"))
+        )
+
+    async def create_payment(self, payment_data: PaymentCreate, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
         """Создание платежа в YooMoney"""
-        payment_id = str(uuid.uuid4())
-        
+        # Метка платежа из ключа идемпотентности: повтор дает ту же ссылку на оплату
+        payment_id = str(uuid.uuid5(uuid.NAMESPACE_URL, idempotency_key) if idempotency_key else uuid.uuid4())
+
         # Формируем ссылку для оплаты через YooMoney
         payment_url = f"https://yoomoney.ru/quickpay/confirm.xml?receiver={self.receiver_wallet}&quickpay-form=shop&sum={payment_data.amount}&label={payment_id}"
-        
+
         return {
             "payment_id": payment_id,
             "payment_url": payment_url,
@@ -81,12 +198,29 @@ class YooMoneyGateway:
             "amount": payment_data.amount,
             "currency": payment_data.currency
         }
-    
+
     async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
-        """Получение статуса платежа"""
-        # В реальном проекте - вызов API YooMoney для проверки статуса
+        """Получение статуса платежа по метке в истории операций"""
+        if not self.token:
+            return {
+                "payment_id": payment_id,
+                "status": "pending",
+                "message": "YOOMONEY_TOKEN is not set, check YooMoney wallet for actual status"
+            }
+
+        history = await self._request(
+            "POST", "/api/operation-history",
+            idempotent=True,
+            data={"label": payment_id, "type": "deposition", "records": 1}
+        )
+        operations = history.get("operations", [])
+        if not operations:
+            return {"payment_id": payment_id, "status": "pending", "message": "Payment not received yet"}
+
+        operation = operations[0]
         return {
             "payment_id": payment_id,
-            "status": "pending",  # Заглушка для демо
-            "message": "Check YooMoney wallet for actual status"
-        }
\ No newline at end of file
+            "status": "succeeded" if operation.get("status") == "success" else operation.get("status", "pending"),
+            "amount": operation.get("amount"),
+            "operation_id": operation.get("operation_id")
+        }
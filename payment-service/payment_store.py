@@ -0,0 +1,108 @@
+"""Хранилище платежей с индексами по order_id, user_id, статусу и времени создания."""
+import bisect
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class PaymentNotFound(Exception):
+    pass
+
+
+class PaymentRepository:
+    def __init__(self):
+        self._by_id: Dict[str, dict] = {}
+        self._by_order: Dict[str, List[str]] = {}
+        self._by_user: Dict[str, List[str]] = {}
+        # dict как упорядоченное множество id
+        self._by_status: Dict[str, Dict[str, None]] = {}
+        # (created_at, payment_id), отсортировано; платежи приходят почти по порядку,
+        # поэтому вставка обычно в конец
+        self._by_time: List[Tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, payment_id: str) -> bool:
+        return payment_id in self._by_id
+
+    def get(self, payment_id: str) -> Optional[dict]:
+        return self._by_id.get(payment_id)
+
+    def require(self, payment_id: str) -> dict:
+        record = self._by_id.get(payment_id)
+        if record is None:
+            raise PaymentNotFound(f"Payment {payment_id} not found")
+        return record
+
+    def save(self, record: dict):
+        """Добавить платеж или обновить существующий (индексы статуса пересчитываются)"""
+        payment_id = record["payment_id"]
+        previous = self._by_id.get(payment_id)
+        self._by_id[payment_id] = record
+
+        if previous is None:
+            self._by_order.setdefault(record["order_id"], []).append(payment_id)
+            self._by_user.setdefault(record["user_id"], []).append(payment_id)
+            key = (record["created_at"], payment_id)
+            if not self._by_time or self._by_time[-1] <= key:
+                self._by_time.append(key)
+            else:
+                bisect.insort(self._by_time, key)
+        elif previous["status"] != record["status"]:
+            self._by_status.get(previous["status"], {}).pop(payment_id, None)
+
+        self._by_status.setdefault(record["status"], {})[payment_id] = None
+
+    def update_status(self, payment_id: str, status: str, at: float, **fields) -> dict:
+        """Перевести платеж в новый статус с записью в историю"""
+        record = dict(self.require(payment_id))
+        record.update(fields)
+        record["status"] = status
+        record["timestamp"] = at
+        record["history"] = record.get("history", []) + [{"status": status, "at": at}]
+        self.save(record)
+        return record
+
+    def by_order(self, order_id: str) -> List[dict]:
+        return [self._by_id[pid] for pid in self._by_order.get(order_id, [])]
+
+    def by_user(self, user_id: str, status: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        ids = self._by_user.get(user_id, [])
+        records = []
+        # Новые платежи в конце списка - идем с конца
+        for pid in reversed(ids):
+            record = self._by_id[pid]
+            if status is not None and record["status"] != status:
+                continue
+            records.append(record)
+            if limit is not None and len(records) >= limit:
+                break
+        return records
+
+    def count_by_status(self) -> Dict[str, int]:
+        return {status: len(ids) for status, ids in self._by_status.items() if ids}
+
+    def iter_window(
+        self,
+        start: float,
+        end: float,
+        status: Optional[str] = None,
+        batch_size: int = 500
+    ) -> Iterator[dict]:
+        """Платежи, созданные в [start, end), по порядку времени.
+
+        Индекс читается пачками и позиция ищется заново для каждой пачки,
+        поэтому копия хранилища не нужна, а вставки во время обхода безопасны.
+        """
+        status_ids = self._by_status.get(status, {}) if status is not None else None
+        position = bisect.bisect_left(self._by_time, (start, ""))
+        while True:
+            batch = self._by_time[position:position + batch_size]
+            if not batch:
+                return
+            for created_at, payment_id in batch:
+                if created_at >= end:
+                    return
+                if status_ids is not None and payment_id not in status_ids:
+                    continue
+                yield self._by_id[payment_id]
+            position = bisect.bisect_right(self._by_time, batch[-1])
@@ -0,0 +1,235 @@
+"""Возвраты платежей.
+
+Остаток к возврату хранится в записи платежа (refunded_amount), а проверка
+остатка, вызов шлюза и списание выполняются под блокировкой конкретного
+платежа, поэтому параллельные частичные возвраты не превысят сумму оплаты.
+Массовый возврат - фоновая задача с ограниченным числом одновременных
+вызовов шлюзов и счетчиками прогресса.
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+from keyed_lock import KeyedLock
+from payment_store import PaymentRepository
+from payment_worker import EventBatchPublisher
+from shared.money import from_minor, to_minor
+from shared.resilience import get_breaker
+
+REFUND_JOB_CONCURRENCY = int(os.getenv("REFUND_JOB_CONCURRENCY", "32"))
+# Сколько завершенных задач помнить для GET /refunds/jobs/{job_id}
+REFUND_JOB_HISTORY = int(os.getenv("REFUND_JOB_HISTORY", "100"))
+# Сколько ошибок хранить в задаче; остальные только считаются
+REFUND_JOB_MAX_ERRORS = 100
+
+REFUNDABLE_STATUSES = {"succeeded", "partially_refunded"}
+
+
+class RefundError(Exception):
+    """Возврат невозможен: статус платежа, сумма или шлюз"""
+
+
+class RefundEngine:
+    def __init__(self, store: PaymentRepository, gateways: Dict[str, Any], events: EventBatchPublisher):
+        self.store = store
+        self.gateways = gateways
+        self.events = events
+        self._locks = KeyedLock()
+
+    def refundable_amount(self, record: dict) -> float:
+        if record["status"] not in REFUNDABLE_STATUSES:
+            return 0.0
+        currency = record.get("currency") or "RUB"
+        available = to_minor(record["amount"], currency) - to_minor(record.get("refunded_amount", 0.0), currency)
+        return from_minor(available, currency)
+
+    async def refund(self, payment_id: str, amount: Optional[float] = None, reason: Optional[str] = None) -> dict:
+        """Вернуть amount (по умолчанию весь остаток); PaymentNotFound / RefundError / ошибка шлюза"""
+        async with self._locks(payment_id):
+            record = self.store.require(payment_id)
+            if record["status"] not in REFUNDABLE_STATUSES:
+                raise RefundError(f"Payment {payment_id} is {record['status']}, nothing to refund")
+
+            # Считаем в минимальных единицах, чтобы частичные возвраты не накапливали ошибку округления
+            currency = record.get("currency") or "RUB"
+            available = to_minor(record["amount"], currency) - to_minor(record.get("refunded_amount", 0.0), currency)
+            requested = available if amount is None else to_minor(amount, currency)
+            if requested <= 0:
+                raise RefundError("Refund amount must be positive")
+            if requested > available:
+                raise RefundError(f"Refund {from_minor(requested, currency)} exceeds refundable balance "
+                                  f"{from_minor(available, currency)}")
+
+            gateway_name = record["gateway"]
+            gateway = self.gateways.get(gateway_name)
+            if gateway is None or not hasattr(gateway, "refund_payment"):
+                raise RefundError(f"Gateway {gateway_name} does not support refunds")
+
+            refund_id = f"re_{uuid.uuid4().hex[:16]}"
+            # refund_id служит ключом идемпотентности: повторы шлюза не вернут деньги дважды
+            result = await get_breaker(f"gateway.{gateway_name}").call(
+                gateway.refund_payment, payment_id, from_minor(requested, currency),
+                idempotency_key=refund_id, currency=currency
+            )
+
+            refunded = to_minor(record.get("refunded_amount", 0.0), currency) + requested
+            full = refunded >= to_minor(record["amount"], currency)
+            refund = {
+                "refund_id": result.get("refund_id", refund_id),
+                "amount": from_minor(requested, currency),
+                "currency": currency,
+                "status": result.get("status", "succeeded"),
+                "reason": reason,
+                "at": time.time()
+            }
+            record = self.store.update_status(
+                payment_id,
+                "refunded" if full else "partially_refunded",
+                refund["at"],
+                refunded_amount=from_minor(refunded, currency),
+                refunds=record.get("refunds", []) + [refund]
+            )
+
+        self.events.publish("payment.refunded", {
+            "payment_id": payment_id,
+            "order_id": record["order_id"],
+            "user_id": record["user_id"],
+            "refund_id": refund["refund_id"],
+            "amount": refund["amount"],
+            "refunded_amount": record["refunded_amount"],
+            "currency": record["currency"],
+            "gateway": gateway_name,
+            "full": full,
+            "reason": reason
+        })
+        return refund
+
+
+class RefundJob:
+    """Массовый возврат: обходит платежи пулом из concurrency воркеров"""
+
+    def __init__(
+        self,
+        engine: RefundEngine,
+        payment_ids: Iterable[str],
+        total: int,
+        amount: Optional[float] = None,
+        reason: Optional[str] = None,
+        concurrency: int = REFUND_JOB_CONCURRENCY
+    ):
+        self.job_id = f"rj_{uuid.uuid4().hex[:12]}"
+        self.engine = engine
+        self.amount = amount
+        self.reason = reason
+        self.concurrency = concurrency
+        self.status = "pending"
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        # {валюта: возвращено в минимальных единицах}; платежи задачи могут быть в разных валютах
+        self.refunded_minor: Dict[str, int] = {}
+        self.errors: List[dict] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._payment_ids = iter(payment_ids)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def processed(self) -> int:
+        return self.succeeded + self.failed + self.skipped
+
+    def start(self):
+        self.status = "running"
+        self._task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self):
+        # Воркеры тянут id из общего итератора: в памяти не больше concurrency задач
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+            self.status = "completed"
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            self.status = "cancelled"
+        except Exception as e:
+            self.status = "failed"
+            print(f"Refund job {self.job_id} failed: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    async def _worker(self):
+        for payment_id in self._payment_ids:
+            try:
+                refund = await self.engine.refund(payment_id, self.amount, self.reason)
+                self.succeeded += 1
+                currency = refund["currency"]
+                self.refunded_minor[currency] = self.refunded_minor.get(currency, 0) + to_minor(refund["amount"], currency)
+            except RefundError as e:
+                # Уже возвращен или не оплачен - повторный запуск задачи безопасен
+                self.skipped += 1
+                self._record_error(payment_id, e)
+            except Exception as e:
+                self.failed += 1
+                self._record_error(payment_id, e)
+
+    def _record_error(self, payment_id: str, error: Exception):
+        if len(self.errors) < REFUND_JOB_MAX_ERRORS:
+            self.errors.append({"payment_id": payment_id, "error": str(error)})
+
+    def snapshot(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.created_at
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "progress": round(self.processed / self.total, 4) if self.total else 1.0,
+            "refunded_amount": {currency: from_minor(minor, currency) for currency, minor in self.refunded_minor.items()},
+            "rate_per_sec": round(self.processed / elapsed, 1) if elapsed > 0 else 0.0,
+            "concurrency": self.concurrency,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "errors": self.errors
+        }
+
+
+class RefundJobRegistry:
+    def __init__(self, engine: RefundEngine, history: int = REFUND_JOB_HISTORY):
+        self.engine = engine
+        self.history = history
+        self._jobs: "OrderedDict[str, RefundJob]" = OrderedDict()
+
+    def submit(self, payment_ids: List[str], **options) -> RefundJob:
+        job = RefundJob(self.engine, payment_ids, len(payment_ids), **options)
+        self._jobs[job.job_id] = job
+        self._trim()
+        job.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[RefundJob]:
+        return self._jobs.get(job_id)
+
+    def all(self) -> List[RefundJob]:
+        return list(self._jobs.values())
+
+    def cancel_all(self):
+        for job in self._jobs.values():
+            job.cancel()
+
+    def _trim(self):
+        # Выбрасываем самые старые завершенные задачи; работающие остаются
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(len(self._jobs) - self.history, 0)]:
+            del self._jobs[job_id]
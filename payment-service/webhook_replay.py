@@ -0,0 +1,114 @@
+"""Повторная обработка вебхуков из журнала.
+
+Применить записи журнала заново внутри работающего сервиса:
+    python webhook_replay.py server --url http://localhost:5003 --from-seq 100 --to-seq 200 --rate 500
+
+Переотправить записи из файла журнала на эндпоинты вебхуков (например, на
+другой стенд). Stripe-события подписываются заново текущим временем, поэтому
+нужен тот же STRIPE_WEBHOOK_SECRET, что и у получателя:
+    python webhook_replay.py resend --journal data/webhooks.journal --url http://localhost:5003 --rate 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from webhooks import sign_stripe_payload
+
+
+def read_journal(path: str, from_seq: int, to_seq):
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["seq"] < from_seq:
+                continue
+            if to_seq is not None and entry["seq"] > to_seq:
+                break
+            yield entry
+
+
+async def replay_on_server(args):
+    params = {"from_seq": args.from_seq}
+    if args.to_seq is not None:
+        params["to_seq"] = args.to_seq
+    if args.rate:
+        params["rate"] = args.rate
+    async with httpx.AsyncClient(base_url=args.url, timeout=30.0) as client:
+        response = await client.post("/webhooks/replay", params=params)
+        response.raise_for_status()
+        print(response.json())
+
+
+async def resend(args):
+    secret = args.stripe_secret or os.getenv("STRIPE_WEBHOOK_SECRET", "")
+    semaphore = asyncio.Semaphore(args.concurrency)
+    counts = {"sent": 0, "duplicate": 0, "failed": 0}
+    tasks = set()
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=30.0) as client:
+        async def send(entry: dict):
+            body = entry["body"].encode()
+            if entry["provider"] == "stripe":
+                headers = {"Content-Type": "application/json"}
+                if secret:
+                    headers["Stripe-Signature"] = sign_stripe_payload(body, secret)
+            else:
+                # Уведомление YooMoney несет подпись sha1_hash в самом теле
+                headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            try:
+                response = await client.post(f"/webhooks/{entry['provider']}", content=body, headers=headers)
+                response.raise_for_status()
+                counts["duplicate" if response.json().get("duplicate") else "sent"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"seq {entry['seq']}: {e}")
+            finally:
+                semaphore.release()
+
+        started = time.monotonic()
+        for i, entry in enumerate(read_journal(args.journal, args.from_seq, args.to_seq)):
+            if args.rate:
+                delay = started + i / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await semaphore.acquire()
+            task = asyncio.create_task(send(entry))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    print(f"sent: {counts['sent']}, duplicate: {counts['duplicate']}, failed: {counts['failed']}, "
+          f"elapsed: {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    server = commands.add_parser("server", help="применить записи журнала внутри сервиса")
+    server.add_argument("--url", default="http://localhost:5003")
+
+    resend_parser = commands.add_parser("resend", help="переотправить записи журнала на эндпоинты вебхуков")
+    resend_parser.add_argument("--url", default="http://localhost:5003")
+    resend_parser.add_argument("--journal", default="data/webhooks.journal")
+    resend_parser.add_argument("--stripe-secret", default=None)
+    resend_parser.add_argument("-c", "--concurrency", type=int, default=50)
+
+    for command in (server, resend_parser):
+        command.add_argument("--from-seq", type=int, default=0)
+        command.add_argument("--to-seq", type=int, default=None)
+        command.add_argument("--rate", type=float, default=None, help="событий в секунду")
+
+    args = parser.parse_args()
+    asyncio.run(replay_on_server(args) if args.command == "server" else resend(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+"""Прием вебхуков платежных провайдеров.
+
+Обработчик HTTP только проверяет подпись, отбрасывает повторы по id события
+и дописывает сырое тело в журнал на диске; ответ провайдеру уходит сразу
+после fsync. Переходы статусов применяют воркеры, читающие из журнала,
+поэтому всплеск вебхуков не задерживает ответы, а принятые события
+переживают перезапуск сервиса.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from payment_store import PaymentRepository
+from shared.money import CurrencyError, to_minor
+from payment_worker import EventBatchPublisher, publish_payment_event
+
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
+# Stripe подписывает вебхук вместе со временем отправки; старые подписи отклоняются
+STRIPE_SIGNATURE_TOLERANCE = int(os.getenv("STRIPE_SIGNATURE_TOLERANCE", "300"))
+YOOMONEY_NOTIFICATION_SECRET = os.getenv("YOOMONEY_NOTIFICATION_SECRET", "")
+# Без секрета вебхуки отклоняются (503); неподписанные принимаются только с этим флагом (локальная разработка)
+WEBHOOK_ALLOW_UNSIGNED = os.getenv("WEBHOOK_ALLOW_UNSIGNED", "0") == "1"
+
+WEBHOOK_JOURNAL_DIR = os.getenv("WEBHOOK_JOURNAL_DIR", "data")
+# Записи, пришедшие за это время, сбрасываются на диск одним fsync
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv("WEBHOOK_FLUSH_INTERVAL_MS", "2")) / 1000
+WEBHOOK_FSYNC = os.getenv("WEBHOOK_FSYNC", "1") == "1"
+# Журнал обнуляется, когда все записи обработаны и он вырос больше этого размера
+WEBHOOK_JOURNAL_MAX_BYTES = int(os.getenv("WEBHOOK_JOURNAL_MAX_BYTES", str(64 * 1024 * 1024)))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_SEEN_CAPACITY = int(os.getenv("WEBHOOK_SEEN_CAPACITY", "200000"))
+
+STRIPE_EVENT_STATUSES = {
+    "payment_intent.succeeded": "succeeded",
+    "payment_intent.payment_failed": "failed",
+    "payment_intent.canceled": "canceled",
+    "charge.refunded": "refunded",
+}
+
+# Поля уведомления YooMoney в порядке, в котором они входят в sha1_hash
+YOOMONEY_HASH_FIELDS = (
+    "notification_type", "operation_id", "amount", "currency",
+    "datetime", "sender", "codepro", "notification_secret", "label"
+)
+
+# Числовые коды валют (ISO 4217) в уведомлениях YooMoney
+YOOMONEY_CURRENCY_CODES = {"643": "RUB"}
+
+TERMINAL_STATUSES = {"failed", "canceled", "refunded"}
+
+
+class WebhookSignatureError(Exception):
+    pass
+
+
+def sign_stripe_payload(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """Заголовок Stripe-Signature для тела (используется в replay и нагрузочном тесте)"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify_stripe_signature(payload: bytes, header: str, secret: str, tolerance: int = STRIPE_SIGNATURE_TOLERANCE):
+    timestamp = None
+    signatures = []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    if not timestamp or not signatures:
+        raise WebhookSignatureError("Malformed Stripe-Signature header")
+    try:
+        signed_at = int(timestamp)
+    except ValueError:
+        raise WebhookSignatureError("Malformed Stripe-Signature timestamp")
+    if tolerance and abs(time.time() - signed_at) > tolerance:
+        raise WebhookSignatureError("Stripe signature timestamp outside tolerance")
+
+    expected = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise WebhookSignatureError("Stripe signature mismatch")
+
+
+def yoomoney_hash(form: Dict[str, str], secret: str) -> str:
+    values = {**form, "notification_secret": secret}
+    return hashlib.sha1("&".join(values.get(name, "") for name in YOOMONEY_HASH_FIELDS).encode()).hexdigest()
+
+
+def verify_yoomoney_signature(form: Dict[str, str], secret: str):
+    if not hmac.compare_digest(yoomoney_hash(form, secret), form.get("sha1_hash", "")):
+        raise WebhookSignatureError("YooMoney sha1_hash mismatch")
+
+
+# (payment_id, статус, доп. поля, оплачено: (сумма в минимальных единицах, валюта) или None)
+WebhookChange = Tuple[str, str, dict, Optional[Tuple[int, str]]]
+
+
+def parse_stripe_event(body: str) -> Optional[WebhookChange]:
+    """Изменение платежа по событию Stripe; None - событие не меняет статус"""
+    event = json.loads(body)
+    status = STRIPE_EVENT_STATUSES.get(event.get("type"))
+    if status is None:
+        return None
+    obj = event["data"]["object"]
+    # У charge.refunded объект - charge, а платеж - его payment_intent
+    payment_id = obj.get("payment_intent") if obj.get("object") == "charge" else obj.get("id")
+    if status == "refunded" and not obj.get("refunded", True):
+        # charge.refunded приходит и на частичный возврат; refunded=true только у полного
+        status = "partially_refunded"
+    fields = {}
+    if status == "failed":
+        fields["error"] = (obj.get("last_payment_error") or {}).get("message")
+    paid = None
+    amount = obj.get("amount_received", obj.get("amount"))
+    if status == "succeeded" and amount is not None and obj.get("currency"):
+        paid = (int(amount), obj["currency"].upper())
+    return payment_id, status, fields, paid
+
+
+def parse_yoomoney_event(body: str) -> Optional[WebhookChange]:
+    form = dict(parse_qsl(body))
+    # Перевод с протекцией или не зачисленный на кошелек еще не оплата
+    if form.get("codepro") == "true" or form.get("unaccepted") == "true":
+        return None
+    if not form.get("label"):
+        return None
+    # amount - зачислено за вычетом комиссии, withdraw_amount - списано с плательщика
+    amount = form.get("withdraw_amount") or form.get("amount")
+    currency = YOOMONEY_CURRENCY_CODES.get(form.get("currency", ""), form.get("currency", ""))
+    try:
+        paid = (to_minor(float(amount), currency), currency)
+    except (TypeError, ValueError):
+        # Без суммы или в неизвестной валюте (CurrencyError) оплату не засчитываем
+        return None
+    return form["label"], "succeeded", {"operation_id": form.get("operation_id")}, paid
+
+
+def paid_matches(record: dict, paid: Tuple[int, str]) -> bool:
+    """Сумма и валюта из уведомления совпадают с платежом"""
+    amount, currency = paid
+    try:
+        expected = to_minor(record["amount"], record.get("currency") or "RUB")
+    except (CurrencyError, TypeError, ValueError):
+        return False
+    return amount == expected and currency == (record.get("currency") or "RUB").upper()
+
+
+EVENT_PARSERS = {
+    "stripe": parse_stripe_event,
+    "yoomoney": parse_yoomoney_event,
+}
+
+
+def can_transition(current: str, new: str) -> bool:
+    """Вебхуки приходят повторно и не по порядку: назад и из финальных статусов не переходим"""
+    if current == new or current in TERMINAL_STATUSES:
+        return False
+    if current == "succeeded":
+        return new in ("refunded", "partially_refunded")
+    if current == "partially_refunded":
+        return new == "refunded"
+    return True
+
+
+class SeenSet:
+    """Множество недавних id событий с ограниченной памятью.
+
+    Два поколения: когда текущее заполняется, оно становится предыдущим,
+    а самое старое выбрасывается целиком. Помнит не меньше capacity / 2
+    последних id и не больше capacity.
+    """
+
+    def __init__(self, capacity: int = WEBHOOK_SEEN_CAPACITY):
+        self._generation = max(capacity // 2, 1)
+        self._current: set = set()
+        self._previous: set = set()
+
+    def __contains__(self, key) -> bool:
+        return key in self._current or key in self._previous
+
+    def __len__(self) -> int:
+        return len(self._current) + len(self._previous)
+
+    def add(self, key):
+        self._current.add(key)
+        if len(self._current) >= self._generation:
+            self._previous = self._current
+            self._current = set()
+
+    def discard(self, key):
+        self._current.discard(key)
+        self._previous.discard(key)
+
+
+class WebhookJournal:
+    """Журнал принятых вебхуков: JSON-строка на событие, fsync группами.
+
+    Рядом хранится курсор - номер последней записи, до которой все
+    обработано; при старте записи после курсора обрабатываются заново.
+    """
+
+    def __init__(self, directory: str = WEBHOOK_JOURNAL_DIR, flush_interval: float = WEBHOOK_FLUSH_INTERVAL):
+        self.path = os.path.join(directory, "webhooks.journal")
+        self.cursor_path = os.path.join(directory, "webhooks.cursor")
+        self.flush_interval = flush_interval
+        self.last_seq = 0
+        self.processed_seq = 0
+        self._saved_cursor = (0, 0)
+        self._done: set = set()
+        self._file = None
+        self._buffer: List[Tuple[bytes, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def open(self) -> List[dict]:
+        """Открыть журнал; возвращает записи, которые еще не обработаны"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.cursor_path):
+            with open(self.cursor_path) as f:
+                cursor = json.load(f)
+            self.processed_seq = cursor["processed"]
+            self.last_seq = cursor["last_seq"]
+
+        pending = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийной остановки
+                        continue
+                    self.last_seq = max(self.last_seq, entry["seq"])
+                    if entry["seq"] > self.processed_seq:
+                        pending.append(entry)
+
+        self._saved_cursor = (self.processed_seq, self.last_seq)
+        self._file = open(self.path, "ab")
+        return pending
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._flush()
+        self._save_cursor()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    async def append(self, provider: str, event_id: str, body: str) -> dict:
+        """Дописать событие; возвращается после того, как запись на диске"""
+        self.last_seq += 1
+        entry = {
+            "seq": self.last_seq,
+            "provider": provider,
+            "event_id": event_id,
+            "received_at": time.time(),
+            "body": body
+        }
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((json.dumps(entry).encode() + b"\n", future))
+        self._wakeup.set()
+        try:
+            await future
+        except Exception:
+            # Номер не должен остаться дырой, иначе курсор перестанет двигаться
+            self.mark_processed(entry["seq"])
+            raise
+        return entry
+
+    def mark_processed(self, seq: int):
+        if seq <= self.processed_seq:
+            return
+        self._done.add(seq)
+        # Воркеры заканчивают не по порядку - курсор двигается только по сплошному префиксу
+        while self.processed_seq + 1 in self._done:
+            self.processed_seq += 1
+            self._done.discard(self.processed_seq)
+
+    def read(self, from_seq: int = 0, to_seq: Optional[int] = None) -> List[dict]:
+        """Записи с from_seq по to_seq включительно (для replay)"""
+        entries = []
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["seq"] < from_seq:
+                    continue
+                if to_seq is not None and entry["seq"] > to_seq:
+                    break
+                entries.append(entry)
+        return entries
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Короткая пауза собирает записи соседних запросов под один fsync
+            if self.flush_interval:
+                await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self._flush()
+                self._save_cursor()
+                await self._compact()
+            except Exception as e:
+                print(f"Error writing webhook journal: {e}")
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write, b"".join(line for line, _ in batch)
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        if WEBHOOK_FSYNC:
+            os.fsync(self._file.fileno())
+
+    def _save_cursor(self):
+        cursor = (self.processed_seq, self.last_seq)
+        if cursor == self._saved_cursor:
+            return
+        tmp_path = self.cursor_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"processed": cursor[0], "last_seq": cursor[1]}, f)
+        os.replace(tmp_path, self.cursor_path)
+        self._saved_cursor = cursor
+
+    async def _compact(self):
+        if self._buffer or self.processed_seq < self.last_seq:
+            return
+        if self._file.tell() < WEBHOOK_JOURNAL_MAX_BYTES:
+            return
+        # Все записи обработаны, а курсор хранит last_seq - нумерация продолжится
+        await asyncio.get_running_loop().run_in_executor(None, self._file.truncate, 0)
+        self._file.seek(0)
+        print(f"Webhook journal compacted at seq {self.last_seq}")
+
+
+class WebhookProcessor:
+    """Дедупликация, журнал и воркеры, применяющие вебхуки к платежам"""
+
+    def __init__(
+        self,
+        store: PaymentRepository,
+        events: EventBatchPublisher,
+        journal: Optional[WebhookJournal] = None,
+        workers: int = WEBHOOK_WORKERS,
+        seen_capacity: int = WEBHOOK_SEEN_CAPACITY
+    ):
+        self.store = store
+        self.events = events
+        self.journal = journal or WebhookJournal()
+        self.workers = workers
+        self.seen = SeenSet(seen_capacity)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {
+            "received": 0,
+            "duplicates": 0,
+            "applied": 0,
+            "ignored": 0,
+            "unknown_payment": 0,
+            "amount_mismatch": 0,
+            "errors": 0
+        }
+
+    async def start(self):
+        pending = self.journal.open()
+        self.journal.start()
+        for entry in pending:
+            self.seen.add((entry["provider"], entry["event_id"]))
+            self._queue.put_nowait(entry)
+        if pending:
+            print(f"Recovering {len(pending)} unprocessed webhooks from journal")
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.journal.stop()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def ingest(self, provider: str, event_id: str, body: str) -> bool:
+        """Принять событие; False - повтор уже принятого события"""
+        key = (provider, event_id)
+        if key in self.seen:
+            self.stats["duplicates"] += 1
+            return False
+        # Помечаем до записи, чтобы параллельный повтор не попал в журнал дважды
+        self.seen.add(key)
+        try:
+            entry = await self.journal.append(provider, event_id, body)
+        except Exception:
+            # Не записали - провайдер повторит, и повтор не должен считаться дублем
+            self.seen.discard(key)
+            raise
+        self.stats["received"] += 1
+        self._queue.put_nowait(entry)
+        return True
+
+    async def replay(self, from_seq: int = 0, to_seq: Optional[int] = None, rate: Optional[float] = None) -> int:
+        """Повторно применить записи журнала, минуя дедупликацию; rate - событий в секунду"""
+        entries = await asyncio.get_running_loop().run_in_executor(None, self.journal.read, from_seq, to_seq)
+        started = time.monotonic()
+        for i, entry in enumerate(entries):
+            if rate:
+                delay = started + i / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._queue.put_nowait(entry)
+        return len(entries)
+
+    async def _worker(self):
+        while True:
+            entry = await self._queue.get()
+            try:
+                self._apply(entry)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error applying {entry['provider']} webhook {entry['event_id']}: {e}")
+            finally:
+                self.journal.mark_processed(entry["seq"])
+
+    def _apply(self, entry: dict):
+        change = EVENT_PARSERS[entry["provider"]](entry["body"])
+        if change is None:
+            self.stats["ignored"] += 1
+            return
+        payment_id, status, fields, paid = change
+        record = self.store.get(payment_id)
+        if record is None:
+            self.stats["unknown_payment"] += 1
+            return
+        if paid is not None and not paid_matches(record, paid):
+            self.stats["amount_mismatch"] += 1
+            print(f"Rejected {entry['provider']} webhook {entry['event_id']}: "
+                  f"paid {paid[0]} {paid[1]} does not match payment {payment_id}")
+            return
+        if not can_transition(record["status"], status):
+            self.stats["ignored"] += 1
+            return
+        record = self.store.update_status(payment_id, status, time.time(), **fields)
+        self.stats["applied"] += 1
+        publish_payment_event(self.events, record)
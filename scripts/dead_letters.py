@@ -0,0 +1,120 @@
+"""Работа с карантином сообщений сервисов (GET/POST /admin/dead-letters).
+
+Нужна роль admin: Bearer-токен из --token или ADMIN_TOKEN, без него -
+заголовок X-User-Role (только для запросов в обход шлюза).
+
+    python scripts/dead_letters.py --url http://localhost:5004 list --routing-key payment.succeeded
+    python scripts/dead_letters.py --url http://localhost:5004 show 42
+    python scripts/dead_letters.py --url http://localhost:5006 replay --queue notifications.all --rate 20 --wait
+    python scripts/dead_letters.py --url http://localhost:5004 replay --ids 42 43
+    python scripts/dead_letters.py --url http://localhost:5004 delete 42
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import httpx
+
+PREFIX = "/admin/dead-letters"
+
+
+def make_client(args) -> httpx.Client:
+    token = args.token or os.getenv("ADMIN_TOKEN")
+    headers = {"Authorization": f"Bearer {token}"} if token else {"X-User-Role": "admin"}
+    return httpx.Client(base_url=args.url, headers=headers, timeout=30.0)
+
+
+def check(response: httpx.Response) -> dict:
+    if response.status_code >= 400:
+        print(f"{response.status_code}: {response.text}", file=sys.stderr)
+        sys.exit(1)
+    return response.json()
+
+
+def cmd_list(client: httpx.Client, args):
+    params = {"status": args.status, "limit": args.limit, "offset": args.offset}
+    if args.queue:
+        params["queue"] = args.queue
+    if args.routing_key:
+        params["routing_key"] = args.routing_key
+    data = check(client.get(PREFIX, params=params))
+    for queue, counts in data["counts"].items():
+        print(f"{queue}: " + ", ".join(f"{status}={count}" for status, count in counts.items()))
+    print(f"{'id':>6}  {'queue':<32}{'routing key':<22}{'tries':>5}  {'failed at':<20}error")
+    for letter in data["items"]:
+        failed_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(letter["failed_at"]))
+        print(f"{letter['id']:>6}  {letter['queue']:<32}{letter['routing_key']:<22}{letter['attempts']:>5}  "
+              f"{failed_at:<20}{letter['error'][:80]}")
+    print(f"{len(data['items'])} of {data['total']}")
+
+
+def cmd_show(client: httpx.Client, args):
+    print(json.dumps(check(client.get(f"{PREFIX}/{args.id}")), indent=2, ensure_ascii=False))
+
+
+def cmd_replay(client: httpx.Client, args):
+    body = {"rate": args.rate, "limit": args.limit}
+    if args.ids:
+        body["ids"] = args.ids
+    if args.queue:
+        body["queue"] = args.queue
+    if args.routing_key:
+        body["routing_key"] = args.routing_key
+    job = check(client.post(f"{PREFIX}/replay", json=body))
+    print(f"Replay job {job['job_id']}: {job['total']} messages at {job['rate']}/s")
+    if not args.wait:
+        return
+    while job["status"] == "running":
+        time.sleep(1)
+        job = check(client.get(f"{PREFIX}/replay/{job['job_id']}"))
+        print(f"  {job['replayed']}/{job['total']} replayed, {job['failed']} failed, {job['skipped']} skipped")
+    print(f"Job {job['status']}")
+    for error in job["errors"]:
+        print(f"  {error}")
+
+
+def cmd_delete(client: httpx.Client, args):
+    for letter_id in args.ids:
+        print(check(client.delete(f"{PREFIX}/{letter_id}"))["message"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5004", help="адрес сервиса")
+    parser.add_argument("--token", default=None, help="JWT администратора (по умолчанию ADMIN_TOKEN)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="сообщения в карантине")
+    list_parser.add_argument("--queue")
+    list_parser.add_argument("--routing-key")
+    list_parser.add_argument("--status", default="quarantined", choices=["quarantined", "replayed"])
+    list_parser.add_argument("--limit", type=int, default=50)
+    list_parser.add_argument("--offset", type=int, default=0)
+    list_parser.set_defaults(handler=cmd_list)
+
+    show_parser = commands.add_parser("show", help="сообщение целиком")
+    show_parser.add_argument("id", type=int)
+    show_parser.set_defaults(handler=cmd_show)
+
+    replay_parser = commands.add_parser("replay", help="вернуть сообщения в очередь сервиса")
+    replay_parser.add_argument("--ids", type=int, nargs="+")
+    replay_parser.add_argument("--queue")
+    replay_parser.add_argument("--routing-key")
+    replay_parser.add_argument("--limit", type=int, default=1000)
+    replay_parser.add_argument("--rate", type=float, default=50, help="сообщений в секунду")
+    replay_parser.add_argument("--wait", action="store_true", help="дождаться завершения")
+    replay_parser.set_defaults(handler=cmd_replay)
+
+    delete_parser = commands.add_parser("delete", help="удалить сообщения из карантина")
+    delete_parser.add_argument("ids", type=int, nargs="+")
+    delete_parser.set_defaults(handler=cmd_delete)
+
+    args = parser.parse_args()
+    with make_client(args) as client:
+        args.handler(client, args)
+
+
+if __name__ == "__main__":
+    main()
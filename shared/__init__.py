@@ -0,0 +1 @@
+"""Общий код, который копируется в образы сервисов (см. additional_contexts в docker-compose.yml)."""
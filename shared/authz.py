@@ -0,0 +1,170 @@
+"""Авторизация на битовых масках прав.
+
+Роли и права компилируются в целые числа один раз при импорте модуля, поэтому
+проверка `requires(Permission.WRITE_CATALOG)` сводится к одной операции `&`
+и не требует обращения к auth-service.
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import jwt
+from fastapi import Depends, Header, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+
+# Имя claim'а с маской прав в JWT
+PERMISSIONS_CLAIM = "pm"
+
+TOKEN_CACHE_SIZE = int(os.getenv("AUTHZ_TOKEN_CACHE_SIZE", "10000"))
+
+
+class Role(str, Enum):
+    ADMIN = "admin"
+    USER = "user"
+    MANAGER = "manager"
+
+
+# Номер бита = порядок объявления. Новые права добавлять только в конец,
+# иначе маски в уже выданных токенах поменяют смысл.
+class Permission(str, Enum):
+    READ_CATALOG = "read:catalog"
+    WRITE_CATALOG = "write:catalog"
+    DELETE_CATALOG = "delete:catalog"
+    READ_ORDERS = "read:orders"
+    WRITE_ORDERS = "write:orders"
+    MANAGE_USERS = "manage:users"
+    PROCESS_PAYMENTS = "process:payments"
+    MANAGE_EVENTS = "manage:events"
+
+
+# Ролевые разрешения
+ROLE_PERMISSIONS = {
+    Role.USER: [
+        Permission.READ_CATALOG,
+        Permission.READ_ORDERS,
+        Permission.WRITE_ORDERS,
+    ],
+    Role.ADMIN: [
+        Permission.READ_CATALOG,
+        Permission.WRITE_CATALOG,
+        Permission.DELETE_CATALOG,
+        Permission.READ_ORDERS,
+        Permission.WRITE_ORDERS,
+        Permission.MANAGE_USERS,
+        Permission.PROCESS_PAYMENTS,
+        Permission.MANAGE_EVENTS,
+    ],
+    Role.MANAGER: [
+        Permission.READ_CATALOG,
+        Permission.WRITE_CATALOG,
+        Permission.READ_ORDERS,
+        Permission.WRITE_ORDERS,
+        Permission.PROCESS_PAYMENTS,
+    ]
+}
+
+PERMISSION_BITS: Dict[Permission, int] = {perm: 1 << i for i, perm in enumerate(Permission)}
+
+
+def compile_mask(permissions: Iterable[Permission]) -> int:
+    mask = 0
+    for perm in permissions:
+        mask |= PERMISSION_BITS[Permission(perm)]
+    return mask
+
+
+# Ключи - строковые значения ролей: так одинаково работают и Role, и заголовок X-User-Role
+ROLE_MASKS: Dict[str, int] = {
+    role.value: compile_mask(perms) for role, perms in ROLE_PERMISSIONS.items()
+}
+
+
+def role_mask(role: Optional[str]) -> int:
+    """Маска прав роли; неизвестная роль не дает никаких прав"""
+    if role is None:
+        return 0
+    return ROLE_MASKS.get(getattr(role, "value", role), 0)
+
+
+def permissions_from_mask(mask: int) -> List[Permission]:
+    return [perm for perm, bit in PERMISSION_BITS.items() if mask & bit]
+
+
+@dataclass(frozen=True)
+class Principal:
+    user_id: Optional[str]
+    role: Optional[str]
+    mask: int
+
+    def has(self, permission: Permission) -> bool:
+        bit = PERMISSION_BITS[permission]
+        return self.mask & bit == bit
+
+
+# Кэш решений по токенам: подпись JWT проверяется один раз на токен,
+# дальше до истечения exp используется сохраненный Principal.
+_token_cache: "OrderedDict[str, Tuple[Principal, float]]" = OrderedDict()
+
+
+def _decode_token(token: str) -> Principal:
+    cached = _token_cache.get(token)
+    now = time.time()
+    if cached is not None:
+        principal, expires_at = cached
+        if expires_at > now:
+            _token_cache.move_to_end(token)
+            return principal
+        del _token_cache[token]
+
+    try:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    role = payload.get("role")
+    mask = payload.get(PERMISSIONS_CLAIM)
+    if not isinstance(mask, int):
+        # Токены, выданные до появления claim'а с маской
+        mask = role_mask(role)
+
+    principal = Principal(user_id=payload.get("user_id"), role=role, mask=mask)
+    _token_cache[token] = (principal, float(payload.get("exp", now)))
+    if len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return principal
+
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+async def get_principal(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer),
+    x_user_role: Optional[str] = Header(None),
+    x_user_id: Optional[str] = Header(None),
+) -> Principal:
+    """Bearer-токен, а при его отсутствии - заголовки X-User-Role / X-User-Id от шлюза"""
+    if credentials is not None:
+        return _decode_token(credentials.credentials)
+    if x_user_role is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return Principal(user_id=x_user_id, role=x_user_role, mask=role_mask(x_user_role))
+
+
+def requires(*permissions: Permission):
+    """Зависимость FastAPI, пропускающая только принципалов со всеми указанными правами"""
+    needed = compile_mask(permissions)
+
+    async def dependency(principal: Principal = Depends(get_principal)) -> Principal:
+        if principal.mask & needed != needed:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+        return principal
+
+    return dependency
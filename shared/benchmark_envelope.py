@@ -0,0 +1,117 @@
+"""Бенчмарк кодирования событий: прежний JSON против конверта shared.envelope.
+
+Для каждого типа события замеряются размер тела, кодирование, полный разбор
+тела и "маршрутизация" - определение типа и id события без разбора тела
+(раньше для этого приходилось делать json.loads).
+    python shared/generate_events.py
+    python shared/benchmark_envelope.py --iterations 200000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from shared.envelope import (  # noqa: E402
+    JSON_CONTENT_TYPE, PROTOBUF_CONTENT_TYPE, EventHeader, decode, decode_message, encode, events_pb2
+)
+
+SAMPLES = {
+    "order.created": {
+        "order_id": "ORD-1A2B3C4D",
+        "user_id": "user_42",
+        "total_amount": 5970.0,
+        "items": [
+            {"product_id": f"prod_{i}", "quantity": i + 1, "price": 1990.0 / (i + 1), "name": f"Товар {i}"}
+            for i in range(3)
+        ],
+        "shipping_address": {"city": "Москва", "street": "Тверская", "building": "1", "zip": "125009"},
+        "payment_method": "card"
+    },
+    "payment.succeeded": {
+        "payment_id": uuid.uuid4().hex,
+        "order_id": "ORD-1A2B3C4D",
+        "user_id": "user_42",
+        "amount": 5970.0,
+        "currency": "RUB",
+        "gateway": "stripe",
+        "reason": None
+    },
+    "payment.refunded": {
+        "payment_id": uuid.uuid4().hex,
+        "order_id": "ORD-1A2B3C4D",
+        "user_id": "user_42",
+        "refund_id": uuid.uuid4().hex,
+        "amount": 1990.0,
+        "refunded_amount": 1990.0,
+        "currency": "RUB",
+        "gateway": "stripe",
+        "full": False,
+        "reason": "requested_by_customer"
+    },
+    "order.cancelled": {"order_id": "ORD-1A2B3C4D", "reason": "card declined"},
+}
+
+
+class FakeMessage:
+    """Свойства входящего AMQP-сообщения, которые читает EventHeader.from_message"""
+
+    def __init__(self, event_type: str, body: bytes, content_type: str):
+        header = EventHeader.new(event_type, correlation_id="ORD-1A2B3C4D")
+        self.body = body
+        self.content_type = content_type
+        self.type = event_type
+        self.routing_key = event_type
+        self.message_id = header.id
+        self.correlation_id = header.correlation_id
+        self.timestamp = None
+        self.headers = header.headers()
+
+
+def measure(fn, iterations: int) -> float:
+    """Микросекунды на вызов"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+    if events_pb2 is None:
+        sys.exit("events_pb2 not found: run python shared/generate_events.py")
+    n = args.iterations
+
+    print(f"{'event':<19}{'format':<10}{'bytes':>7}{'encode us':>11}{'decode us':>11}{'to dict us':>12}{'route us':>10}")
+    for event_type, payload in SAMPLES.items():
+        json_body = json.dumps(payload).encode()
+        proto_body, content_type = encode(event_type, payload, "protobuf")
+        assert content_type == PROTOBUF_CONTENT_TYPE
+        assert decode(event_type, proto_body, content_type) == {k: v for k, v in payload.items() if v is not None}
+
+        json_message = FakeMessage(event_type, json_body, JSON_CONTENT_TYPE)
+        rows = [
+            ("json", len(json_body),
+             measure(lambda: json.dumps(payload).encode(), n),
+             measure(lambda: json.loads(json_body), n),
+             None,
+             # Прежний способ узнать тип и id: разобрать тело
+             measure(lambda: json.loads(json_body).get("order_id"), n)),
+            ("protobuf", len(proto_body),
+             measure(lambda: encode(event_type, payload, "protobuf"), n),
+             measure(lambda: decode_message(event_type, proto_body), n),
+             measure(lambda: decode(event_type, proto_body, PROTOBUF_CONTENT_TYPE), n),
+             measure(lambda: EventHeader.from_message(json_message), n)),
+        ]
+        for name, size, enc, dec, to_dict, route in rows:
+            to_dict_text = f"{to_dict:>12.2f}" if to_dict is not None else f"{'-':>12}"
+            print(f"{event_type:<19}{name:<10}{size:>7}{enc:>11.2f}{dec:>11.2f}{to_dict_text}{route:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""Карантин сообщений, не обработанных потребителями событий.
+
+EventConsumer переносит сюда содержимое своей DLQ (Q.dlq): тело, заголовки,
+последнюю ошибку и число попыток. Хранилище - SQLite в томе сервиса, поэтому
+карантин переживает перезапуск и не зависит от брокера. Здесь же хранится
+счетчик повторных доставок, по которому EventConsumer выявляет сообщения,
+роняющие процесс.
+
+Админский API (dead_letter_router) позволяет смотреть карантин и
+переигрывать сообщения с ограничением частоты; клиент командной строки -
+scripts/dead_letters.py.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
+
+from shared.authz import Permission, requires
+from shared.envelope import JSON_CONTENT_TYPE, decode
+
+QUARANTINE_DB = os.getenv("QUARANTINE_DB", "data/quarantine.db")
+# Частота replay по умолчанию, сообщений в секунду
+REPLAY_RATE = float(os.getenv("DEAD_LETTER_REPLAY_RATE", "50"))
+# Сколько символов тела показывать в списке
+PREVIEW_CHARS = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    routing_key TEXT NOT NULL,
+    message_id TEXT,
+    body BLOB NOT NULL,
+    content_type TEXT NOT NULL DEFAULT 'application/json',
+    headers TEXT NOT NULL,
+    error TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    failed_at REAL NOT NULL,
+    quarantined_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'quarantined',
+    replay_count INTEGER NOT NULL DEFAULT 0,
+    replayed_at REAL
+);
+CREATE INDEX IF NOT EXISTS dead_letters_queue ON dead_letters (queue, status, id);
+CREATE TABLE IF NOT EXISTS redeliveries (
+    queue TEXT NOT NULL,
+    message_key TEXT NOT NULL,
+    deliveries INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (queue, message_key)
+);
+"""
+
+STATUSES = ("quarantined", "replayed")
+
+
+def _render(routing_key: str, body: bytes, content_type: str) -> str:
+    """Тело в читаемом виде; protobuf показывается как JSON"""
+    if content_type == JSON_CONTENT_TYPE:
+        return body.decode(errors="replace")
+    try:
+        return json.dumps(decode(routing_key, body, content_type), ensure_ascii=False)
+    except Exception:
+        return body.hex()
+
+
+class QuarantineStore:
+    def __init__(self, path: str = QUARANTINE_DB):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Запросы короткие и идут из одного event loop; блокировка - на случай
+        # вызовов из пула потоков
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(dead_letters)")}
+        if "content_type" not in columns:
+            # Карантин, созданный до появления protobuf-тел
+            self._db.execute(
+                "ALTER TABLE dead_letters ADD COLUMN content_type TEXT NOT NULL DEFAULT 'application/json'"
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def add(self, queue: str, routing_key: str, message_id: Optional[str], body: bytes,
+            headers: Dict[str, Any], error: str, attempts: int, failed_at: float,
+            content_type: Optional[str] = None) -> int:
+        cursor = self._execute(
+            "INSERT INTO dead_letters (queue, routing_key, message_id, body, content_type, headers, error, "
+            "attempts, failed_at, quarantined_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (queue, routing_key, message_id, body, content_type or JSON_CONTENT_TYPE,
+             json.dumps(headers, default=str), error, attempts, failed_at, time.time())
+        )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _row(row: sqlite3.Row, full: bool = False) -> Dict[str, Any]:
+        letter = dict(row)
+        letter["headers"] = json.loads(letter["headers"])
+        body = letter["body"]
+        if full:
+            return letter
+        del letter["body"]
+        letter["body_preview"] = _render(letter["routing_key"], bytes(body), letter["content_type"])[:PREVIEW_CHARS]
+        letter["body_size"] = len(body)
+        return letter
+
+    def _where(self, queue: Optional[str], routing_key: Optional[str], status: Optional[str]):
+        clauses, params = [], []
+        for column, value in (("queue", queue), ("routing_key", routing_key), ("status", status)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def list(self, queue: Optional[str] = None, routing_key: Optional[str] = None,
+             status: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+        where, params = self._where(queue, routing_key, status)
+        rows = self._execute(
+            f"SELECT * FROM dead_letters{where} ORDER BY id LIMIT ? OFFSET ?", (*params, limit, offset)
+        ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def count(self, queue: Optional[str] = None, routing_key: Optional[str] = None,
+              status: Optional[str] = None) -> int:
+        where, params = self._where(queue, routing_key, status)
+        return self._execute(f"SELECT COUNT(*) FROM dead_letters{where}", params).fetchone()[0]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Число сообщений по очередям и статусам"""
+        result: Dict[str, Dict[str, int]] = {}
+        rows = self._execute("SELECT queue, status, COUNT(*) FROM dead_letters GROUP BY queue, status")
+        for queue, status, count in rows.fetchall():
+            result.setdefault(queue, {})[status] = count
+        return result
+
+    def get(self, letter_id: int, full: bool = False) -> Optional[Dict[str, Any]]:
+        row = self._execute("SELECT * FROM dead_letters WHERE id = ?", (letter_id,)).fetchone()
+        return self._row(row, full) if row is not None else None
+
+    def select_for_replay(self, ids: Optional[List[int]] = None, queue: Optional[str] = None,
+                          routing_key: Optional[str] = None, limit: int = 1000) -> List[int]:
+        if ids:
+            placeholders = ",".join("?" * len(ids))
+            rows = self._execute(
+                f"SELECT id FROM dead_letters WHERE id IN ({placeholders}) AND status = 'quarantined' ORDER BY id",
+                ids
+            ).fetchall()
+        else:
+            where, params = self._where(queue, routing_key, "quarantined")
+            rows = self._execute(
+                f"SELECT id FROM dead_letters{where} ORDER BY id LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_replayed(self, letter_id: int):
+        self._execute(
+            "UPDATE dead_letters SET status = 'replayed', replay_count = replay_count + 1, replayed_at = ? "
+            "WHERE id = ?",
+            (time.time(), letter_id)
+        )
+
+    def delete(self, letter_id: int) -> bool:
+        return self._execute("DELETE FROM dead_letters WHERE id = ?", (letter_id,)).rowcount > 0
+
+    def note_redelivery(self, queue: str, message_key: str) -> int:
+        """Учесть повторную доставку сообщения и вернуть их общее число"""
+        with self._lock:
+            row = self._db.execute(
+                "INSERT INTO redeliveries (queue, message_key, deliveries, updated_at) VALUES (?, ?, 2, ?) "
+                "ON CONFLICT (queue, message_key) DO UPDATE SET deliveries = deliveries + 1, "
+                "updated_at = excluded.updated_at RETURNING deliveries",
+                (queue, message_key, time.time())
+            ).fetchone()
+        return row[0]
+
+    def clear_redelivery(self, queue: str, message_key: str):
+        self._execute("DELETE FROM redeliveries WHERE queue = ? AND message_key = ?", (queue, message_key))
+
+
+class ReplayJob:
+    """Возврат сообщений из карантина в очереди сервиса с ограничением частоты"""
+
+    def __init__(self, store: QuarantineStore, consumers: Dict[str, Any], ids: List[int], rate: float):
+        self.id = uuid.uuid4().hex[:12]
+        self.store = store
+        self.consumers = consumers
+        self.ids = ids
+        self.rate = rate
+        self.status = "running"
+        self.replayed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors: List[str] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self):
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        started = time.monotonic()
+        try:
+            for i, letter_id in enumerate(self.ids):
+                # Темп задается от начала задания, а не от предыдущего сообщения,
+                # чтобы задержки публикации не снижали итоговую частоту
+                delay = started + i * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                letter = self.store.get(letter_id, full=True)
+                if letter is None or letter["status"] != "quarantined":
+                    self.skipped += 1
+                    continue
+                consumer = self.consumers.get(letter["queue"])
+                if consumer is None:
+                    self.skipped += 1
+                    self._error(f"{letter_id}: no consumer for queue {letter['queue']}")
+                    continue
+                try:
+                    await consumer.replay(letter)
+                except Exception as e:
+                    self.failed += 1
+                    self._error(f"{letter_id}: {e}")
+                    continue
+                self.store.mark_replayed(letter_id)
+                self.replayed += 1
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        finally:
+            self.finished_at = time.time()
+
+    def _error(self, message: str):
+        print(f"Dead letter replay {self.id}: {message}")
+        if len(self.errors) < 20:
+            self.errors.append(message)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.ids),
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "rate": self.rate,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+class ReplayRequest(BaseModel):
+    ids: Optional[List[int]] = Field(None, description="Конкретные сообщения; иначе - по фильтру")
+    queue: Optional[str] = None
+    routing_key: Optional[str] = None
+    limit: int = Field(1000, ge=1, le=100000)
+    rate: float = Field(REPLAY_RATE, gt=0, le=10000, description="Сообщений в секунду")
+
+
+def dead_letter_router(store: QuarantineStore, *consumers) -> APIRouter:
+    """Админский API карантина для потребителей сервиса"""
+    router = APIRouter(
+        prefix="/admin/dead-letters",
+        tags=["dead-letters"],
+        dependencies=[Depends(requires(Permission.MANAGE_EVENTS))]
+    )
+    by_queue = {consumer.queue_name: consumer for consumer in consumers}
+    jobs: Dict[str, ReplayJob] = {}
+
+    @router.get("")
+    async def list_dead_letters(
+        queue: Optional[str] = Query(None),
+        routing_key: Optional[str] = Query(None),
+        status: Optional[str] = Query("quarantined", description="quarantined | replayed"),
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0)
+    ):
+        """Сообщения в карантине"""
+        if status is not None and status not in STATUSES:
+            raise HTTPException(status_code=400, detail=f"Unknown status {status}")
+        return {
+            "items": store.list(queue, routing_key, status, limit, offset),
+            "total": store.count(queue, routing_key, status),
+            "counts": store.counts(),
+            "queues": {name: consumer.snapshot() for name, consumer in by_queue.items()}
+        }
+
+    @router.post("/replay", status_code=202)
+    async def replay_dead_letters(request: ReplayRequest):
+        """Вернуть сообщения в очереди сервиса с заданной частотой"""
+        if request.queue is not None and request.queue not in by_queue:
+            raise HTTPException(status_code=404, detail=f"Unknown queue {request.queue}")
+        ids = store.select_for_replay(request.ids, request.queue, request.routing_key, request.limit)
+        job = ReplayJob(store, by_queue, ids, request.rate)
+        jobs[job.id] = job
+        job.start()
+        return job.snapshot()
+
+    @router.get("/replay/{job_id}")
+    async def get_replay_job(job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Replay job not found")
+        return job.snapshot()
+
+    @router.delete("/replay/{job_id}")
+    async def cancel_replay_job(job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Replay job not found")
+        job.cancel()
+        return job.snapshot()
+
+    @router.get("/{letter_id}")
+    async def get_dead_letter(letter_id: int):
+        letter = store.get(letter_id, full=True)
+        if letter is None:
+            raise HTTPException(status_code=404, detail="Dead letter not found")
+        body = bytes(letter.pop("body"))
+        try:
+            letter["body"] = decode(letter["routing_key"], body, letter["content_type"])
+        except ValueError:
+            letter["body"] = _render(letter["routing_key"], body, letter["content_type"])
+        return letter
+
+    @router.delete("/{letter_id}")
+    async def delete_dead_letter(letter_id: int):
+        if not store.delete(letter_id):
+            raise HTTPException(status_code=404, detail="Dead letter not found")
+        return {"message": f"Dead letter {letter_id} deleted"}
+
+    return router
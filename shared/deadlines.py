@@ -0,0 +1,63 @@
+"""Бюджет времени запроса, который передается вниз по цепочке вызовов.
+
+Входящий HTTP-запрос задает бюджет заголовком X-Request-Timeout-Ms (или
+берется значение по умолчанию). Клиенты исходящих вызовов берут
+`remaining_budget()` и не ждут ответа дольше, чем осталось у исходного запроса.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+DEADLINE_HEADER = "x-request-timeout-ms"
+
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def remaining_budget() -> Optional[float]:
+    """Сколько секунд осталось у текущего запроса; None - бюджет не задан"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Ограничить бюджет внутри блока; внешний бюджет никогда не расширяется"""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class DeadlineMiddleware:
+    """ASGI middleware: бюджет запроса из заголовка X-Request-Timeout-Ms"""
+
+    def __init__(self, app, default_budget: Optional[float] = None):
+        self.app = app
+        self.default_budget = default_budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        budget = self.default_budget
+        for name, value in scope["headers"]:
+            if name.decode("latin-1") == DEADLINE_HEADER:
+                try:
+                    budget = int(value) / 1000
+                except ValueError:
+                    pass
+                break
+
+        with deadline_scope(budget):
+            await self.app(scope, receive, send)
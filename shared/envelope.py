@@ -0,0 +1,289 @@
+"""Конверт событий exchange "events": типизированный заголовок и тело.
+
+Заголовок события передается свойствами AMQP-сообщения, поэтому для
+маршрутизации и дедупликации тело не разбирается:
+    type           - тип события (совпадает с routing key)
+    message_id     - id события
+    timestamp      - время создания
+    correlation_id - id запроса/заказа, породившего цепочку событий
+    x-event-version, traceparent, tracestate - в headers
+
+Тело кодируется по EVENTS_ENCODING: "protobuf" (схемы в events.proto) или
+"json" - прежний формат, который понимают потребители, еще не знающие о
+конверте. Потребители различают формат по content_type и принимают оба,
+поэтому переход выполняется так: обновить потребителей, затем включить
+EVENTS_ENCODING=protobuf у издателей. События без схемы, а также словари с
+полями, которых нет в схеме, всегда уходят в JSON - данные не теряются.
+
+Trace context: события, опубликованные во время обработки другого события,
+наследуют его traceparent (см. trace_context), так что цепочка
+order.created -> payment.failed -> order.cancelled остается одним trace.
+"""
+import contextvars
+import json
+import os
+import secrets
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+import aio_pika
+
+try:
+    from shared import events_pb2
+except ImportError:
+    # events_pb2 генерируется при сборке образа (shared/generate_events.py)
+    events_pb2 = None
+
+JSON_CONTENT_TYPE = "application/json"
+PROTOBUF_CONTENT_TYPE = "application/x-protobuf"
+
+EVENT_VERSION_HEADER = "x-event-version"
+TRACEPARENT_HEADER = "traceparent"
+TRACESTATE_HEADER = "tracestate"
+
+EVENTS_ENCODING = os.getenv("EVENTS_ENCODING", "json")
+EVENT_PRODUCER = os.getenv("OTEL_SERVICE_NAME", "")
+
+
+class EnvelopeError(ValueError):
+    """Тело не соответствует схеме или формат не поддерживается"""
+
+
+@dataclass(frozen=True)
+class Schema:
+    message: Any
+    version: int
+
+
+def _schemas() -> Dict[str, Schema]:
+    if events_pb2 is None:
+        return {}
+    payment = events_pb2.PaymentEvent
+    return {
+        "order.created": Schema(events_pb2.OrderCreated, 1),
+        "order.cancelled": Schema(events_pb2.OrderCancelled, 1),
+        "payment.succeeded": Schema(payment, 1),
+        "payment.failed": Schema(payment, 1),
+        "payment.refunded": Schema(payment, 1),
+    }
+
+
+SCHEMAS = _schemas()
+
+# traceparent события, которое сейчас обрабатывается (ставит EventConsumer)
+trace_context: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("event_trace_context", default=None)
+
+
+def new_traceparent(parent: Optional[str] = None) -> str:
+    """W3C traceparent: продолжение trace родителя или новый trace"""
+    trace_id = None
+    if parent:
+        parts = parent.split("-")
+        if len(parts) == 4 and len(parts[1]) == 32:
+            trace_id = parts[1]
+    return f"00-{trace_id or secrets.token_hex(16)}-{secrets.token_hex(8)}-01"
+
+
+@dataclass
+class EventHeader:
+    type: str
+    version: int
+    id: str
+    timestamp: float
+    traceparent: Optional[str] = None
+    tracestate: Optional[str] = None
+    correlation_id: Optional[str] = None
+
+    @classmethod
+    def new(cls, event_type: str, version: Optional[int] = None, event_id: Optional[str] = None,
+            correlation_id: Optional[str] = None, traceparent: Optional[str] = None,
+            timestamp: Optional[float] = None) -> "EventHeader":
+        if version is None:
+            schema = SCHEMAS.get(event_type)
+            version = schema.version if schema is not None else 1
+        return cls(
+            type=event_type,
+            version=version,
+            id=event_id or uuid.uuid4().hex,
+            timestamp=time.time() if timestamp is None else timestamp,
+            traceparent=new_traceparent(traceparent or trace_context.get()),
+            correlation_id=correlation_id
+        )
+
+    @classmethod
+    def from_message(cls, message: aio_pika.abc.AbstractIncomingMessage) -> "EventHeader":
+        headers = message.headers or {}
+        return cls(
+            type=message.type or message.routing_key or "",
+            version=int(headers.get(EVENT_VERSION_HEADER, 1)),
+            id=message.message_id or "",
+            timestamp=message.timestamp.timestamp() if message.timestamp is not None else 0.0,
+            traceparent=_str(headers.get(TRACEPARENT_HEADER)),
+            tracestate=_str(headers.get(TRACESTATE_HEADER)),
+            correlation_id=message.correlation_id
+        )
+
+    def headers(self) -> Dict[str, Any]:
+        headers: Dict[str, Any] = {EVENT_VERSION_HEADER: self.version}
+        if self.traceparent:
+            headers[TRACEPARENT_HEADER] = self.traceparent
+        if self.tracestate:
+            headers[TRACESTATE_HEADER] = self.tracestate
+        return headers
+
+
+def _str(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+# Виды полей для _fill/_to_dict
+_SCALAR, _OPTIONAL, _REPEATED, _STRUCT, _MESSAGE, _MESSAGES = range(6)
+_plans: Dict[str, Dict[str, int]] = {}
+
+
+def _plan(descriptor) -> Dict[str, int]:
+    """Вид каждого поля сообщения; разбор дескриптора кэшируется на тип"""
+    plan = _plans.get(descriptor.full_name)
+    if plan is None:
+        plan = {}
+        for field in descriptor.fields:
+            # FieldDescriptor.label убран в новых версиях protobuf в пользу is_repeated
+            repeated = getattr(field, "is_repeated", None)
+            if repeated is None:
+                repeated = field.label == field.LABEL_REPEATED
+            if field.message_type is None:
+                kind = _REPEATED if repeated else (_OPTIONAL if field.has_presence else _SCALAR)
+            elif field.message_type.full_name == "google.protobuf.Struct":
+                kind = _STRUCT
+            else:
+                kind = _MESSAGES if repeated else _MESSAGE
+            plan[field.name] = kind
+        _plans[descriptor.full_name] = plan
+    return plan
+
+
+def _fill(message, data: Dict[str, Any]):
+    plan = _plan(message.DESCRIPTOR)
+    for key, value in data.items():
+        if value is None:
+            continue
+        kind = plan.get(key)
+        if kind is None:
+            raise EnvelopeError(f"{message.DESCRIPTOR.name} has no field {key}")
+        try:
+            if kind == _SCALAR or kind == _OPTIONAL:
+                setattr(message, key, value)
+            elif kind == _REPEATED:
+                getattr(message, key).extend(value)
+            elif kind == _STRUCT:
+                getattr(message, key).update(value)
+            elif kind == _MESSAGES:
+                target = getattr(message, key)
+                for item in value:
+                    _fill(target.add(), item)
+            else:
+                _fill(getattr(message, key), value)
+        except (TypeError, ValueError, AttributeError) as e:
+            raise EnvelopeError(f"{message.DESCRIPTOR.name}.{key}: {e}") from e
+
+
+def _value(value) -> Any:
+    kind = value.WhichOneof("kind")
+    if kind == "struct_value":
+        return _struct(value.struct_value)
+    if kind == "list_value":
+        return [_value(item) for item in value.list_value.values]
+    if kind == "null_value" or kind is None:
+        return None
+    return getattr(value, kind)
+
+
+def _struct(struct) -> Dict[str, Any]:
+    return {key: _value(value) for key, value in struct.fields.items()}
+
+
+def _to_dict(message) -> Dict[str, Any]:
+    # Быстрее json_format.MessageToDict: не переименовывает поля и не
+    # проверяет типы; поля без presence со значением по умолчанию
+    # возвращаются явно, как их отправил бы JSON-издатель
+    result: Dict[str, Any] = {}
+    for name, kind in _plan(message.DESCRIPTOR).items():
+        if kind == _SCALAR:
+            result[name] = getattr(message, name)
+        elif kind == _OPTIONAL:
+            if message.HasField(name):
+                result[name] = getattr(message, name)
+        elif kind == _REPEATED:
+            result[name] = list(getattr(message, name))
+        elif kind == _STRUCT:
+            result[name] = _struct(getattr(message, name))
+        elif kind == _MESSAGES:
+            result[name] = [_to_dict(item) for item in getattr(message, name)]
+        else:
+            result[name] = _to_dict(getattr(message, name))
+    return result
+
+
+def encode(event_type: str, payload: Dict[str, Any], encoding: str = EVENTS_ENCODING) -> Tuple[bytes, str]:
+    """Тело события и его content_type"""
+    schema = SCHEMAS.get(event_type)
+    if encoding == "protobuf" and schema is not None:
+        message = schema.message()
+        try:
+            _fill(message, payload)
+        except EnvelopeError as e:
+            # Поле вне схемы: отправляем JSON, чтобы не потерять данные
+            print(f"Event {event_type} does not match schema, sending JSON: {e}")
+        else:
+            return message.SerializeToString(), PROTOBUF_CONTENT_TYPE
+    return json.dumps(payload).encode(), JSON_CONTENT_TYPE
+
+
+def decode_message(event_type: str, body: bytes):
+    """Protobuf-сообщение без преобразования в словарь"""
+    schema = SCHEMAS.get(event_type)
+    if schema is None:
+        raise EnvelopeError(f"No protobuf schema for {event_type}")
+    message = schema.message()
+    try:
+        message.ParseFromString(body)
+    except Exception as e:
+        raise EnvelopeError(f"Invalid {event_type} body: {e}") from e
+    return message
+
+
+def decode(event_type: str, body: bytes, content_type: Optional[str]) -> Dict[str, Any]:
+    """Тело события как словарь, независимо от формата"""
+    if content_type == PROTOBUF_CONTENT_TYPE:
+        return _to_dict(decode_message(event_type, body))
+    if content_type in (None, "", JSON_CONTENT_TYPE):
+        return json.loads(body)
+    raise EnvelopeError(f"Unsupported content type {content_type}")
+
+
+def build_message(
+    event_type: str,
+    payload: Dict[str, Any],
+    headers: Optional[Dict[str, Any]] = None,
+    header: Optional[EventHeader] = None,
+    encoding: str = EVENTS_ENCODING,
+    **header_fields
+) -> aio_pika.Message:
+    """AMQP-сообщение события с заголовком конверта; header_fields - аргументы EventHeader.new"""
+    header = header or EventHeader.new(event_type, **header_fields)
+    body, content_type = encode(event_type, payload, encoding)
+    return aio_pika.Message(
+        body=body,
+        content_type=content_type,
+        type=header.type,
+        message_id=header.id,
+        timestamp=header.timestamp,
+        correlation_id=header.correlation_id,
+        app_id=EVENT_PRODUCER or None,
+        headers={**(headers or {}), **header.headers()},
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+    )
@@ -0,0 +1,76 @@
+"""Разреженные наборы полей (sparse fieldsets): ?fields=id,status,items.name.
+
+Клиент, которому нужна часть документа (GraphQL-шлюз знает это по запросу),
+перечисляет поля через запятую; вложенные поля - через точку. Сервис
+отдает только их и не прогоняет весь документ через response_model:
+меньше сериализации у сервиса и меньше JSON в сети и в разборе у клиента.
+
+Допустимые поля берутся из модели ответа (schema_of): неизвестное поле -
+FieldsetError, то есть 400, а не молча пустой ответ. Поле без вложенных
+выбирает значение целиком; у списков объектов набор полей применяется к
+каждому элементу.
+"""
+import typing
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+
+# {"id": {}, "items": {"name": {}}}; пустой словарь - поле целиком
+FieldTree = Dict[str, "FieldTree"]
+Schema = Dict[str, Optional["Schema"]]
+
+
+class FieldsetError(ValueError):
+    pass
+
+
+def _model_in(annotation: Any) -> Optional[type]:
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    for arg in typing.get_args(annotation):
+        model = _model_in(arg)
+        if model is not None:
+            return model
+    return None
+
+
+def schema_of(model: type) -> Schema:
+    """Поля модели ответа; у полей-моделей (в том числе List[...] и Optional[...]) - их поля"""
+    schema: Schema = {}
+    for name, field in model.model_fields.items():
+        nested = _model_in(field.annotation)
+        schema[name] = schema_of(nested) if nested is not None else None
+    return schema
+
+
+def parse_fields(spec: Optional[str], schema: Schema) -> Optional[FieldTree]:
+    """Дерево полей из значения параметра fields; None - документ целиком"""
+    if spec is None or not spec.strip():
+        return None
+    paths = [path.strip() for path in spec.split(",") if path.strip()]
+    for path in paths:
+        allowed: Optional[Schema] = schema
+        for name in path.split("."):
+            if allowed is None:
+                raise FieldsetError(f"Field {path} has no subfields")
+            if name not in allowed:
+                raise FieldsetError(f"Unknown field {path}")
+            allowed = allowed[name]
+    tree: FieldTree = {}
+    # Короткие пути первыми: "items" вместе с "items.name" - это items целиком
+    for path in sorted(paths, key=lambda path: path.count(".")):
+        node = tree
+        for name in path.split("."):
+            if name in node and not node[name]:
+                break
+            node = node.setdefault(name, {})
+    return tree
+
+
+def project(document: Any, tree: Optional[FieldTree]) -> Any:
+    """Оставить в документе (dict или список dict) только поля дерева"""
+    if not tree or document is None:
+        return document
+    if isinstance(document, list):
+        return [project(item, tree) for item in document]
+    return {name: project(document[name], sub) for name, sub in tree.items() if name in document}
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""Генерация shared/events_pb2.py из events.proto (запускается при сборке образа)"""
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+result = subprocess.run([
+    sys.executable, '-m', 'grpc_tools.protoc',
+    f'-I{here}', f'--python_out={here}',
+    os.path.join(here, 'events.proto')
+])
+
+if result.returncode == 0:
+    print("Successfully generated events_pb2.py")
+else:
+    print("Failed to generate events_pb2.py")
+    sys.exit(1)
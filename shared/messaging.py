@@ -0,0 +1,472 @@
+"""Подписки сервисов на события из exchange "events".
+
+Обработчики объявляются декоратором с шаблонами routing key, и очередь
+сервиса привязывается только к этим ключам - чужие события брокер в нее
+не кладет. Сообщения с одним ключом упорядочивания (заголовок
+x-ordering-key, обычно order_id) обрабатываются строго по очереди, с
+разными - параллельно, в пределах prefetch_count. Тело сообщения
+разбирается только при обращении к Event.payload.
+
+    consumer = EventConsumer("notification-service.events", prefetch_count=200)
+
+    @consumer.subscribe("payment.succeeded", "payment.failed")
+    async def on_payment(event: Event):
+        ...
+
+    await consumer.start(connection)
+
+Ошибки обработчиков не теряют сообщение. У каждой очереди Q объявляются:
+  Q.retry.<delay>ms - очереди задержки с TTL, после которого сообщение
+                      возвращается в Q (повторяются только упавшие обработчики);
+  Q.dlx / Q.dlq     - exchange и очередь для сообщений, исчерпавших повторы,
+                      а также для ошибок, которые повтор не исправит.
+Из Q.dlq сообщения переносятся в карантин (shared.dead_letters), откуда их
+можно посмотреть и переиграть. Сообщение, на котором процесс падает и
+которое брокер поэтому доставляет снова и снова, после max_redeliveries
+доставок тоже уходит в DLQ.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import aio_pika
+
+from shared.envelope import EnvelopeError, EventHeader, TRACEPARENT_HEADER, decode, trace_context
+
+EVENTS_EXCHANGE = "events"
+ORDERING_KEY_HEADER = "x-ordering-key"
+# Служебные заголовки повторов и карантина
+ORIGINAL_ROUTING_KEY_HEADER = "x-original-routing-key"
+RETRY_COUNT_HEADER = "x-retry-count"
+FAILED_HANDLERS_HEADER = "x-failed-handlers"
+ERROR_HEADER = "x-error"
+FAILED_AT_HEADER = "x-failed-at"
+REPLAY_COUNT_HEADER = "x-replay-count"
+
+# Задержки перед повторами, секунды; число задержек = число повторов
+RETRY_DELAYS = tuple(float(d) for d in os.getenv("CONSUMER_RETRY_DELAYS", "1,10,60").split(",") if d)
+MAX_REDELIVERIES = int(os.getenv("CONSUMER_MAX_REDELIVERIES", "3"))
+
+
+class PermanentError(Exception):
+    """Повтор не поможет: сообщение сразу уходит в DLQ"""
+
+
+# Битое тело не исправится от повтора
+PERMANENT_ERRORS = (PermanentError, EnvelopeError, json.JSONDecodeError, UnicodeDecodeError)
+
+
+class Event:
+    """Входящее событие; тело (JSON или protobuf, см. shared.envelope) разбирается
+    при первом обращении к payload"""
+
+    __slots__ = ("message", "routing_key", "_payload", "_header")
+
+    def __init__(self, message: aio_pika.abc.AbstractIncomingMessage):
+        self.message = message
+        # Повторы и replay приходят через default exchange с именем очереди
+        # в routing key; исходный ключ сохраняется в заголовке
+        original = (message.headers or {}).get(ORIGINAL_ROUTING_KEY_HEADER)
+        self.routing_key = _header_str(original) if original is not None else (message.routing_key or "")
+        self._payload = None
+        self._header = None
+
+    @property
+    def body(self) -> bytes:
+        return self.message.body
+
+    @property
+    def headers(self) -> Dict[str, Any]:
+        return self.message.headers or {}
+
+    @property
+    def payload(self) -> Any:
+        if self._payload is None:
+            self._payload = decode(self.routing_key, self.message.body, self.message.content_type)
+        return self._payload
+
+    @property
+    def header(self) -> EventHeader:
+        if self._header is None:
+            self._header = EventHeader.from_message(self.message)
+        return self._header
+
+    @property
+    def ordering_key(self) -> str:
+        key = self.headers.get(ORDERING_KEY_HEADER)
+        if key is None:
+            return self.routing_key
+        return _header_str(key)
+
+    @property
+    def timestamp(self) -> float:
+        """Время публикации; если издатель его не указал - время получения"""
+        if self.message.timestamp is not None:
+            return self.message.timestamp.timestamp()
+        return time.time()
+
+    @property
+    def attempt(self) -> int:
+        return int(self.headers.get(RETRY_COUNT_HEADER, 0))
+
+    @property
+    def failed_handlers(self) -> Optional[List[str]]:
+        """Обработчики, упавшие в прошлой попытке; None - первая доставка"""
+        names = self.headers.get(FAILED_HANDLERS_HEADER)
+        return _header_str(names).split(",") if names else None
+
+    @property
+    def message_key(self) -> str:
+        """Идентификатор для счетчика повторных доставок"""
+        if self.message.message_id:
+            return self.message.message_id
+        return hashlib.sha1(self.routing_key.encode() + b"\0" + self.message.body).hexdigest()
+
+
+def _header_str(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+Handler = Callable[[Event], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class Subscription:
+    patterns: Tuple[str, ...]
+    handler: Handler
+
+    @property
+    def name(self) -> str:
+        return getattr(self.handler, "__name__", repr(self.handler))
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """Сопоставление по правилам topic exchange: * - одно слово, # - ноль и больше слов"""
+    return _match(pattern.split("."), routing_key.split("."))
+
+
+def _match(pattern: List[str], words: List[str]) -> bool:
+    if not pattern:
+        return not words
+    head = pattern[0]
+    if head == "#":
+        return any(_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return (head == "*" or head == words[0]) and _match(pattern[1:], words[1:])
+
+
+def ordering_headers(key: Optional[str]) -> Dict[str, Any]:
+    """Заголовки публикации, чтобы потребители сохранили порядок событий одной сущности"""
+    return {ORDERING_KEY_HEADER: key} if key else {}
+
+
+class EventConsumer:
+    def __init__(
+        self,
+        queue_name: str,
+        prefetch_count: int,
+        exchange: str = EVENTS_EXCHANGE,
+        stale_bindings: Sequence[str] = (),
+        retry_delays: Sequence[float] = RETRY_DELAYS,
+        max_redeliveries: int = MAX_REDELIVERIES,
+        quarantine=None
+    ):
+        self.queue_name = queue_name
+        self.prefetch_count = prefetch_count
+        self.exchange_name = exchange
+        # Привязки, оставшиеся у durable-очереди от прошлых версий сервиса
+        self.stale_bindings = tuple(stale_bindings)
+        self.retry_delays = tuple(retry_delays)
+        self.max_redeliveries = max_redeliveries
+        # shared.dead_letters.QuarantineStore: сюда переносится содержимое DLQ
+        self.quarantine = quarantine
+        self.subscriptions: List[Subscription] = []
+        self._routes: Dict[str, List[Subscription]] = {}
+        self._pending: Dict[str, Deque[Event]] = {}
+        self._drains: Dict[str, asyncio.Task] = {}
+        self._channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self._queue: Optional[aio_pika.abc.AbstractQueue] = None
+        self._dlx: Optional[aio_pika.abc.AbstractExchange] = None
+        self._consumer_tag = None
+        self._dlq: Optional[aio_pika.abc.AbstractQueue] = None
+        self._dlq_consumer_tag = None
+        self.stats = {
+            "received": 0,
+            "handled": 0,
+            "errors": 0,
+            "unrouted": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+            "quarantined": 0,
+            "replayed": 0
+        }
+
+    @property
+    def dlx_name(self) -> str:
+        return f"{self.queue_name}.dlx"
+
+    @property
+    def dlq_name(self) -> str:
+        return f"{self.queue_name}.dlq"
+
+    def retry_queue_name(self, delay: float) -> str:
+        return f"{self.queue_name}.retry.{int(delay * 1000)}ms"
+
+    def subscribe(self, *patterns: str) -> Callable[[Handler], Handler]:
+        if not patterns:
+            raise ValueError("At least one routing key pattern is required")
+
+        def decorator(handler: Handler) -> Handler:
+            self.subscriptions.append(Subscription(tuple(patterns), handler))
+            self._routes.clear()
+            return handler
+        return decorator
+
+    @property
+    def patterns(self) -> List[str]:
+        seen: Dict[str, None] = {}
+        for subscription in self.subscriptions:
+            for pattern in subscription.patterns:
+                seen[pattern] = None
+        return list(seen)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(len(events) for events in self._pending.values())
+
+    async def start(self, connection: aio_pika.abc.AbstractConnection):
+        # Канал с подтверждениями: сообщение подтверждается брокеру только
+        # после того, как его копия принята в очередь повтора или DLQ
+        self._channel = await connection.channel(publisher_confirms=True)
+        # Без явного prefetch брокер отдает все сообщения очереди сразу
+        await self._channel.set_qos(prefetch_count=self.prefetch_count)
+        exchange = await self._channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.TOPIC)
+        self._queue = await self._channel.declare_queue(self.queue_name, durable=True)
+        for pattern in self.stale_bindings:
+            if pattern not in self.patterns:
+                await self._queue.unbind(exchange, routing_key=pattern)
+        for pattern in self.patterns:
+            await self._queue.bind(exchange, routing_key=pattern)
+
+        self._dlx = await self._channel.declare_exchange(self.dlx_name, aio_pika.ExchangeType.FANOUT, durable=True)
+        self._dlq = await self._channel.declare_queue(self.dlq_name, durable=True)
+        await self._dlq.bind(self._dlx)
+        for delay in self.retry_delays:
+            # По истечении TTL брокер возвращает сообщение в основную очередь
+            await self._channel.declare_queue(self.retry_queue_name(delay), durable=True, arguments={
+                "x-message-ttl": int(delay * 1000),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue_name
+            })
+
+        self._consumer_tag = await self._queue.consume(self._on_message)
+        if self.quarantine is not None:
+            self._dlq_consumer_tag = await self._dlq.consume(self._on_dead_letter)
+
+    async def stop(self):
+        for queue, tag in ((self._queue, self._consumer_tag), (self._dlq, self._dlq_consumer_tag)):
+            if queue is not None and tag is not None:
+                try:
+                    await queue.cancel(tag)
+                except Exception as e:
+                    print(f"Error cancelling consumer {queue.name}: {e}")
+        self._consumer_tag = self._dlq_consumer_tag = None
+        if self._drains:
+            await asyncio.gather(*self._drains.values(), return_exceptions=True)
+
+    def _match(self, routing_key: str) -> List[Subscription]:
+        routes = self._routes.get(routing_key)
+        if routes is None:
+            routes = [s for s in self.subscriptions if any(topic_matches(p, routing_key) for p in s.patterns)]
+            self._routes[routing_key] = routes
+        return routes
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        # Вызывается задачей на каждое сообщение в порядке доставки; до первого
+        # await событие уже стоит в очереди своего ключа, поэтому порядок сохраняется
+        self.stats["received"] += 1
+        event = Event(message)
+        key = event.ordering_key
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+        pending.append(event)
+        if key not in self._drains:
+            self._drains[key] = asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key: str):
+        pending = self._pending[key]
+        try:
+            while pending:
+                event = pending[0]
+                try:
+                    await self._handle(event)
+                except Exception as e:
+                    # Не удалось переложить в повтор/DLQ: вернем сообщение в очередь
+                    print(f"Error settling {event.routing_key} from {self.queue_name}: {e}")
+                    try:
+                        await event.message.nack(requeue=True)
+                    except Exception:
+                        pass
+                pending.popleft()
+        finally:
+            del self._pending[key]
+            del self._drains[key]
+
+    async def _handle(self, event: Event):
+        message = event.message
+        subscriptions = self._match(event.routing_key)
+        if not subscriptions:
+            # Осталась привязка от старой версии или шаблон шире обработчиков
+            self.stats["unrouted"] += 1
+            await message.ack()
+            return
+
+        redelivered = message.redelivered and self.quarantine is not None
+        if redelivered:
+            # Повторная доставка без ack - скорее всего, процесс упал на этом сообщении
+            deliveries = self.quarantine.note_redelivery(self.queue_name, event.message_key)
+            if deliveries > self.max_redeliveries:
+                names = [s.name for s in subscriptions]
+                await self._dead_letter(event, names, f"Redelivered {deliveries} times without ack")
+                await message.ack()
+                self.quarantine.clear_redelivery(self.queue_name, event.message_key)
+                return
+
+        failed_before = event.failed_handlers
+        if failed_before is not None:
+            subscriptions = [s for s in subscriptions if s.name in failed_before]
+
+        # События, опубликованные обработчиками, продолжат trace этого события
+        trace = trace_context.set(_header_str(event.headers[TRACEPARENT_HEADER])
+                                  if TRACEPARENT_HEADER in event.headers else None)
+        errors: Dict[str, Exception] = {}
+        try:
+            for subscription in subscriptions:
+                try:
+                    await subscription.handler(event)
+                    self.stats["handled"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    errors[subscription.name] = e
+                    print(f"Error in {subscription.name} for {event.routing_key} "
+                          f"(attempt {event.attempt + 1}): {e}")
+        finally:
+            trace_context.reset(trace)
+
+        if errors:
+            await self._retry_or_dead_letter(event, errors)
+        await message.ack()
+        if redelivered:
+            self.quarantine.clear_redelivery(self.queue_name, event.message_key)
+
+    def _copy(self, event: Event, headers: Dict[str, Any]) -> aio_pika.Message:
+        message = event.message
+        return aio_pika.Message(
+            body=message.body,
+            headers=headers,
+            content_type=message.content_type,
+            type=message.type,
+            message_id=message.message_id,
+            correlation_id=message.correlation_id,
+            timestamp=message.timestamp,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        )
+
+    async def _retry_or_dead_letter(self, event: Event, errors: Dict[str, Exception]):
+        reason = "; ".join(f"{name}: {error!r}" for name, error in errors.items())[:2000]
+        permanent = any(isinstance(error, PERMANENT_ERRORS) for error in errors.values())
+        attempt = event.attempt
+        if permanent or attempt >= len(self.retry_delays):
+            await self._dead_letter(event, list(errors), reason)
+            return
+
+        headers = {
+            **event.headers,
+            ORIGINAL_ROUTING_KEY_HEADER: event.routing_key,
+            RETRY_COUNT_HEADER: attempt + 1,
+            FAILED_HANDLERS_HEADER: ",".join(errors),
+            ERROR_HEADER: reason
+        }
+        await self._channel.default_exchange.publish(
+            self._copy(event, headers),
+            routing_key=self.retry_queue_name(self.retry_delays[attempt])
+        )
+        self.stats["retried"] += 1
+
+    async def _dead_letter(self, event: Event, handlers: List[str], reason: str):
+        headers = {
+            **event.headers,
+            ORIGINAL_ROUTING_KEY_HEADER: event.routing_key,
+            FAILED_HANDLERS_HEADER: ",".join(handlers),
+            ERROR_HEADER: reason,
+            FAILED_AT_HEADER: time.time()
+        }
+        await self._dlx.publish(self._copy(event, headers), routing_key=event.routing_key)
+        self.stats["dead_lettered"] += 1
+        print(f"Dead-lettered {event.routing_key} from {self.queue_name}: {reason}")
+
+    async def _on_dead_letter(self, message: aio_pika.abc.AbstractIncomingMessage):
+        event = Event(message)
+        headers = event.headers
+        try:
+            self.quarantine.add(
+                queue=self.queue_name,
+                routing_key=event.routing_key,
+                message_id=message.message_id,
+                body=message.body,
+                content_type=message.content_type,
+                headers={k: _header_str(v) if isinstance(v, bytes) else v for k, v in headers.items()},
+                error=_header_str(headers.get(ERROR_HEADER, "")),
+                attempts=event.attempt + 1,
+                failed_at=float(headers.get(FAILED_AT_HEADER, time.time()))
+            )
+        except Exception as e:
+            print(f"Could not quarantine message from {self.dlq_name}: {e}")
+            await message.nack(requeue=True)
+            return
+        self.stats["quarantined"] += 1
+        await message.ack()
+
+    async def replay(self, letter: dict):
+        """Вернуть сообщение из карантина в очередь этого сервиса.
+
+        Публикация идет через default exchange прямо в очередь, а не в "events",
+        поэтому другие подписчики событие повторно не получат. Выполняются
+        только обработчики, которые упали в прошлый раз.
+        """
+        headers = {
+            k: v for k, v in letter["headers"].items()
+            if k not in (RETRY_COUNT_HEADER, ERROR_HEADER, FAILED_AT_HEADER)
+        }
+        headers[ORIGINAL_ROUTING_KEY_HEADER] = letter["routing_key"]
+        headers[REPLAY_COUNT_HEADER] = letter["replay_count"] + 1
+        await self._channel.default_exchange.publish(
+            aio_pika.Message(
+                body=letter["body"],
+                headers=headers,
+                content_type=letter["content_type"],
+                type=letter["routing_key"],
+                message_id=letter["message_id"],
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            ),
+            routing_key=self.queue_name
+        )
+        self.stats["replayed"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queue": self.queue_name,
+            "prefetch_count": self.prefetch_count,
+            "bindings": self.patterns,
+            "retry_delays": list(self.retry_delays),
+            "in_flight": self.in_flight,
+            "active_keys": len(self._drains),
+            **self.stats
+        }
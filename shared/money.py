@@ -0,0 +1,56 @@
+"""Денежные суммы в целых минимальных единицах валюты (копейки, центы, иены).
+
+Во внешних API суммы остаются числами с плавающей точкой, но считаются
+только целыми: to_minor переводит число в минимальные единицы через
+десятичное представление (0.1 + 0.2 дает ровно 30 копеек, а 1.005 - 101,
+а не 100, как при int(amount * 100)), from_minor - обратно.
+Число знаков после запятой зависит от валюты (CURRENCY_EXPONENTS).
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from typing import List, Sequence
+
+CURRENCY_EXPONENTS = {
+    "RUB": 2, "USD": 2, "EUR": 2, "GBP": 2, "CNY": 2, "KZT": 2, "BYN": 2,
+    "JPY": 0, "KRW": 0,
+    "KWD": 3, "BHD": 3,
+}
+
+
+class CurrencyError(ValueError):
+    pass
+
+
+def exponent(currency: str) -> int:
+    try:
+        return CURRENCY_EXPONENTS[currency.upper()]
+    except KeyError:
+        raise CurrencyError(f"Unsupported currency {currency}")
+
+
+def to_minor(amount: float, currency: str = "RUB") -> int:
+    """Сумма в минимальных единицах, округление половины от нуля"""
+    return int(Decimal(str(amount)).scaleb(exponent(currency)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor(minor: int, currency: str = "RUB") -> float:
+    return minor / 10 ** exponent(currency)
+
+
+def round_div(numerator: int, denominator: int) -> int:
+    """Целочисленное деление неотрицательных чисел с округлением половины вверх"""
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def allocate(amount: int, weights: Sequence[int]) -> List[int]:
+    """Разделить сумму пропорционально весам без потери единиц (метод наибольших остатков)"""
+    total = sum(weights)
+    if total <= 0:
+        parts = [0] * len(weights)
+        if parts:
+            parts[0] = amount
+        return parts
+    parts = [amount * w // total for w in weights]
+    remainders = sorted(range(len(weights)), key=lambda i: amount * weights[i] % total, reverse=True)
+    for i in remainders[:amount - sum(parts)]:
+        parts[i] += 1
+    return parts
@@ -0,0 +1,278 @@
+"""Асинхронный circuit breaker с bulkhead для вызовов внешних зависимостей.
+
+Breaker считает долю ошибок и медленных вызовов в скользящем окне из
+последних `window_size` вызовов. При превышении порога он размыкается на
+`open_timeout` секунд, затем пропускает `half_open_max_calls` пробных
+вызовов. Bulkhead ограничивает число одновременных вызовов зависимости.
+
+Breaker'ы регистрируются по имени в процессе (`get_breaker`), их состояние
+отдается через `breaker_status()` и метрики Prometheus.
+"""
+import asyncio
+import time
+from collections import deque
+from enum import Enum
+from functools import wraps
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Type
+
+from prometheus_client import Counter, Gauge
+
+
+class CircuitState(str, Enum):
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+
+_STATE_VALUES = {CircuitState.CLOSED: 0, CircuitState.OPEN: 1, CircuitState.HALF_OPEN: 2}
+
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state",
+    "Circuit breaker state (0=closed, 1=open, 2=half_open)",
+    ["name"]
+)
+CIRCUIT_CALLS = Counter(
+    "circuit_breaker_calls_total",
+    "Calls through circuit breaker by outcome",
+    ["name", "outcome"]
+)
+BULKHEAD_IN_FLIGHT = Gauge(
+    "bulkhead_in_flight",
+    "Concurrent calls currently holding a bulkhead slot",
+    ["name"]
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit {name} is open, retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"Bulkhead {name} is full")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_size: int = 50,
+        minimum_calls: int = 10,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = 2.0,
+        slow_call_rate_threshold: float = 0.8,
+        open_timeout: float = 10.0,
+        half_open_max_calls: int = 3,
+        max_concurrent: Optional[int] = None,
+        max_wait: Optional[float] = None,
+        ignore_exceptions: Tuple[Type[BaseException], ...] = ()
+    ):
+        """
+        max_concurrent - размер bulkhead (None - без ограничения);
+        max_wait - сколько ждать свободного места: None - без ограничения, 0 - отказать сразу.
+        """
+        self.name = name
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_timeout = open_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.ignore_exceptions = ignore_exceptions
+
+        self.state = CircuitState.CLOSED
+        self.opened_at: Optional[float] = None
+        # (failed, slow) по последним вызовам; счетчики ведутся инкрементально
+        self._window: Deque[Tuple[bool, bool]] = deque()
+        self._window_failures = 0
+        self._window_slow = 0
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        # Номер полуоткрытого периода: пробы прошлого периода, завершившиеся позже,
+        # не трогают счетчики текущего
+        self._half_open_generation = 0
+
+        self._bulkhead = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+        self.in_flight = 0
+        self.totals = {"success": 0, "failure": 0, "slow": 0, "rejected": 0, "bulkhead_rejected": 0}
+
+        CIRCUIT_STATE.labels(name).set(0)
+
+    # --- состояние ---
+
+    def _set_state(self, state: CircuitState):
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(_STATE_VALUES[state])
+        if state == CircuitState.OPEN:
+            self.opened_at = time.monotonic()
+        elif state == CircuitState.HALF_OPEN:
+            self._half_open_generation += 1
+            self._half_open_in_flight = 0
+            self._half_open_successes = 0
+        else:
+            self.opened_at = None
+            self._window.clear()
+            self._window_failures = 0
+            self._window_slow = 0
+
+    def _count(self, outcome: str):
+        self.totals[outcome] += 1
+        CIRCUIT_CALLS.labels(self.name, outcome).inc()
+
+    def _before_call(self) -> Optional[int]:
+        """Пропустить вызов или отказать; для пробного вызова - номер полуоткрытого периода"""
+        if self.state == CircuitState.OPEN:
+            remaining = self.opened_at + self.open_timeout - time.monotonic()
+            if remaining > 0:
+                self._count("rejected")
+                raise CircuitOpenError(self.name, remaining)
+            self._set_state(CircuitState.HALF_OPEN)
+
+        if self.state == CircuitState.HALF_OPEN:
+            if self._half_open_in_flight >= self.half_open_max_calls:
+                self._count("rejected")
+                raise CircuitOpenError(self.name, 0.0)
+            self._half_open_in_flight += 1
+            return self._half_open_generation
+        return None
+
+    def _probe_finished(self, probe: Optional[int]) -> bool:
+        """Проба текущего полуоткрытого периода завершилась: освободить ее место"""
+        if probe is None or probe != self._half_open_generation or self.state != CircuitState.HALF_OPEN:
+            return False
+        self._half_open_in_flight -= 1
+        return True
+
+    def _record(self, failed: bool, slow: bool, probe: Optional[int]):
+        if failed:
+            self._count("failure")
+        else:
+            self._count("success")
+        if slow:
+            self._count("slow")
+
+        if probe is not None:
+            if not self._probe_finished(probe):
+                return
+            if failed or slow:
+                self._set_state(CircuitState.OPEN)
+            else:
+                self._half_open_successes += 1
+                if self._half_open_successes >= self.half_open_max_calls:
+                    self._set_state(CircuitState.CLOSED)
+            return
+
+        if self.state != CircuitState.CLOSED:
+            return
+
+        self._window.append((failed, slow))
+        self._window_failures += failed
+        self._window_slow += slow
+        if len(self._window) > self.window_size:
+            old_failed, old_slow = self._window.popleft()
+            self._window_failures -= old_failed
+            self._window_slow -= old_slow
+
+        calls = len(self._window)
+        if calls >= self.minimum_calls and (
+            self._window_failures / calls >= self.failure_rate_threshold
+            or self._window_slow / calls >= self.slow_call_rate_threshold
+        ):
+            self._set_state(CircuitState.OPEN)
+
+    # --- bulkhead ---
+
+    async def _acquire(self):
+        if self._bulkhead is None:
+            return
+        if self.max_wait == 0:
+            if self._bulkhead.locked():
+                self._count("bulkhead_rejected")
+                raise BulkheadFullError(self.name)
+            await self._bulkhead.acquire()
+        elif self.max_wait is None:
+            await self._bulkhead.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self._bulkhead.acquire(), timeout=self.max_wait)
+            except asyncio.TimeoutError:
+                self._count("bulkhead_rejected")
+                raise BulkheadFullError(self.name)
+
+    def _release(self):
+        if self._bulkhead is not None:
+            self._bulkhead.release()
+
+    # --- вызов ---
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        await self._acquire()
+        self.in_flight += 1
+        BULKHEAD_IN_FLIGHT.labels(self.name).inc()
+        try:
+            probe = self._before_call()
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                self._probe_finished(probe)
+                raise
+            except self.ignore_exceptions:
+                self._record(False, False, probe)
+                raise
+            except Exception:
+                self._record(True, time.monotonic() - started >= self.slow_call_duration, probe)
+                raise
+            self._record(False, time.monotonic() - started >= self.slow_call_duration, probe)
+            return result
+        finally:
+            self.in_flight -= 1
+            BULKHEAD_IN_FLIGHT.labels(self.name).dec()
+            self._release()
+
+    def __call__(self, func: Callable[..., Awaitable[Any]]):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.call(func, *args, **kwargs)
+        return wrapper
+
+    def snapshot(self) -> Dict[str, Any]:
+        calls = len(self._window)
+        open_until = None
+        if self.state == CircuitState.OPEN:
+            open_until = time.time() + max(0.0, self.opened_at + self.open_timeout - time.monotonic())
+        return {
+            "name": self.name,
+            "state": self.state.value,
+            "failure_count": self._window_failures,
+            "slow_call_count": self._window_slow,
+            "calls_in_window": calls,
+            "failure_rate": self._window_failures / calls if calls else 0.0,
+            "slow_call_rate": self._window_slow / calls if calls else 0.0,
+            "open_until": open_until,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "totals": dict(self.totals)
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str, **config) -> CircuitBreaker:
+    """Breaker по имени зависимости; настройки применяются при первом создании"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name, **config)
+    return breaker
+
+
+def breaker_status() -> List[Dict[str, Any]]:
+    return [breaker.snapshot() for breaker in _breakers.values()]